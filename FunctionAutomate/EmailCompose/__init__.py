@@ -1,63 +1,510 @@
-"""Compose text using Jinja2.
-
-Composes a text using a Jinja2 template stored in the Function App's storage
-account.
-
-The incoming request is expected to have the following 3 parameters:
-- template_parameters
-- template_file
-- share_name
-
-Requires the following env variables:
-- AzureWebJobsStorage
-
-Author: Guillem Ballesteros
-"""
-import json
-import os
-
-from __app__.utilities import utilities
-
-import azure.functions as func
-from azure.storage.fileshare import ShareFileClient
-
-from jinja2 import Template
-
-
-def get_template(conn_str: str, share_name: str, template_path: str) -> Template:
-    """Retrieve Jinja2 template from Azure File Share.
-
-    Parameters
-    ----------
-    conn_str
-        Connection string to the storage account. Typically stored in an env
-        variable.
-    share_name
-        Name of the file share in the storage account where the template file
-        is kept.
-    template_path
-        Full path to the template file relative to the root of the file share.
-    """
-    data = ShareFileClient.from_connection_string(
-        conn_str=conn_str, share_name=share_name, file_path=template_path,
-    ).download_file()
-
-    template = Template(data.readall().decode("utf-8"))
-
-    return template
-
-
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    template_parameters = utilities.get_param(req, "template_parameters")
-    template_file = utilities.get_param(req, "template_file")
-    share_name = utilities.get_param(req, "share_name")
-
-    template = get_template(
-        conn_str=os.environ["AzureWebJobsStorage"],
-        share_name=share_name,
-        template_path=template_file,
-    )
-
-    completed_template = template.render(template_parameters)
-
-    return func.HttpResponse(json.dumps({"output_text": completed_template}))
+"""Compose text using Jinja2.
+
+Composes a text using a Jinja2 template stored in the Function App's storage
+account.
+
+The incoming request is expected to have the following 3 parameters:
+- template_parameters
+- template_file
+- share_name
+
+Alternatively template_parameters can be replaced by template_parameters_batch,
+a list of parameter sets. The template is then rendered once per set and the
+outputs are returned as newline delimited JSON, one line per set and in the
+same order. Render errors are reported in the line of the failing set. The
+response body is built in memory, so batches are bounded by the following
+optional env variables and rejected with a 413 beyond them:
+- COMPOSE_BATCH_MAX_ITEMS: Maximum number of parameter sets. Defaults to 1000.
+- COMPOSE_BATCH_MAX_BYTES: Maximum size of the response body. Defaults to
+    16 MiB.
+
+Requires the following env variables:
+- AzureWebJobsStorage
+
+Templates are loaded through a Jinja2 Environment backed by the File Share so
+they can use {% extends %} and {% include %} relative to the root of the share.
+
+Compiled templates are kept in a process wide cache which can be tuned with
+the following optional env variables:
+- TEMPLATE_CACHE_MAX_BYTES: Memory budget for the cached templates.
+- TEMPLATE_CACHE_REVALIDATE_SECONDS: Seconds a cached template is trusted
+    before checking its ETag against the File Share again.
+- TEMPLATE_WARM_UP_SHARE: If set, every template in this share is compiled in
+    the background when the worker starts.
+- TEMPLATE_WARM_UP_PREFIX: Restrict the warm up to a directory of the share.
+
+Repeated renders of the same template with the same template_parameters can
+be served from a process wide output cache. Outputs are keyed by the ETags of
+the template and its dependencies, so they are not served anymore once any of
+them changes. The response tells whether the output came from the cache.
+- RENDER_CACHE_MAX_BYTES: Memory budget for the cached outputs. The cache is
+    disabled when unset or 0.
+
+An asyncio flavour of the entry point is available as main_async. Set
+"entryPoint": "main_async" in function.json to use it.
+
+Author: Guillem Ballesteros
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from __app__.EmailCompose import loader
+from __app__.utilities import aio
+from __app__.utilities import caching
+from __app__.utilities import clients
+from __app__.utilities import exceptions
+from __app__.utilities import schema
+
+import azure.functions as func
+
+from jinja2 import Environment, Template
+
+
+class CachedTemplate(NamedTuple):
+    template: Template
+    etag: str
+    size: int
+    checked_at: float
+
+
+class TemplateCache:
+    """Process wide cache of compiled templates.
+
+    Templates are keyed by (share_name, template_path). A cached template is
+    served without touching the File Share until revalidate_after seconds
+    have passed. After that its ETag is compared against the one on the share
+    and the template is only downloaded and compiled again if it changed.
+    """
+
+    def __init__(self, max_bytes: int, revalidate_after: float) -> None:
+        """Init the template cache.
+
+        Parameters
+        ----------
+        max_bytes
+            Memory budget for the cache. The size of a template is
+            approximated by the size of its source.
+        revalidate_after
+            Seconds after which a cached template has to be checked against
+            the File Share before being used again.
+        """
+        self.revalidate_after = revalidate_after
+        self.revalidations = 0
+        self._cache = caching.LRUCache(max_bytes)
+
+    def get(self, conn_str: str, share_name: str, template_path: str) -> Template:
+        """Retrieve a compiled template from the cache or the File Share.
+
+        Parameters
+        ----------
+        conn_str
+            Connection string to the storage account.
+        share_name
+            Name of the file share where the template file is kept.
+        template_path
+            Full path to the template file relative to the root of the share.
+        """
+        key = (share_name, template_path)
+        cached = self._cache.get(key)
+        if self._is_fresh(cached):
+            exceptions.annotate(template_cache="hit")
+            return cached.template
+
+        if cached is not None:
+            with exceptions.span("file_share.properties"):
+                etag = (
+                    clients.get_file_client(
+                        conn_str=conn_str,
+                        share_name=share_name,
+                        file_path=template_path,
+                    )
+                    .get_file_properties()
+                    .etag
+                )
+            if self._revalidate(key, cached, etag):
+                return cached.template
+
+        exceptions.annotate(template_cache="miss")
+        environment = loader.get_environment(
+            conn_str, share_name, self.revalidate_after
+        )
+        with exceptions.span("template.load"):
+            template = environment.loader.load_with_dependencies(
+                environment, template_path
+            )
+
+        return self._store(key, environment, template)
+
+    async def get_async(
+        self, conn_str: str, share_name: str, template_path: str
+    ) -> Template:
+        """Counterpart of get using the aio File Share client."""
+        key = (share_name, template_path)
+        cached = self._cache.get(key)
+        if self._is_fresh(cached):
+            exceptions.annotate(template_cache="hit")
+            return cached.template
+
+        if cached is not None:
+            etag = await aio.get_etag(conn_str, share_name, template_path)
+            if self._revalidate(key, cached, etag):
+                return cached.template
+
+        exceptions.annotate(template_cache="miss")
+        environment = loader.get_environment(
+            conn_str, share_name, self.revalidate_after
+        )
+        with exceptions.span("template.load"):
+            sources = await environment.loader.prefetch_async(
+                environment, template_path
+            )
+            template = environment.loader.load_with_dependencies(
+                environment, template_path, sources
+            )
+
+        return self._store(key, environment, template)
+
+    def _is_fresh(self, cached: Optional[CachedTemplate]) -> bool:
+        return (
+            cached is not None
+            and time.monotonic() - cached.checked_at < self.revalidate_after
+        )
+
+    def _revalidate(
+        self, key: Tuple[str, str], cached: CachedTemplate, etag: str
+    ) -> bool:
+        """Check a cached template against the ETag of its file.
+
+        Returns whether the cached template is still valid.
+        """
+        self.revalidations += 1
+        exceptions.annotate(template_cache="revalidated")
+        if etag == cached.etag:
+            self._cache.put(
+                key, cached._replace(checked_at=time.monotonic()), cached.size
+            )
+            return True
+
+        logging.info(f"Template {key[1]} changed. Reloading.")
+        return False
+
+    def _store(
+        self, key: Tuple[str, str], environment: Environment, template: Template
+    ) -> Template:
+        etag, size = environment.loader.versions[key[1]]
+        self._cache.put(
+            key, CachedTemplate(template, etag, size, time.monotonic()), size
+        )
+
+        return template
+
+    def stats(self) -> Dict[str, int]:
+        """Report hit/miss counters of the cache."""
+        return dict(self._cache.stats(), revalidations=self.revalidations)
+
+
+class RenderCache:
+    """Process wide cache of rendered outputs.
+
+    Outputs are keyed by the template, its version as reported by the loader
+    and a hash of the canonical JSON of the parameters. Outputs of old
+    versions of a template are never looked up again and are left for the LRU
+    policy to evict.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        """Init the render cache.
+
+        Parameters
+        ----------
+        max_bytes
+            Memory budget for the cache. The size of an output is approximated
+            by its length. A budget of 0 disables the cache.
+        """
+        self.max_bytes = max_bytes
+        self._cache = caching.LRUCache(max_bytes)
+
+    @staticmethod
+    def parameters_hash(template_parameters: Any) -> str:
+        """Hash of the parameters that does not depend on the order of keys."""
+        canonical = json.dumps(
+            template_parameters,
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def render(
+        self,
+        template: Template,
+        share_name: str,
+        template_path: str,
+        template_parameters: Any,
+    ) -> Tuple[str, bool]:
+        """Render a template unless the same output is already cached.
+
+        Parameters
+        ----------
+        template
+            Compiled template as returned by get_template.
+        share_name
+            Name of the file share where the template file is kept.
+        template_path
+            Full path to the template file relative to the root of the share.
+        template_parameters
+            Parameters of the render. Must be JSON serializable.
+
+        Returns
+        -------
+        The output and whether it was served from the cache.
+        """
+        if self.max_bytes <= 0:
+            return template.render(template_parameters), False
+
+        environment = template.environment
+        key = (
+            share_name,
+            template_path,
+            environment.loader.version(environment, template_path),
+            self.parameters_hash(template_parameters),
+        )
+        output = self._cache.get(key)
+        exceptions.annotate(render_cache="miss" if output is None else "hit")
+        if output is not None:
+            return output, True
+
+        output = template.render(template_parameters)
+        self._cache.put(key, output, len(output))
+
+        return output, False
+
+    def stats(self) -> Dict[str, int]:
+        """Report hit/miss counters of the cache."""
+        return self._cache.stats()
+
+
+_render_cache = RenderCache(int(os.environ.get("RENDER_CACHE_MAX_BYTES", 0)))
+
+_template_cache = TemplateCache(
+    max_bytes=int(os.environ.get("TEMPLATE_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+    revalidate_after=float(os.environ.get("TEMPLATE_CACHE_REVALIDATE_SECONDS", 60)),
+)
+
+
+def get_template(conn_str: str, share_name: str, template_path: str) -> Template:
+    """Retrieve Jinja2 template from Azure File Share.
+
+    Templates are served from the process wide template cache whenever
+    possible.
+
+    Parameters
+    ----------
+    conn_str
+        Connection string to the storage account. Typically stored in an env
+        variable.
+    share_name
+        Name of the file share in the storage account where the template file
+        is kept.
+    template_path
+        Full path to the template file relative to the root of the file share.
+    """
+    return _template_cache.get(conn_str, share_name, template_path)
+
+
+async def get_template_async(
+    conn_str: str, share_name: str, template_path: str
+) -> Template:
+    """Counterpart of get_template for the asyncio entry point."""
+    return await _template_cache.get_async(conn_str, share_name, template_path)
+
+
+def warm_up(conn_str: str, share_name: str, prefix: str = "") -> int:
+    """Compile every template under a directory of a File Share.
+
+    Meant to be run when the worker starts so that the first requests find
+    the template cache and the bytecode cache already populated. Templates
+    that fail to compile are logged and skipped.
+
+    Parameters
+    ----------
+    conn_str
+        Connection string to the storage account.
+    share_name
+        Name of the file share with the templates.
+    prefix
+        Directory within the share to restrict the warm up to.
+
+    Returns
+    -------
+    Number of templates compiled.
+    """
+
+    def compile_template(template_path: str) -> bool:
+        try:
+            get_template(conn_str, share_name, template_path)
+        except Exception as e:
+            logging.info(f"Could not warm up template {template_path}: {e}")
+            return False
+        return True
+
+    template_paths = loader.list_templates(conn_str, share_name, prefix)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        compiled = sum(executor.map(compile_template, template_paths))
+    logging.info(f"Warmed up {compiled} templates from {share_name}/{prefix}")
+
+    return compiled
+
+
+if os.environ.get("TEMPLATE_WARM_UP_SHARE"):
+    threading.Thread(
+        target=warm_up,
+        args=(
+            os.environ["AzureWebJobsStorage"],
+            os.environ["TEMPLATE_WARM_UP_SHARE"],
+            os.environ.get("TEMPLATE_WARM_UP_PREFIX", ""),
+        ),
+        daemon=True,
+    ).start()
+
+
+def render_batch(
+    template: Template, parameter_sets: Iterable[Dict[str, Any]]
+) -> Iterator[str]:
+    """Render a template for every parameter set as newline delimited JSON.
+
+    Lines are produced lazily so that only one rendered output is alive at a
+    time. A failing render does not interrupt the batch, the error is
+    reported in place of the output.
+
+    Parameters
+    ----------
+    template
+        Compiled template.
+    parameter_sets
+        Parameters for each of the renders.
+    """
+    for index, template_parameters in enumerate(parameter_sets):
+        try:
+            line = {
+                "index": index,
+                "output_text": template.render(template_parameters),
+            }
+        except Exception as e:
+            line = {"index": index, "error": f"{type(e).__name__}: {e}"}
+
+        yield json.dumps(line) + "\n"
+
+
+def batch_response(
+    template: Template, parameter_sets: List[Dict[str, Any]]
+) -> func.HttpResponse:
+    """Render a batch into a single NDJSON response of bounded size.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError with a 413 status if the batch has more
+    than COMPOSE_BATCH_MAX_ITEMS sets or its output is larger than
+    COMPOSE_BATCH_MAX_BYTES.
+    """
+    max_items = int(os.environ.get("COMPOSE_BATCH_MAX_ITEMS", 1000))
+    if len(parameter_sets) > max_items:
+        msg = f"Batches are limited to {max_items} parameter sets"
+        raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=413))
+
+    max_bytes = int(os.environ.get("COMPOSE_BATCH_MAX_BYTES", 16 * 2 ** 20))
+    lines = []
+    size = 0
+    with exceptions.span("render"):
+        for line in render_batch(template, parameter_sets):
+            size += len(line.encode("utf-8"))
+            if size > max_bytes:
+                msg = f"Batch output is larger than the limit of {max_bytes} bytes"
+                raise exceptions.HttpError(
+                    msg, func.HttpResponse(msg, status_code=413)
+                )
+            lines.append(line)
+    exceptions.annotate(output_bytes=size)
+
+    return func.HttpResponse("".join(lines), mimetype="application/x-ndjson")
+
+
+COMPOSE_FIELDS = [
+    schema.Field("template_file", required=True),
+    schema.Field("share_name", required=True),
+    schema.Field("template_parameters"),
+    schema.Field("template_parameters_batch", coerce=schema.json_list),
+]
+
+
+def compose_response(template: Template, params: Dict[str, Any]) -> func.HttpResponse:
+    """Render a template for a request.
+
+    Parameters
+    ----------
+    template
+        Compiled template of the request.
+    params
+        Parameters of the request as parsed with COMPOSE_FIELDS.
+    """
+    if exceptions.tracing_enabled():
+        exceptions.annotate(template_cache=_template_cache.stats())
+
+    if params["template_parameters_batch"] is not None:
+        return batch_response(template, params["template_parameters_batch"])
+
+    # A fresh dict per request, templates may mutate their parameters.
+    template_parameters = params["template_parameters"] or {}
+    with exceptions.span("render"):
+        completed_template, cached = _render_cache.render(
+            template, params["share_name"], params["template_file"], template_parameters
+        )
+    exceptions.annotate(output_chars=len(completed_template))
+
+    return func.HttpResponse(
+        json.dumps({"output_text": completed_template, "cached": cached})
+    )
+
+
+@exceptions.exceptions_as_response
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    params = schema.parse(req, COMPOSE_FIELDS)
+    template = get_template(
+        conn_str=os.environ["AzureWebJobsStorage"],
+        share_name=params["share_name"],
+        template_path=params["template_file"],
+    )
+
+    return compose_response(template, params)
+
+
+@exceptions.exceptions_as_response_async
+async def main_async(req: func.HttpRequest) -> func.HttpResponse:
+    """Counterpart of main that does not block the worker on storage I/O.
+
+    Templates are fetched with the aio File Share client. Rendering is CPU
+    bound and stays on the event loop.
+    """
+    params = schema.parse(req, COMPOSE_FIELDS)
+    template = await get_template_async(
+        conn_str=os.environ["AzureWebJobsStorage"],
+        share_name=params["share_name"],
+        template_path=params["template_file"],
+    )
+
+    return compose_response(template, params)
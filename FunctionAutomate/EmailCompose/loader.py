@@ -0,0 +1,367 @@
+"""Jinja2 loader for templates stored in an Azure File Share.
+
+Loading templates through a proper Environment instead of building bare
+Templates from strings enables the use of {% extends %} and {% include %}.
+Compiled templates are also persisted to a bytecode cache in local temp
+storage so that recycled or scaled-out instances skip compilation.
+
+Optional env variables:
+- TEMPLATE_BYTECODE_DIR: Directory for the bytecode cache. Defaults to the
+    per user folder Jinja creates in the system temp directory, which only
+    the user running the worker can access.
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from __app__.utilities import aio
+from __app__.utilities import clients
+from __app__.utilities import exceptions
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from jinja2 import (
+    BaseLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    Template,
+    TemplateNotFound,
+    TemplateSyntaxError,
+    meta,
+)
+
+if TYPE_CHECKING:
+    from azure.storage.fileshare import ShareFileClient
+
+
+class TemplateSource(NamedTuple):
+    source: str
+    etag: str
+    fetched_at: float
+
+
+class FileShareLoader(BaseLoader):
+    """Load templates from a single Azure File Share.
+
+    Template names are paths relative to the root of the share. Whether a
+    compiled template is still up to date is decided by comparing the ETag of
+    the file, which is checked at most once every revalidate_after seconds.
+    """
+
+    def __init__(
+        self,
+        conn_str: str,
+        share_name: str,
+        revalidate_after: float,
+        max_workers: int = 8,
+    ) -> None:
+        """Init the loader.
+
+        Parameters
+        ----------
+        conn_str
+            Connection string to the storage account.
+        share_name
+            Name of the file share templates are loaded from.
+        revalidate_after
+            Seconds a loaded template is trusted before checking its ETag.
+        max_workers
+            Number of concurrent downloads when prefetching dependencies.
+        """
+        self.conn_str = conn_str
+        self.share_name = share_name
+        self.revalidate_after = revalidate_after
+        self.max_workers = max_workers
+        self.versions: Dict[str, Tuple[str, int]] = {}
+        self.dependencies: Dict[str, Tuple[str, ...]] = {}
+        self._prefetched: Dict[str, TemplateSource] = {}
+        self._lock = threading.Lock()
+
+    def _file_client(self, template: str) -> "ShareFileClient":
+        return clients.get_file_client(
+            conn_str=self.conn_str, share_name=self.share_name, file_path=template,
+        )
+
+    def fetch(self, template: str) -> TemplateSource:
+        """Download the source of a template from the File Share.
+
+        Raise
+        -----
+        Raises TemplateNotFound if the file does not exist.
+        """
+        try:
+            with exceptions.span("file_share.download"):
+                data = self._file_client(template).download_file()
+                source = data.readall().decode("utf-8")
+        except ResourceNotFoundError:
+            raise TemplateNotFound(template)
+
+        return TemplateSource(source, data.properties.etag, time.monotonic())
+
+    def get_source(
+        self, environment: Environment, template: str
+    ) -> Tuple[str, Optional[str], Callable[[], bool]]:
+        with self._lock:
+            loaded = self._prefetched.get(template)
+        if loaded is None:
+            loaded = self.fetch(template)
+
+        with self._lock:
+            self.versions[template] = (loaded.etag, len(loaded.source))
+
+        checked_at = [loaded.fetched_at]
+
+        def uptodate() -> bool:
+            if time.monotonic() - checked_at[0] < self.revalidate_after:
+                return True
+            try:
+                etag = self._file_client(template).get_file_properties().etag
+            except ResourceNotFoundError:
+                return False
+            checked_at[0] = time.monotonic()
+            return bool(etag == loaded.etag)
+
+        return loaded.source, f"{self.share_name}/{template}", uptodate
+
+    def load_with_dependencies(
+        self,
+        environment: Environment,
+        template: str,
+        sources: Optional[Dict[str, TemplateSource]] = None,
+    ) -> Template:
+        """Load a template after downloading its dependencies concurrently.
+
+        The dependencies are compiled into the Environment's own cache so that
+        rendering does not have to go back to the File Share for them.
+
+        Parameters
+        ----------
+        environment
+            Environment the loader belongs to.
+        template
+            Name of the template to load.
+        sources
+            Sources already downloaded by prefetch_async. They are downloaded
+            with prefetch if not given.
+        """
+        if sources is None:
+            sources = self.prefetch(environment, template)
+        with self._lock:
+            self._prefetched.update(sources)
+            self.dependencies[template] = tuple(
+                sorted(name for name in sources if name != template)
+            )
+
+        try:
+            for name in sources:
+                if name != template:
+                    environment.get_template(name)
+            return self.load(environment, template, environment.globals)
+        finally:
+            with self._lock:
+                for name in sources:
+                    self._prefetched.pop(name, None)
+
+    def version(self, environment: Environment, template: str) -> Tuple[str, ...]:
+        """ETags of a loaded template and of the templates it depends on.
+
+        The dependencies are looked up through the Environment first, which
+        reloads them if their ETag changed just like rendering would.
+
+        Parameters
+        ----------
+        environment
+            Environment the loader belongs to.
+        template
+            Name of a template loaded with load_with_dependencies.
+        """
+        with self._lock:
+            names = (template,) + self.dependencies.get(template, ())
+
+        for name in names[1:]:
+            try:
+                environment.get_template(name)
+            except TemplateNotFound:
+                pass
+
+        with self._lock:
+            return tuple(self.versions.get(name, ("", 0))[0] for name in names)
+
+    def prefetch(
+        self, environment: Environment, template: str
+    ) -> Dict[str, TemplateSource]:
+        """Download a template and everything it depends on concurrently.
+
+        The dependency graph is discovered level by level by parsing every
+        downloaded source for {% extends %}, {% include %} and {% import %}
+        tags. Templates referenced through variables can't be resolved ahead
+        of time and are left for Jinja to load on demand.
+
+        Parameters
+        ----------
+        environment
+            Environment used to parse the sources.
+        template
+            Name of the root template.
+
+        Returns
+        -------
+        The downloaded sources keyed by template name.
+        """
+        sources: Dict[str, TemplateSource] = {}
+        pending: Set[str] = {template}
+        seen: Set[str] = set()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending:
+                seen |= pending
+                fetched = list(executor.map(self._try_fetch, pending))
+                pending = set()
+
+                for name, loaded in fetched:
+                    if loaded is None:
+                        continue
+                    sources[name] = loaded
+                    pending |= set(self._dependencies(environment, loaded.source))
+                pending -= seen
+
+        return sources
+
+    async def prefetch_async(
+        self, environment: Environment, template: str
+    ) -> Dict[str, TemplateSource]:
+        """Counterpart of prefetch using the aio File Share client."""
+        sources: Dict[str, TemplateSource] = {}
+        pending: Set[str] = {template}
+        seen: Set[str] = set()
+
+        while pending:
+            seen |= pending
+            fetched = await asyncio.gather(
+                *[self._try_fetch_async(name) for name in pending]
+            )
+            pending = set()
+
+            for name, loaded in fetched:
+                if loaded is None:
+                    continue
+                sources[name] = loaded
+                pending |= set(self._dependencies(environment, loaded.source))
+            pending -= seen
+
+        return sources
+
+    async def _try_fetch_async(
+        self, template: str
+    ) -> Tuple[str, Optional[TemplateSource]]:
+        try:
+            source, etag = await aio.download_file(
+                self.conn_str, self.share_name, template
+            )
+        except ResourceNotFoundError:
+            return template, None
+
+        return template, TemplateSource(source.decode("utf-8"), etag, time.monotonic())
+
+    def _try_fetch(self, template: str) -> Tuple[str, Optional[TemplateSource]]:
+        # Missing templates are reported when Jinja actually asks for them.
+        try:
+            return template, self.fetch(template)
+        except TemplateNotFound:
+            return template, None
+
+    @staticmethod
+    def _dependencies(environment: Environment, source: str) -> Iterable[str]:
+        try:
+            ast = environment.parse(source)
+        except TemplateSyntaxError:
+            return []
+        return [x for x in meta.find_referenced_templates(ast) if x is not None]
+
+
+def bytecode_cache() -> FileSystemBytecodeCache:
+    """Local cache where compiled templates are persisted.
+
+    Jinja loads the marshalled code it finds there, so the directory must
+    not be writable by other users. A configured directory is created
+    accessible to the current user only. Otherwise Jinja picks a per user
+    folder and checks its ownership and permissions itself.
+    """
+    directory = os.environ.get("TEMPLATE_BYTECODE_DIR")
+    if directory is None:
+        return FileSystemBytecodeCache()
+
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return FileSystemBytecodeCache(directory)
+
+
+_environments: Dict[Tuple[str, str], Environment] = {}
+_environments_lock = threading.Lock()
+
+
+def get_environment(
+    conn_str: str, share_name: str, revalidate_after: float
+) -> Environment:
+    """Retrieve the process wide Environment for a File Share.
+
+    Parameters
+    ----------
+    conn_str
+        Connection string to the storage account.
+    share_name
+        Name of the file share templates are loaded from.
+    revalidate_after
+        Seconds a loaded template is trusted before checking its ETag.
+    """
+    key = (conn_str, share_name)
+    with _environments_lock:
+        if key not in _environments:
+            _environments[key] = Environment(
+                loader=FileShareLoader(conn_str, share_name, revalidate_after),
+                bytecode_cache=bytecode_cache(),
+                auto_reload=True,
+            )
+
+        return _environments[key]
+
+
+def list_templates(conn_str: str, share_name: str, prefix: str = "") -> List[str]:
+    """List recursively the paths of all the files under a share directory.
+
+    Parameters
+    ----------
+    conn_str
+        Connection string to the storage account.
+    share_name
+        Name of the file share.
+    prefix
+        Directory within the share to start from. The root by default.
+    """
+    template_paths = []
+    directories = [prefix.strip("/")]
+    while directories:
+        directory = directories.pop()
+        directory_client = clients.get_directory_client(
+            conn_str=conn_str, share_name=share_name, directory_path=directory,
+        )
+        for item in directory_client.list_directories_and_files():
+            path = f"{directory}/{item['name']}" if directory else item["name"]
+            if item["is_directory"]:
+                directories.append(path)
+            else:
+                template_paths.append(path)
+
+    return template_paths
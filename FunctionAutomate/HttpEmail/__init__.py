@@ -1,233 +1,707 @@
-"""Send emails upon HTTP request.
-
-Depends on the presence of an appropiate Key Vault to store passwords and
-text file based DB stored in the storage account.
-
-Requires the following env variables:
-- KEY_VAULT_URI
-- AzureWebJobsStorage
-
-Author: Guillem Ballesteros
-"""
-
-import json
-import logging
-import os
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import formatdate
-from typing import Dict, List, Union
-
-from __app__.utilities import utilities
-
-import azure.functions as func
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
-from azure.storage.fileshare import ShareFileClient
-
-
-class SenderDB:
-    """Setup our email accounts "DB", it is really just a JSON file.
-
-    The sender details are obtained from a text file stored in an Azure
-    File Share. To avoid having plain text password the text based DB stores
-    a reference to a Key vault Secret.
-
-    The connection to the Key Vault is established using the following
-    environment defined variables:
-    - AZURE_CLIENT_ID
-    - AZURE_CLIENT_SECRET
-    - AZURE_TENANT_ID
-    The client ID and client secret are specific to an App registered in your
-    active directory.
-
-    The KEY_VAULT_URI is also expected to be found on the environment
-    variables.
-
-    The DB is a JSON file with a list of dicts that include:
-    - user: The name which we will refer the account with in the requests.
-    - email: Email of the senders.
-    - host: Host for the SMTP server.
-    - port: Port to the SMTP server.
-    - keyvault_secret: The name of the secret stored in the KeyVault which has
-        the password for the account.
-    """
-
-    def __init__(self, conn_str: str, share_name: str, file_path: str) -> None:
-        """Initialize the sender class.
-
-        Retrieves the DB from the file share. All the parameters of __init__
-        are there to retrieve the DB.
-
-        Parameters
-        ----------
-        conn_str
-            Connection strin to the storage account containing the DB. Every
-            Function App has an storage account associated with it. It's
-            connection strin is stored in the default env variable
-            AzureWebJobsStorage.
-        share_name
-            Name of the share where the DB is kept.
-        file_path
-            Path within the File Share to the DB.
-        """
-
-        file_client = ShareFileClient.from_connection_string(
-            conn_str=conn_str, share_name=share_name, file_path=file_path,
-        )
-
-        data = file_client.download_file()
-        self.email_db = json.loads(data.readall())
-
-    def get_sender(self, user: str) -> Dict[str, Union[str, int]]:
-        """Retrieve the details for a user from the DB.
-
-        If we try to retrieve a user defined multiple times it raises an
-        error since we have ambiguous details.
-
-        Passwords are retrieved from a KeyVault.
-
-        Parameters
-        ----------
-        user
-            User associated with the email account used to deliver the email.
-        """
-
-        sender_details_lst = [x for x in self.email_db if x["user"] == user]
-        if len(sender_details_lst) == 0:
-            logging.info("Sender user not found in DB.")
-            raise KeyError("Sender not found in DB.")
-        elif len(sender_details_lst) > 1:
-            logging.info("More than one sender user in DB. Please fix.")
-            raise KeyError("Ambiguous sender found in DB")
-        else:
-            sender_details: Dict[str, Union[str, int]] = sender_details_lst[0]
-
-        credential = DefaultAzureCredential()
-        client = SecretClient(
-            vault_url=os.environ["KEY_VAULT_URI"], credential=credential
-        )
-        secret = client.get_secret(sender_details["keyvault_secret"]).value
-        sender_details["password"] = secret
-
-        return sender_details
-
-
-def parse_request(req: func.HttpRequest) -> Dict[str, Union[str, List[str]]]:
-    """Extract all the relevant parameters from the incoming request.
-
-    The parameters extracted are:
-    - user (mandatory)
-    - subject (optional default:empty)
-    - recipients (mandatory): Comma separated list of recipiients.
-    - body (optional default: empty)
-    - mimetype (optional default: plain)
-    """
-    param_names = ["user", "subject", "recipients", "body", "mimetype"]
-    email_parameters = {k: utilities.get_param(req, k) for k in param_names}
-    logging.info(f"The incoming parameters are: {email_parameters}")
-
-    # Further prep the parameters
-    if not email_parameters["recipients"]:
-        logging.info("Failed delivery. No recipients received.")
-        raise KeyError("Email recipients not specified in request.")
-    else:
-        email_parameters["recipients"] = email_parameters["recipients"].split(",")
-
-    if not email_parameters["user"]:
-        logging.info("Failed delivery. No sender user specified.")
-        raise KeyError("Sender user was not specified in request.")
-
-    # Set the default parameters
-    if not email_parameters["body"]:
-        email_parameters["body"] = ""
-    if not email_parameters["subject"]:
-        email_parameters["subject"] = ""
-    if not email_parameters["mimetype"]:
-        email_parameters["mimetype"] = "plain"
-
-    return email_parameters
-
-
-class EmailDeliverer:
-    """Configure and deliver emails."""
-
-    def __init__(self, host: str, port: int, email: str, password: str) -> None:
-        """Init email deliverer.
-
-        Parameters
-        ----------
-        host
-            Host for SMTP server.
-        port
-            SMTP port
-        email
-            Email messages are being delivered from.
-        password
-            Password to the email account.
-        """
-        self.host = host
-        self.port = port
-        self.password = password
-        self.email = email
-
-    def send_email(
-        self, recipients: List[str], subject: str, body: str, mimetype: str
-    ) -> None:
-        """Send email.
-
-        Only one message is attached to the email.
-
-        Parameters
-        ----------
-        recipients
-            List of emails who are going to receive the email.
-        subject
-            Subject line of the email.
-        body
-            Text body of the email.
-        mimetype
-            MIME type for the attached message
-        """
-        msg = MIMEMultipart()
-        msg["From"] = self.email
-        msg["To"] = ",".join(recipients)
-        msg["Subject"] = subject
-        msg["Date"] = formatdate(localtime=True)
-        msg.attach(MIMEText(body, mimetype))
-
-        server = smtplib.SMTP(self.host, self.port)
-        server.starttls()
-        server.login(self.email, self.password)
-        server.send_message(msg)
-        server.quit()
-
-
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    """Azure function to send emails triggered by HTTP request."""
-    logging.info("Send email triggered via HTTP.")
-
-    email_parameters = parse_request(req)
-
-    sender_details = SenderDB(
-        conn_str=os.environ["AzureWebJobsStorage"],
-        share_name="email-app",
-        file_path="emails.json",
-    ).get_sender(str(email_parameters["user"]))
-
-    postman = EmailDeliverer(
-        host=str(sender_details["host"]),
-        port=int(sender_details["port"]),
-        email=str(sender_details["email"]),
-        password=str(sender_details["password"]),
-    )
-
-    postman.send_email(
-        recipients=list(email_parameters["recipients"]),
-        subject=str(email_parameters["subject"]),
-        body=str(email_parameters["body"]),
-        mimetype=str(email_parameters["mimetype"]),
-    )
-
-    return func.HttpResponse("{}")
+"""Send emails upon HTTP request.
+
+Depends on the presence of an appropiate Key Vault to store passwords and
+text file based DB stored in the storage account.
+
+A request can also deliver many messages from the same sender at once. Bulk
+requests carry the user and a JSON list of messages, each one with the same
+recipients, subject, body and mimetype fields as a single email request. All
+messages are sent over one SMTP session and the response reports the status
+of every message so that failures can be retried selectively.
+
+Requests with delivery set to "queued" are validated and put in the
+email-outbox queue instead of being sent right away. The response is then a
+202 with the id of the queued message, and the HttpEmailWorker function takes
+care of the delivery. Emails that don't fit in a queue message, 64 KiB once
+base64 encoded, are rejected with a 413.
+
+Messages can carry attachments stored in a File Share. The attachments
+parameter is a JSON list of dicts with the share_name and path of each file
+and, optionally, the filename and content_type to present it with. The files
+are streamed into the SMTP conversation, see streaming.py, and their total
+size is limited by the optional env variables:
+- ATTACHMENT_MAX_BYTES: Limit to the size of the attachments of a message.
+- ATTACHMENT_CHUNK_BYTES: Size of the ranges the files are downloaded in.
+
+An asyncio flavour of the entry point is available as main_async. Set
+"entryPoint": "main_async" in function.json to use it.
+
+Requires the following env variables:
+- KEY_VAULT_URI
+- AzureWebJobsStorage
+
+SMTP sessions are pooled across invocations. The pool can be tuned with the
+following optional env variables:
+- SMTP_POOL_SIZE: Maximum number of open sessions per sender account.
+- SMTP_POOL_IDLE_SECONDS: Seconds after which an unused session is closed.
+
+Author: Guillem Ballesteros
+"""
+
+import json
+import logging
+import os
+import smtplib
+import threading
+import time
+import uuid
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
+
+from __app__.HttpEmail import smtp_pool
+from __app__.HttpEmail import streaming
+from __app__.utilities import aio
+from __app__.utilities import clients
+from __app__.utilities import exceptions
+from __app__.utilities import keyvault
+from __app__.utilities import queues
+from __app__.utilities import schema
+
+import azure.functions as func
+
+
+class SenderDB:
+    """Setup our email accounts "DB", it is really just a JSON file.
+
+    The sender details are obtained from a text file stored in an Azure
+    File Share. To avoid having plain text password the text based DB stores
+    a reference to a Key vault Secret.
+
+    The connection to the Key Vault is established using the following
+    environment defined variables:
+    - AZURE_CLIENT_ID
+    - AZURE_CLIENT_SECRET
+    - AZURE_TENANT_ID
+    The client ID and client secret are specific to an App registered in your
+    active directory.
+
+    The KEY_VAULT_URI is also expected to be found on the environment
+    variables.
+
+    The DB is a JSON file with a list of dicts that include:
+    - user: The name which we will refer the account with in the requests.
+    - email: Email of the senders.
+    - host: Host for the SMTP server.
+    - port: Port to the SMTP server.
+    - keyvault_secret: The name of the secret stored in the KeyVault which has
+        the password for the account.
+    """
+
+    _instances: Dict[Tuple[str, str, str], "SenderDB"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(
+        self, conn_str: str, share_name: str, file_path: str, ttl: float = 300.0
+    ) -> None:
+        """Initialize the sender class.
+
+        Retrieves the DB from the file share and indexes it by user. All the
+        parameters of __init__ but ttl are there to retrieve the DB.
+
+        Parameters
+        ----------
+        conn_str
+            Connection strin to the storage account containing the DB. Every
+            Function App has an storage account associated with it. It's
+            connection strin is stored in the default env variable
+            AzureWebJobsStorage.
+        share_name
+            Name of the share where the DB is kept.
+        file_path
+            Path within the File Share to the DB.
+        ttl
+            Seconds after which a lookup triggers a background check of the
+            DB's ETag, reloading it if it changed.
+
+        Raise
+        -----
+        Raises a KeyError if a user is defined more than once since we would
+        have ambiguous details.
+        """
+        self.ttl = ttl
+        self._file_client = clients.get_file_client(
+            conn_str=conn_str, share_name=share_name, file_path=file_path,
+        )
+        self._refresh_lock = threading.Lock()
+
+        with exceptions.span("file_share.download"):
+            data = self._file_client.download_file()
+            self.email_db = json.loads(data.readall())
+        self._senders = self._index(self.email_db)
+        self._etag = data.properties.etag
+        self._loaded_at = time.monotonic()
+
+    @classmethod
+    def get_instance(
+        cls, conn_str: str, share_name: str, file_path: str
+    ) -> "SenderDB":
+        """Retrieve the process wide DB, loading it on first use.
+
+        The TTL is read from the optional SENDER_DB_TTL_SECONDS env variable.
+        When the DB is first loaded the passwords of all its senders are
+        prefetched from the Key Vault in the background.
+        """
+        key = (conn_str, share_name, file_path)
+        with cls._instances_lock:
+            exceptions.annotate(sender_db_cache_hit=key in cls._instances)
+            if key not in cls._instances:
+                sender_db = cls(
+                    conn_str,
+                    share_name,
+                    file_path,
+                    ttl=float(os.environ.get("SENDER_DB_TTL_SECONDS", 300)),
+                )
+                threading.Thread(
+                    target=sender_db.prefetch_secrets, daemon=True
+                ).start()
+                cls._instances[key] = sender_db
+
+            return cls._instances[key]
+
+    def prefetch_secrets(self) -> None:
+        """Warm up the secret cache with the passwords of every sender."""
+        keyvault.get_secret_provider(os.environ["KEY_VAULT_URI"]).prefetch(
+            str(x["keyvault_secret"]) for x in self.email_db
+        )
+
+    @staticmethod
+    def _index(
+        email_db: List[Dict[str, Union[str, int]]]
+    ) -> Dict[str, Dict[str, Union[str, int]]]:
+        senders: Dict[str, Dict[str, Union[str, int]]] = {}
+        for sender_details in email_db:
+            user = str(sender_details["user"])
+            if user in senders:
+                logging.info("More than one sender user in DB. Please fix.")
+                raise KeyError(f"Ambiguous sender {user} found in DB")
+            senders[user] = sender_details
+
+        return senders
+
+    def refresh(self) -> None:
+        """Reload the DB if its ETag changed since it was last loaded.
+
+        If the new version of the DB can't be loaded the current one is kept.
+        """
+        try:
+            if self._file_client.get_file_properties().etag != self._etag:
+                data = self._file_client.download_file()
+                email_db = json.loads(data.readall())
+                self._senders = self._index(email_db)
+                self.email_db = email_db
+                self._etag = data.properties.etag
+                logging.info("Sender DB reloaded.")
+            self._loaded_at = time.monotonic()
+        except Exception as e:
+            logging.info(f"Could not refresh the sender DB: {e}")
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh_if_expired(self) -> None:
+        if time.monotonic() - self._loaded_at < self.ttl:
+            return
+        # Only one refresh at a time, concurrent lookups keep the current DB.
+        if self._refresh_lock.acquire(blocking=False):
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def get_sender(self, user: str) -> Dict[str, Union[str, int]]:
+        """Retrieve the details for a user from the DB.
+
+        Lookups are served from the in memory index. Once the TTL has expired
+        the DB is refreshed in the background while the current version keeps
+        serving requests.
+
+        Passwords are retrieved from a KeyVault through the process wide
+        secret cache.
+
+        Parameters
+        ----------
+        user
+            User associated with the email account used to deliver the email.
+        """
+        sender_details = self._lookup(user)
+        secret = keyvault.get_secret_provider(os.environ["KEY_VAULT_URI"]).get(
+            str(sender_details["keyvault_secret"])
+        )
+        sender_details["password"] = secret
+
+        return sender_details
+
+    async def get_sender_async(self, user: str) -> Dict[str, Union[str, int]]:
+        """Counterpart of get_sender using the aio Key Vault client."""
+        sender_details = self._lookup(user)
+        secret = await keyvault.get_secret_provider(
+            os.environ["KEY_VAULT_URI"]
+        ).get_async(str(sender_details["keyvault_secret"]))
+        sender_details["password"] = secret
+
+        return sender_details
+
+    def _lookup(self, user: str) -> Dict[str, Union[str, int]]:
+        self._refresh_if_expired()
+
+        if user not in self._senders:
+            logging.info("Sender user not found in DB.")
+            raise KeyError("Sender not found in DB.")
+
+        return dict(self._senders[user])
+
+
+MESSAGE_FIELDS = [
+    schema.Field("recipients", required=True, coerce=schema.comma_separated),
+    schema.Field("subject", default=""),
+    schema.Field("body", default=""),
+    schema.Field("mimetype", default="plain"),
+    schema.Field("attachments", default=[], coerce=streaming.attachment_list),
+]
+EMAIL_FIELDS = [schema.Field("user", required=True, coerce=str)] + MESSAGE_FIELDS
+BULK_FIELDS = [
+    schema.Field("user", required=True, coerce=str),
+    schema.Field("messages", required=True, coerce=schema.json_list),
+]
+
+
+def parse_request(
+    req: Union[func.HttpRequest, Mapping[str, Any]]
+) -> Dict[str, Union[str, List[str]]]:
+    """Extract all the relevant parameters from the incoming request.
+
+    The parameters extracted are:
+    - user (mandatory)
+    - subject (optional default:empty)
+    - recipients (mandatory): Comma separated list of recipiients.
+    - body (optional default: empty)
+    - mimetype (optional default: plain)
+    - attachments (optional default: none): List of File Share files.
+    """
+    email_parameters = schema.parse(req, EMAIL_FIELDS)
+    logging.info(f"The incoming parameters are: {email_parameters}")
+
+    return email_parameters
+
+
+def parse_bulk_request(
+    req: Union[func.HttpRequest, Mapping[str, Any]]
+) -> Dict[str, Any]:
+    """Extract the sender and the list of messages from a bulk request.
+
+    The parameters extracted are:
+    - user (mandatory)
+    - messages (mandatory): List of dicts with the following keys
+        - recipients (mandatory): List or comma separated list of recipients.
+        - subject (optional default:empty)
+        - body (optional default: empty)
+        - mimetype (optional default: plain)
+        - attachments (optional default: none)
+    """
+    bulk_parameters = schema.parse(req, BULK_FIELDS)
+    bulk_parameters["messages"] = [
+        schema.parse(message, MESSAGE_FIELDS, f"message {index}")
+        for index, message in enumerate(bulk_parameters["messages"])
+    ]
+
+    return bulk_parameters
+
+
+OUTBOX_QUEUE = "email-outbox"
+DEAD_LETTER_QUEUE = "email-outbox-deadletter"
+
+_smtp_pool = smtp_pool.SMTPSessionPool(
+    max_size=int(os.environ.get("SMTP_POOL_SIZE", 4)),
+    idle_timeout=float(os.environ.get("SMTP_POOL_IDLE_SECONDS", 60)),
+)
+
+
+class EmailDeliverer:
+    """Configure and deliver emails."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        email: str,
+        password: str,
+        pool: smtp_pool.SMTPSessionPool = _smtp_pool,
+    ) -> None:
+        """Init email deliverer.
+
+        Parameters
+        ----------
+        host
+            Host for SMTP server.
+        port
+            SMTP port
+        email
+            Email messages are being delivered from.
+        password
+            Password to the email account.
+        pool
+            Pool the SMTP sessions are borrowed from.
+        """
+        self.host = host
+        self.port = port
+        self.password = password
+        self.email = email
+        self.pool = pool
+
+    @classmethod
+    def for_sender(
+        cls,
+        sender_details: Dict[str, Union[str, int]],
+        pool: smtp_pool.SMTPSessionPool = _smtp_pool,
+    ) -> "EmailDeliverer":
+        """Build the deliverer of a sender as returned by SenderDB.get_sender."""
+        return cls(
+            host=str(sender_details["host"]),
+            port=int(sender_details["port"]),
+            email=str(sender_details["email"]),
+            password=str(sender_details["password"]),
+            pool=pool,
+        )
+
+    def build_message(
+        self, recipients: List[str], subject: str, body: str, mimetype: str
+    ) -> MIMEMultipart:
+        """Assemble an email with a single attached message."""
+        msg = MIMEMultipart()
+        msg["From"] = self.email
+        msg["To"] = ",".join(recipients)
+        msg["Subject"] = subject
+        msg["Date"] = formatdate(localtime=True)
+        msg.attach(MIMEText(body, mimetype))
+
+        return msg
+
+    def _send(
+        self,
+        server: smtplib.SMTP,
+        msg: MIMEMultipart,
+        recipients: List[str],
+        attachments: List[streaming.Attachment],
+    ) -> Dict[str, Any]:
+        with exceptions.span("smtp.send"):
+            if not attachments:
+                return server.send_message(msg)
+            return streaming.send_streamed(
+                server,
+                self.email,
+                recipients,
+                streaming.message_stream(msg, attachments),
+            )
+
+    def send_email(
+        self,
+        recipients: List[str],
+        subject: str,
+        body: str,
+        mimetype: str,
+        attachments: Optional[List[Dict[str, Any]]] = None,
+    ) -> None:
+        """Send email.
+
+        The body is attached to the email as a single message, followed by
+        the attachments if any.
+
+        Parameters
+        ----------
+        recipients
+            List of emails who are going to receive the email.
+        subject
+            Subject line of the email.
+        body
+            Text body of the email.
+        mimetype
+            MIME type for the attached message
+        attachments
+            References to File Share files as returned by
+            streaming.attachment_list.
+        """
+        msg = self.build_message(recipients, subject, body, mimetype)
+        exceptions.annotate(body_chars=len(body), recipients=len(recipients))
+        files = streaming.open_attachments(attachments) if attachments else []
+
+        # A pooled session may have been dropped by the server since its
+        # health check. In that case it is retried once on a new session.
+        for attempt in range(2):
+            try:
+                with self.pool.session(
+                    self.host, self.port, self.email, self.password
+                ) as server:
+                    self._send(server, msg, recipients, files)
+                return
+            except smtplib.SMTPServerDisconnected:
+                if attempt:
+                    raise
+                logging.info("SMTP session was disconnected. Reconnecting.")
+
+    def send_emails(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Send many emails over a single SMTP session.
+
+        A failing message does not stop the delivery of the rest. If the
+        session is dropped it is reopened and the delivery resumes from the
+        message that was interrupted, unless that same message is interrupted
+        twice in which case it and the rest are marked as failed. A message
+        whose attachments can't be read while it is sent is marked as failed
+        and the delivery resumes from the next one on a new session. If a
+        session can't be opened, e.g. the server refuses the connection, the
+        current and remaining messages are marked as failed.
+
+        Parameters
+        ----------
+        messages
+            List of dicts with the recipients, subject, body and mimetype of
+            each email as returned by parse_bulk_request.
+
+        Returns
+        -------
+        One status dict per message in the same order. The status is one of:
+        - accepted: The server took the message. Recipients refused by the
+            server are listed under refused.
+        - refused: The server refused all the recipients.
+        - failed: The server replied with an error, see smtp_code and error.
+        """
+        statuses: List[Dict[str, Any]] = []
+        interrupted_at = None
+
+        while len(statuses) < len(messages):
+            try:
+                with self.pool.session(
+                    self.host, self.port, self.email, self.password
+                ) as server:
+                    for message in messages[len(statuses) :]:
+                        statuses.append(self.deliver(server, message))
+            except streaming.AttachmentError as e:
+                # The session was discarded by the pool, it is mid DATA.
+                logging.info(f"Attachment failed while sending: {e}")
+                statuses.append(
+                    {"status": "failed", "smtp_code": None, "error": str(e)}
+                )
+            except smtplib.SMTPServerDisconnected as e:
+                if interrupted_at == len(statuses):
+                    statuses.extend(
+                        {"status": "failed", "smtp_code": None, "error": str(e)}
+                        for _ in messages[len(statuses) :]
+                    )
+                else:
+                    logging.info("SMTP session was disconnected. Reconnecting.")
+                    interrupted_at = len(statuses)
+            except (smtplib.SMTPException, OSError) as e:
+                # The statuses of the messages already sent are still returned.
+                logging.info(f"SMTP session failed: {e}")
+                statuses.extend(
+                    {"status": "failed", "smtp_code": None, "error": str(e)}
+                    for _ in messages[len(statuses) :]
+                )
+
+        return [dict(status, index=i) for i, status in enumerate(statuses)]
+
+    def deliver(
+        self, server: smtplib.SMTP, message: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Send one message over a session borrowed from the pool.
+
+        Failures reported by the server are returned as the status of the
+        message, see send_emails, and the session can keep being used.
+
+        Parameters
+        ----------
+        server
+            Session as handed out by pool.session.
+        message
+            Dict with the recipients, subject, body, mimetype and optionally
+            the attachments of the email.
+
+        Raise
+        -----
+        Raises smtplib.SMTPServerDisconnected if the session is dropped and
+        streaming.AttachmentError if an attachment can't be read while sent.
+        In both cases the session can't be used anymore.
+        """
+        msg = self.build_message(
+            message["recipients"],
+            message["subject"],
+            message["body"],
+            message["mimetype"],
+        )
+        try:
+            files = streaming.open_attachments(message.get("attachments") or [])
+        except exceptions.HttpError as e:
+            return {"status": "failed", "smtp_code": None, "error": str(e)}
+
+        try:
+            refused = self._send(server, msg, message["recipients"], files)
+        except smtplib.SMTPRecipientsRefused as e:
+            return {"status": "refused", "refused": _format_refused(e.recipients)}
+        except smtplib.SMTPResponseException as e:
+            return {
+                "status": "failed",
+                "smtp_code": e.smtp_code,
+                "error": _decode(e.smtp_error),
+            }
+
+        return {"status": "accepted", "refused": _format_refused(refused)}
+
+
+def _decode(smtp_error: Union[bytes, str]) -> str:
+    if isinstance(smtp_error, bytes):
+        return smtp_error.decode("utf-8", "replace")
+    return smtp_error
+
+
+def _format_refused(refused: Dict[str, Any]) -> Dict[str, Any]:
+    return {rcpt: [code, _decode(error)] for rcpt, (code, error) in refused.items()}
+
+
+def get_sender_db() -> SenderDB:
+    """Retrieve the process wide sender DB of the storage account."""
+    return SenderDB.get_instance(
+        conn_str=os.environ["AzureWebJobsStorage"],
+        share_name="email-app",
+        file_path="emails.json",
+    )
+
+
+def send_request(
+    sender_details: Dict[str, Union[str, int]],
+    email_parameters: Dict[str, Union[str, List[str]]],
+) -> func.HttpResponse:
+    """Send the email of a single email request.
+
+    Parameters
+    ----------
+    sender_details
+        Sender as returned by SenderDB.get_sender.
+    email_parameters
+        Parameters of the email as returned by parse_request.
+    """
+    postman = EmailDeliverer.for_sender(sender_details)
+    postman.send_email(
+        recipients=list(email_parameters["recipients"]),
+        subject=str(email_parameters["subject"]),
+        body=str(email_parameters["body"]),
+        mimetype=str(email_parameters["mimetype"]),
+        attachments=email_parameters["attachments"],
+    )
+
+    return func.HttpResponse("{}")
+
+
+def send_bulk_request(
+    sender_details: Dict[str, Union[str, int]], messages: List[Dict[str, Any]]
+) -> func.HttpResponse:
+    """Send the messages of a bulk request and report the status of each one.
+
+    Parameters
+    ----------
+    sender_details
+        Sender as returned by SenderDB.get_sender.
+    messages
+        Messages as returned by parse_bulk_request.
+    """
+    logging.info(f"Bulk delivery of {len(messages)} emails.")
+    statuses = EmailDeliverer.for_sender(sender_details).send_emails(messages)
+
+    return func.HttpResponse(json.dumps({"results": statuses}))
+
+
+@exceptions.exceptions_as_response
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    """Azure function to send emails triggered by HTTP request."""
+    logging.info("Send email triggered via HTTP.")
+
+    params = schema.request_params(req)
+    if params.get("messages") is not None:
+        return bulk_main(params)
+
+    email_parameters = parse_request(params)
+
+    if params.get("delivery") == "queued":
+        return enqueue(email_parameters)
+
+    sender_details = get_sender_db().get_sender(str(email_parameters["user"]))
+
+    return send_request(sender_details, email_parameters)
+
+
+def bulk_main(req: Union[func.HttpRequest, Mapping[str, Any]]) -> func.HttpResponse:
+    """Send all the messages of a bulk request from one sender."""
+    bulk_parameters = parse_bulk_request(req)
+    sender_details = get_sender_db().get_sender(str(bulk_parameters["user"]))
+
+    return send_bulk_request(sender_details, bulk_parameters["messages"])
+
+
+def enqueue(email_parameters: Dict[str, Union[str, List[str]]]) -> func.HttpResponse:
+    """Put an email in the outbox queue for HttpEmailWorker to deliver.
+
+    Parameters
+    ----------
+    email_parameters
+        Parameters of the email as returned by parse_request.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError with a 413 status if the email doesn't fit
+    in a queue message.
+    """
+    message_id = uuid.uuid4().hex
+    content = json.dumps(
+        {"message_id": message_id, "attempt": 0, "email": email_parameters}
+    )
+    if queues.encoded_size(content) > queues.MAX_MESSAGE_BYTES:
+        msg = (
+            f"Queued emails are limited to {queues.MAX_MESSAGE_BYTES} bytes once "
+            "encoded. Send it right away or attach large content from a share."
+        )
+        raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=413))
+
+    with exceptions.span("queue.send"):
+        queues.get_queue(OUTBOX_QUEUE).send(content)
+    logging.info(f"Email queued with id {message_id}.")
+
+    return func.HttpResponse(json.dumps({"message_id": message_id}), status_code=202)
+
+
+@exceptions.exceptions_as_response_async
+async def main_async(req: func.HttpRequest) -> func.HttpResponse:
+    """Counterpart of main that does not block the worker on Key Vault.
+
+    The password of the sender is retrieved with the aio Key Vault client.
+    smtplib and the Storage Queue client have no asyncio flavour here, so
+    the delivery or enqueueing runs in the default executor on a pooled
+    session.
+    """
+    logging.info("Send email triggered via HTTP.")
+
+    params = schema.request_params(req)
+    if params.get("messages") is not None:
+        return await bulk_main_async(params)
+
+    email_parameters = parse_request(params)
+
+    if params.get("delivery") == "queued":
+        return await aio.run_blocking(enqueue, email_parameters)
+
+    sender_db = await aio.run_blocking(get_sender_db)
+    sender_details = await sender_db.get_sender_async(str(email_parameters["user"]))
+
+    return await aio.run_blocking(send_request, sender_details, email_parameters)
+
+
+async def bulk_main_async(
+    req: Union[func.HttpRequest, Mapping[str, Any]]
+) -> func.HttpResponse:
+    """Counterpart of bulk_main for the asyncio entry point."""
+    bulk_parameters = parse_bulk_request(req)
+    sender_db = await aio.run_blocking(get_sender_db)
+    sender_details = await sender_db.get_sender_async(str(bulk_parameters["user"]))
+
+    return await aio.run_blocking(
+        send_bulk_request, sender_details, bulk_parameters["messages"]
+    )
@@ -0,0 +1,162 @@
+"""Pool of authenticated SMTP sessions.
+
+Opening an SMTP session costs a TCP connect, a TLS handshake and a LOGIN
+before the first message can be sent. The pool keeps those sessions open
+between invocations of a warm worker so that they can be reused.
+"""
+import logging
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from __app__.utilities import exceptions
+
+SessionKey = Tuple[str, int, str]
+
+
+class SMTPSessionPool:
+    """Thread safe pool of SMTP sessions keyed by (host, port, email).
+
+    At most max_size sessions are open for each key. When all of them are in
+    use further requests wait for one to be released. Idle sessions are
+    closed once idle_timeout seconds have passed and the rest are checked
+    with a NOOP before being handed out again.
+    """
+
+    def __init__(
+        self, max_size: int = 4, idle_timeout: float = 60.0, timeout: float = 30.0
+    ) -> None:
+        """Init the pool.
+
+        Parameters
+        ----------
+        max_size
+            Maximum number of open sessions per (host, port, email).
+        idle_timeout
+            Seconds after which an unused session is closed instead of reused.
+        timeout
+            Socket timeout for the SMTP connections.
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle: Dict[SessionKey, List[Tuple[smtplib.SMTP, float]]] = {}
+        self._slots: Dict[SessionKey, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _connect(
+        self, host: str, port: int, email: str, password: str
+    ) -> smtplib.SMTP:
+        with exceptions.span("smtp.connect"):
+            server = smtplib.SMTP(host, port, timeout=self.timeout)
+        try:
+            with exceptions.span("smtp.starttls"):
+                server.starttls()
+            with exceptions.span("smtp.login"):
+                server.login(email, password)
+        except Exception:
+            server.close()
+            raise
+
+        return server
+
+    @staticmethod
+    def _quit(server: smtplib.SMTP) -> None:
+        """Close a session that is idle between commands with a QUIT."""
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    @staticmethod
+    def _is_alive(server: smtplib.SMTP) -> bool:
+        try:
+            return server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _reuse(self, key: SessionKey) -> Optional[smtplib.SMTP]:
+        """Pop a healthy idle session, closing the stale ones found on the way.
+
+        Returns None if no idle session could be reused.
+        """
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    return None
+                server, released_at = idle.pop()
+
+            if time.monotonic() - released_at >= self.idle_timeout:
+                self._quit(server)
+            elif self._is_alive(server):
+                return server
+            else:
+                server.close()
+
+    @contextmanager
+    def session(
+        self, host: str, port: int, email: str, password: str
+    ) -> Iterator[smtplib.SMTP]:
+        """Borrow an authenticated session from the pool.
+
+        The session goes back to the pool when the block exits. If the block
+        raises SMTPServerDisconnected, or any other error that does not come
+        from a regular reply of a working server, it is discarded instead.
+        Discarded sessions are closed without a QUIT since they may be in the
+        middle of a command, e.g. the DATA of a message.
+
+        Parameters
+        ----------
+        host
+            Host for SMTP server.
+        port
+            SMTP port
+        email
+            Email account the session is authenticated as.
+        password
+            Password to the email account.
+        """
+        key = (host, port, email)
+        with self._lock:
+            slots = self._slots.setdefault(
+                key, threading.BoundedSemaphore(self.max_size)
+            )
+
+        with exceptions.span("smtp.wait_for_slot"):
+            slots.acquire()
+        try:
+            with exceptions.span("smtp.health_check"):
+                server = self._reuse(key)
+            exceptions.annotate(smtp_session_reused=server is not None)
+            if server is None:
+                logging.info(f"Opening new SMTP session to {host}:{port}.")
+                server = self._connect(host, port, email, password)
+
+            try:
+                yield server
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                self._release(key, server)
+                raise
+            except BaseException:
+                server.close()
+                raise
+            else:
+                self._release(key, server)
+        finally:
+            slots.release()
+
+    def _release(self, key: SessionKey, server: smtplib.SMTP) -> None:
+        with self._lock:
+            self._idle.setdefault(key, []).append((server, time.monotonic()))
+
+    def close_all(self) -> None:
+        """Close every idle session. Sessions in use are not affected."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for sessions in idle.values():
+            for server, _ in sessions:
+                self._quit(server)
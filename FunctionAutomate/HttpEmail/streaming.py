@@ -0,0 +1,289 @@
+"""Attachments streamed from an Azure File Share into the SMTP DATA command.
+
+smtplib.SMTP.send_message flattens the whole message before sending it, so an
+attachment would be held in memory twice, once as read from the share and
+once base64 encoded. Here the attachments are instead downloaded in ranges of
+chunk_size bytes, base64 encoded range by range and written to the SMTP
+socket as they come. The memory used by a message does not depend on the size
+of its attachments.
+"""
+import base64
+import email.policy
+import mimetypes
+import os
+import re
+import smtplib
+import uuid
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from __app__.utilities import clients
+from __app__.utilities import exceptions
+from __app__.utilities import schema
+
+import azure.functions as func
+from azure.core.exceptions import AzureError, ResourceNotFoundError
+
+ATTACHMENT_FIELDS = [
+    schema.Field("share_name", required=True, coerce=str),
+    schema.Field("path", required=True, coerce=str),
+    schema.Field("filename", coerce=str),
+    schema.Field("content_type", coerce=str),
+]
+
+# Bytes encoded into each 76 characters long base64 line (RFC 2045).
+LINE_BYTES = 57
+
+
+class AttachmentError(Exception):
+    """An attachment could not be read while its message was being sent.
+
+    The SMTP session is left in the middle of the DATA command so it can't be
+    used for further messages.
+    """
+
+
+def attachment_list(value: Any) -> List[Dict[str, Any]]:
+    """Coerce the attachments parameter into a list of attachment references.
+
+    Each reference is a dict with the share_name and path of the file and,
+    optionally, the filename and content_type to present it with.
+    """
+    return [
+        schema.parse(reference, ATTACHMENT_FIELDS, f"attachment {index}")
+        for index, reference in enumerate(schema.json_list(value))
+    ]
+
+
+class Attachment:
+    """File in a File Share that is read in chunks when sent."""
+
+    def __init__(
+        self,
+        file_client: Any,
+        filename: str,
+        content_type: str,
+        size: int,
+        chunk_size: int,
+    ) -> None:
+        self.file_client = file_client
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def chunks(self) -> Iterator[bytes]:
+        """Download the file one range at a time.
+
+        Raise
+        -----
+        Raises an IOError if the file changes while it is being read.
+        """
+        offset = 0
+        etag = None
+        while offset < self.size:
+            with exceptions.span("file_share.download"):
+                data = self.file_client.download_file(
+                    offset=offset, length=min(self.chunk_size, self.size - offset)
+                )
+                chunk = data.readall()
+
+            if etag is None:
+                etag = data.properties.etag
+            if data.properties.etag != etag or not chunk:
+                raise IOError(f"Attachment {self.filename} changed while sent")
+
+            offset += len(chunk)
+            yield chunk
+
+
+def open_attachments(
+    references: List[Dict[str, Any]],
+    max_bytes: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+) -> List[Attachment]:
+    """Check that the attachments of a message exist and fit in the limit.
+
+    Nothing is downloaded yet, only the properties of the files are fetched.
+
+    Parameters
+    ----------
+    references
+        Attachments as returned by attachment_list.
+    max_bytes
+        Limit to the total size of the attachments. By default the optional
+        ATTACHMENT_MAX_BYTES env variable or 10 MiB.
+    chunk_size
+        Size of the ranges the files are downloaded in. By default the
+        optional ATTACHMENT_CHUNK_BYTES env variable or 1 MiB.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError if an attachment is not found or if the
+    attachments are larger than max_bytes.
+    """
+    if max_bytes is None:
+        max_bytes = int(os.environ.get("ATTACHMENT_MAX_BYTES", 10 * 2 ** 20))
+    if chunk_size is None:
+        chunk_size = int(os.environ.get("ATTACHMENT_CHUNK_BYTES", 2 ** 20))
+
+    attachments = []
+    total = 0
+    for reference in references:
+        file_client = clients.get_file_client(
+            conn_str=os.environ["AzureWebJobsStorage"],
+            share_name=reference["share_name"],
+            file_path=reference["path"],
+        )
+        try:
+            with exceptions.span("file_share.properties"):
+                properties = file_client.get_file_properties()
+        except ResourceNotFoundError:
+            msg = f"Attachment {reference['share_name']}/{reference['path']} not found"
+            raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=500))
+
+        total += properties.size
+        if total > max_bytes:
+            msg = f"Attachments are larger than the limit of {max_bytes} bytes"
+            raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=413))
+
+        filename = reference["filename"] or os.path.basename(reference["path"])
+        content_type = (
+            reference["content_type"]
+            or mimetypes.guess_type(filename)[0]
+            or "application/octet-stream"
+        )
+        attachments.append(
+            Attachment(file_client, filename, content_type, properties.size, chunk_size)
+        )
+
+    exceptions.annotate(attachment_bytes=total)
+    return attachments
+
+
+def base64_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Base64 encode a stream of bytes into CRLF terminated lines.
+
+    Chunks are cut at multiples of LINE_BYTES so that the lines are the same
+    as if the whole stream had been encoded at once.
+    """
+    remainder = b""
+    for chunk in chunks:
+        data = remainder + chunk
+        cut = len(data) - len(data) % LINE_BYTES
+        remainder = data[cut:]
+        if cut:
+            yield base64.encodebytes(data[:cut]).replace(b"\n", b"\r\n")
+
+    if remainder:
+        yield base64.encodebytes(remainder).replace(b"\n", b"\r\n")
+
+
+def _quote_periods(data: bytes) -> bytes:
+    # Lines starting with a period must be doubled within DATA (RFC 5321).
+    return re.sub(rb"(?m)^\.", b"..", data)
+
+
+def message_stream(
+    msg: MIMEMultipart, attachments: List[Attachment]
+) -> Iterator[bytes]:
+    """Serialize msg with the attachments appended as extra parts.
+
+    The output uses CRLF line endings and is dot stuffed, ready to be written
+    after the DATA command. Base64 lines never start with a period so only
+    the headers and the text parts need to be stuffed.
+    """
+    boundary = f"=============== {uuid.uuid4().hex} =="
+    msg.set_boundary(boundary)
+    head = msg.as_bytes(policy=email.policy.SMTP)
+    closing = f"--{boundary}--".encode()
+    yield _quote_periods(head[: head.rindex(closing)])
+
+    for attachment in attachments:
+        maintype, _, subtype = attachment.content_type.partition("/")
+        part = MIMEBase(maintype, subtype or "octet-stream")
+        part.add_header(
+            "Content-Disposition", "attachment", filename=attachment.filename
+        )
+        part["Content-Transfer-Encoding"] = "base64"
+        yield f"--{boundary}\r\n".encode()
+        yield _quote_periods(part.as_bytes(policy=email.policy.SMTP))
+        yield from base64_lines(attachment.chunks())
+
+    yield closing + b"\r\n"
+
+
+def _reset(server: smtplib.SMTP) -> None:
+    try:
+        server.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+def send_streamed(
+    server: smtplib.SMTP,
+    from_addr: str,
+    to_addrs: List[str],
+    data: Iterable[bytes],
+) -> Dict[str, Tuple[int, bytes]]:
+    """Counterpart of smtplib.SMTP.sendmail writing data as it is produced.
+
+    Parameters
+    ----------
+    server
+        Authenticated SMTP session.
+    from_addr
+        Address of the sender.
+    to_addrs
+        Addresses of the recipients.
+    data
+        Chunks of the message as produced by message_stream.
+
+    Returns
+    -------
+    The recipients refused by the server, like sendmail.
+
+    Raise
+    -----
+    Raises the same exceptions as sendmail. If an attachment can't be read
+    while data is written an AttachmentError is raised, and the session is
+    left in the middle of the DATA command and must be closed.
+    """
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(from_addr)
+    if code != 250:
+        _reset(server)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    refused = {}
+    for addr in to_addrs:
+        code, resp = server.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        _reset(server)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, resp = server.docmd("data")
+    if code != 354:
+        _reset(server)
+        raise smtplib.SMTPDataError(code, resp)
+
+    try:
+        for chunk in data:
+            server.send(chunk)
+    except smtplib.SMTPException:
+        raise
+    except (OSError, AzureError) as e:
+        # Socket errors are raised as SMTPServerDisconnected by server.send,
+        # so these come from the File Share.
+        raise AttachmentError(str(e)) from e
+    server.send(b".\r\n")
+
+    code, resp = server.getreply()
+    if code != 250:
+        _reset(server)
+        raise smtplib.SMTPDataError(code, resp)
+
+    return refused
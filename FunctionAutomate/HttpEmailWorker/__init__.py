@@ -0,0 +1,164 @@
+"""Deliver the emails queued by HttpEmail and the chunks queued by MailMerge.
+
+Triggered by the email-outbox queue. Failed deliveries are put back in the
+queue with an exponential backoff and, once they run out of attempts or hit
+a permanent error, e.g. a 5XX SMTP reply or an unknown sender, moved to the
+email-outbox-deadletter queue. The records of a mail merge chunk that is dead
+lettered are reported as failed in the progress of its job.
+
+The number of concurrent deliveries to the same SMTP host is bounded to avoid
+being throttled by the mail server.
+
+Optional env variables:
+- EMAIL_WORKER_HOST_CONCURRENCY: Concurrent deliveries per SMTP host.
+- EMAIL_WORKER_MAX_ATTEMPTS: Delivery attempts before dead lettering.
+- EMAIL_WORKER_BACKOFF_SECONDS: Delay before the first retry. It doubles on
+    every further attempt.
+- EMAIL_WORKER_MAX_BACKOFF_SECONDS: Upper bound for the retry delay.
+"""
+import json
+import logging
+import os
+import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from __app__.HttpEmail import (
+    DEAD_LETTER_QUEUE,
+    OUTBOX_QUEUE,
+    EmailDeliverer,
+    get_sender_db,
+)
+from __app__.MailMerge import fail_chunk, send_chunk
+from __app__.utilities import exceptions
+from __app__.utilities import queues
+
+import azure.functions as func
+
+_host_slots: Dict[str, threading.BoundedSemaphore] = {}
+_host_slots_lock = threading.Lock()
+
+
+def host_slot(host: str) -> threading.BoundedSemaphore:
+    """Semaphore bounding the concurrent deliveries to an SMTP host."""
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(
+                int(os.environ.get("EMAIL_WORKER_HOST_CONCURRENCY", 2))
+            )
+
+        return _host_slots[host]
+
+
+def retry_delay(attempt: int) -> int:
+    """Seconds to wait before retrying a delivery that failed attempt times."""
+    base = int(os.environ.get("EMAIL_WORKER_BACKOFF_SECONDS", 30))
+    max_backoff = int(os.environ.get("EMAIL_WORKER_MAX_BACKOFF_SECONDS", 3600))
+
+    return min(base * 2 ** (attempt - 1), max_backoff)
+
+
+def deliver_queued(content: str) -> bool:
+    """Deliver a queued email or mail merge chunk, scheduling a retry if it fails.
+
+    Parameters
+    ----------
+    content
+        Body of the queue message as written by HttpEmail.enqueue or
+        MailMerge.enqueue_job.
+
+    Returns
+    -------
+    Whether the email or chunk was delivered.
+    """
+    envelope = json.loads(content)
+    if "merge" in envelope:
+        return _retry_on_failure(envelope, send_chunk)
+
+    return _retry_on_failure(envelope, _deliver_email)
+
+
+def _deliver_email(envelope: Dict[str, Any]) -> None:
+    email_parameters = envelope["email"]
+    sender_details = get_sender_db().get_sender(str(email_parameters["user"]))
+    postman = EmailDeliverer.for_sender(sender_details)
+
+    with host_slot(postman.host):
+        postman.send_email(
+            recipients=list(email_parameters["recipients"]),
+            subject=str(email_parameters["subject"]),
+            body=str(email_parameters["body"]),
+            mimetype=str(email_parameters["mimetype"]),
+            attachments=email_parameters.get("attachments"),
+        )
+
+
+def _retry_on_failure(
+    envelope: Dict[str, Any], deliver: Callable[[Dict[str, Any]], None]
+) -> bool:
+    try:
+        deliver(envelope)
+    except Exception as e:
+        attempt = envelope["attempt"] + 1
+        envelope = dict(envelope, attempt=attempt, error=str(e)[:1000])
+        max_attempts = int(os.environ.get("EMAIL_WORKER_MAX_ATTEMPTS", 5))
+        # 5XX replies, missing or oversized attachments and senders that are
+        # not in the DB are permanent failures, retrying them is pointless.
+        is_permanent = (
+            (isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500)
+            or isinstance(e, smtplib.SMTPRecipientsRefused)
+            or isinstance(e, exceptions.HttpError)
+            or isinstance(e, KeyError)
+        )
+
+        if is_permanent or attempt >= max_attempts:
+            logging.info(f"Email {envelope['message_id']} dead lettered: {e}")
+            queues.get_queue(DEAD_LETTER_QUEUE).send(json.dumps(envelope))
+            if "merge" in envelope:
+                fail_chunk(envelope, e)
+        else:
+            logging.info(f"Email {envelope['message_id']} will be retried: {e}")
+            queues.get_queue(OUTBOX_QUEUE).send(
+                json.dumps(envelope), visibility_timeout=retry_delay(attempt)
+            )
+        return False
+
+    logging.info(f"Email {envelope['message_id']} delivered.")
+    return True
+
+
+def drain(queue_name: str = OUTBOX_QUEUE, max_workers: int = 8) -> int:
+    """Deliver every message currently visible in the outbox queue.
+
+    Does outside of Azure what the queue trigger does in it, e.g. when running
+    against the local queue stand-in.
+
+    Parameters
+    ----------
+    queue_name
+        Name of the queue to drain.
+    max_workers
+        Number of messages processed concurrently.
+
+    Returns
+    -------
+    Number of messages processed.
+    """
+    queue = queues.get_queue(queue_name)
+    processed = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            messages = queue.receive(max_messages=max_workers * 4)
+            if not messages:
+                return processed
+
+            list(executor.map(deliver_queued, [x.content for x in messages]))
+            for message in messages:
+                queue.delete(message)
+            processed += len(messages)
+
+
+def main(msg: func.QueueMessage) -> None:
+    deliver_queued(msg.get_body().decode("utf-8"))
@@ -0,0 +1,803 @@
+"""Render and send a personalized email to every recipient of a campaign.
+
+Replaces a call to EmailCompose and another to HttpEmail per recipient. A
+POST request references a template, a sender user and the recipient records:
+- user: Sender user as found in the sender DB of HttpEmail.
+- template_file and share_name: Jinja2 template of the body, loaded through
+    the template cache of EmailCompose.
+- subject (optional default: empty): Jinja2 template of the subject line.
+    It is repeated in every chunk, so together with the other parameters
+    it may take MAX_SETTINGS_BYTES at most.
+- mimetype (optional default: html)
+- recipients: JSON list of records. Alternatively recipients_file, a dict
+    with the share_name and path of a newline delimited JSON file of records
+    which is streamed from the File Share in chunks.
+- connections (optional): Number of parallel SMTP sessions.
+
+Every record is a JSON object with the email of the recipient and is passed
+as is to the templates.
+
+A campaign can take far longer than an HTTP invocation is allowed to run, so
+the request only splits the records into chunks and puts them in the
+email-outbox queue. The response is a 202 with the job_id. HttpEmailWorker
+renders and sends each chunk, with the same retries as queued emails, and
+records its outcome in the MailMergeJobs table, which must exist in the
+storage account. A chunk that is retried after some of its emails were sent
+sends them again.
+
+A GET request with the job_id reports the progress of the job: its state,
+the number of records and chunks and how many records were accepted, refused
+or failed so far. With chunk set as well, it lists the records of that chunk
+that were not accepted or had recipients refused, with the same status
+fields as the bulk requests of HttpEmail.
+
+Within a chunk, records are rendered by the worker's thread and handed to
+the sender threads through a bounded queue, so rendering and delivery
+overlap while memory stays bounded. The deliveries to an SMTP host are
+throttled process wide by a token bucket.
+
+Optional env variables:
+- MAIL_MERGE_CONNECTIONS: Default number of parallel SMTP sessions.
+- MAIL_MERGE_MAX_CONNECTIONS: Upper bound for the connections parameter.
+- MAIL_MERGE_CHUNK_RECORDS: Records per chunk, at most MAX_CHUNK_RECORDS.
+- MAIL_MERGE_QUEUE_SIZE: Rendered messages waiting to be sent at most.
+- MAIL_MERGE_HOST_RATE: Messages per second sent to an SMTP host. 0 lifts
+    the limit.
+- MAIL_MERGE_MAX_RECONNECTS: Consecutive reconnections a sender thread
+    attempts before giving up.
+- MAIL_MERGE_RECONNECT_BACKOFF_SECONDS: Delay before the first reconnection.
+    It doubles on every further one.
+"""
+import json
+import logging
+import os
+import queue
+import re
+import smtplib
+import threading
+import time
+import uuid
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from __app__.EmailCompose import get_template
+from __app__.HttpEmail import (
+    OUTBOX_QUEUE,
+    EmailDeliverer,
+    get_sender_db,
+    smtp_pool,
+    streaming,
+)
+from __app__.utilities import clients
+from __app__.utilities import exceptions
+from __app__.utilities import queues
+from __app__.utilities import schema
+from __app__.utilities import throttling
+from __app__.utilities import utilities
+
+import azure.functions as func
+from azure.common import AzureMissingResourceHttpError
+
+from jinja2 import Template
+
+RECIPIENTS_FILE_FIELDS = [
+    schema.Field("share_name", required=True, coerce=str),
+    schema.Field("path", required=True, coerce=str),
+]
+
+
+def recipients_file(value: Any) -> Dict[str, Any]:
+    """Coerce the recipients_file parameter into a File Share reference."""
+    return schema.parse(value, RECIPIENTS_FILE_FIELDS, "recipients_file")
+
+
+MERGE_FIELDS = [
+    schema.Field("user", required=True, coerce=str),
+    schema.Field("template_file", required=True, coerce=str),
+    schema.Field("share_name", required=True, coerce=str),
+    schema.Field("subject", default="", coerce=str),
+    schema.Field("mimetype", default="html", coerce=str),
+    schema.Field("recipients", coerce=schema.json_list),
+    schema.Field("recipients_file", coerce=recipients_file),
+    schema.Field("connections", coerce=int),
+]
+PROGRESS_FIELDS = [
+    schema.Field("job_id", required=True, coerce=str),
+    schema.Field("chunk", coerce=int),
+]
+
+JOBS_TABLE = "MailMergeJobs"
+JOB_ROW = "job"
+MAX_CONNECTIONS = int(os.environ.get("MAIL_MERGE_MAX_CONNECTIONS", 8))
+# Keeps the outcomes of a chunk within the size of a Table property.
+MAX_CHUNK_RECORDS = 100
+# Room left in a queue message for the ids of a chunk in its envelope and
+# the error added to it when it is retried. The settings of the merge are
+# measured for each job.
+ENVELOPE_BYTES = 4096
+# The settings, mostly the subject template, can take this much of a chunk.
+MAX_SETTINGS_BYTES = 16 * 1024
+MAX_ERROR_CHARS = 200
+
+_JOB_ID_PATTERN = re.compile("[0-9a-f]{32}")
+
+# The merge keeps its own sessions so that a campaign does not starve the
+# single emails sent by HttpEmail on the same worker.
+_smtp_pool = smtp_pool.SMTPSessionPool(
+    max_size=MAX_CONNECTIONS,
+    idle_timeout=float(os.environ.get("SMTP_POOL_IDLE_SECONDS", 60)),
+)
+
+_host_limiters: Dict[str, throttling.RateLimiter] = {}
+_host_limiters_lock = threading.Lock()
+
+
+def host_limiter(host: str) -> throttling.RateLimiter:
+    """Token bucket throttling the messages sent to an SMTP host."""
+    with _host_limiters_lock:
+        if host not in _host_limiters:
+            rate = float(os.environ.get("MAIL_MERGE_HOST_RATE", 20))
+            _host_limiters[host] = throttling.RateLimiter(rate, burst=rate)
+
+        return _host_limiters[host]
+
+
+class Job(NamedTuple):
+    index: int
+    message: Dict[str, Any]
+
+
+INVALID_RECORD = "Record must be a JSON object with an email"
+RECORD_TOO_LARGE = "Record does not fit in a queue message"
+
+
+def read_records(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """Decode newline delimited JSON records from a stream of bytes.
+
+    Lines that are not valid JSON are yielded as None so that they are
+    reported in the position they were found at.
+    """
+    remainder = b""
+    for chunk in chunks:
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield _decode_record(line)
+
+    if remainder.strip():
+        yield _decode_record(remainder)
+
+
+def _decode_record(line: bytes) -> Any:
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def stream_recipients_file(share_name: str, path: str) -> Iterator[Any]:
+    """Read the records of a recipients file in chunks."""
+    file_client = clients.get_file_client(
+        conn_str=os.environ["AzureWebJobsStorage"],
+        share_name=share_name,
+        file_path=path,
+    )
+    with exceptions.span("file_share.properties"):
+        size = file_client.get_file_properties().size
+    chunk_size = int(os.environ.get("ATTACHMENT_CHUNK_BYTES", 2 ** 20))
+    records_file = streaming.Attachment(
+        file_client, path, "application/x-ndjson", size, chunk_size
+    )
+
+    return read_records(records_file.chunks())
+
+
+class Chunk(NamedTuple):
+    start: int
+    records: List[Any]
+    # Positions within the chunk of the records left out for being too large.
+    oversized: List[int]
+
+
+def chunk_records(
+    records: Iterable[Any], max_records: int, max_bytes: int
+) -> Iterator[Chunk]:
+    """Group the records in chunks that fit in a queue message.
+
+    Parameters
+    ----------
+    records
+        Recipient records.
+    max_records
+        Records per chunk at most.
+    max_bytes
+        Size of the JSON encoded records of a chunk at most.
+    """
+    chunk = Chunk(0, [], [])
+    size = 0
+    for index, record in enumerate(records):
+        record_size = len(json.dumps(record).encode("utf-8")) + 2
+        is_oversized = record_size > max_bytes
+        if is_oversized:
+            record, record_size = None, 0
+
+        if chunk.records and (
+            len(chunk.records) == max_records or size + record_size > max_bytes
+        ):
+            yield chunk
+            chunk = Chunk(index, [], [])
+            size = 0
+
+        if is_oversized:
+            chunk.oversized.append(index - chunk.start)
+        chunk.records.append(record)
+        size += record_size
+
+    if chunk.records:
+        yield chunk
+
+
+class MergeReport:
+    """Thread safe tally of the outcome of every record."""
+
+    def __init__(self) -> None:
+        self.outcomes: Dict[int, Dict[str, Any]] = {}
+        self.counts: Dict[str, int] = {}
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, index: int, outcome: Dict[str, Any]) -> None:
+        with self._lock:
+            self.outcomes[index] = dict(outcome, index=index)
+            status = outcome["status"]
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "total": len(self.outcomes),
+                "seconds": round(time.monotonic() - self.started_at, 3),
+                **self.counts,
+                "results": [self.outcomes[i] for i in sorted(self.outcomes)],
+            }
+
+
+def render_messages(
+    body_template: Template,
+    subject_template: Template,
+    mimetype: str,
+    records: Iterable[Tuple[int, Any]],
+    report: MergeReport,
+) -> Iterator[Job]:
+    """Render the email of every record.
+
+    Records that are invalid or fail to render are reported straight away
+    instead of being yielded.
+
+    Parameters
+    ----------
+    records
+        Pairs of the index of each record within the job and the record.
+    """
+    for index, record in records:
+        if not isinstance(record, dict) or not record.get("email"):
+            report.record(index, {"status": "failed", "error": INVALID_RECORD})
+            continue
+
+        try:
+            with exceptions.span("render"):
+                message = {
+                    "recipients": [str(record["email"])],
+                    "subject": subject_template.render(record),
+                    "body": body_template.render(record),
+                    "mimetype": mimetype,
+                }
+        except Exception as e:
+            report.record(
+                index, {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+            )
+            continue
+
+        yield Job(index, message)
+
+
+def _failed(error: Exception) -> Dict[str, Any]:
+    return {"status": "failed", "smtp_code": None, "error": str(error)}
+
+
+class Senders:
+    """Threads delivering the rendered messages over parallel SMTP sessions.
+
+    Each thread keeps one session open for as long as it works. A message
+    interrupted by a dropped session is retried once on a new session. A
+    thread reconnects with an exponential backoff and gives up after
+    max_reconnects reconnections without delivering a message, or as soon as
+    a session can't be opened for any other reason. The last thread standing
+    reports the remaining messages as failed so that the queue never stalls.
+    """
+
+    def __init__(
+        self,
+        postman: EmailDeliverer,
+        connections: int,
+        queue_size: int,
+        limiter: throttling.RateLimiter,
+        report: MergeReport,
+        max_reconnects: int = 3,
+        backoff: float = 1.0,
+    ) -> None:
+        self.postman = postman
+        self.limiter = limiter
+        self.report = report
+        self.max_reconnects = max_reconnects
+        self.backoff = backoff
+        # The queue is bounded by a semaphore rather than by its maxsize so
+        # that the end of the job can always be signaled without blocking.
+        self.jobs: "queue.Queue[Optional[Job]]" = queue.Queue()
+        self._free_slots = threading.Semaphore(queue_size)
+        self._alive = connections
+        self._alive_lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True)
+            for _ in range(connections)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, job: Job) -> None:
+        """Queue a message, waiting while the queue is full."""
+        self._free_slots.acquire()
+        self.jobs.put(job)
+
+    def join(self) -> None:
+        """Wait for every queued message to be delivered."""
+        for _ in self._threads:
+            self.jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _next(self) -> Optional[Job]:
+        """Take the next message, None once all of them have been taken."""
+        job = self.jobs.get()
+        if job is not None:
+            self._free_slots.release()
+
+        return job
+
+    def _run(self) -> None:
+        postman = self.postman
+        pending: Optional[Job] = None
+        interrupted = False
+        reconnects = 0
+        while True:
+            try:
+                with postman.pool.session(
+                    postman.host, postman.port, postman.email, postman.password
+                ) as server:
+                    while True:
+                        pending = pending or self._next()
+                        if pending is None:
+                            return
+                        self.limiter.acquire()
+                        outcome = postman.deliver(server, pending.message)
+                        self.report.record(pending.index, outcome)
+                        pending, interrupted, reconnects = None, False, 0
+            except smtplib.SMTPServerDisconnected as e:
+                if pending is not None and interrupted:
+                    self.report.record(pending.index, _failed(e))
+                    pending = None
+                interrupted = pending is not None
+                reconnects += 1
+                if reconnects > self.max_reconnects:
+                    logging.info(f"Mail merge sender gave up reconnecting: {e}")
+                    self._stop(pending, e)
+                    return
+                time.sleep(self.backoff * 2 ** (reconnects - 1))
+            except Exception as e:
+                logging.info(f"Mail merge sender stopped: {e}")
+                self._stop(pending, e)
+                return
+
+    def _stop(self, pending: Optional[Job], error: Exception) -> None:
+        if pending is not None:
+            self.report.record(pending.index, _failed(error))
+
+        with self._alive_lock:
+            self._alive -= 1
+            is_last = self._alive == 0
+        if not is_last:
+            return
+
+        job = self._next()
+        while job is not None:
+            self.report.record(job.index, _failed(error))
+            job = self._next()
+
+
+def merge(
+    postman: EmailDeliverer,
+    body_template: Template,
+    subject_template: Template,
+    mimetype: str,
+    records: Iterable[Tuple[int, Any]],
+    connections: int,
+    report: Optional[MergeReport] = None,
+) -> Dict[str, Any]:
+    """Render and send the email of every record.
+
+    Parameters
+    ----------
+    postman
+        Deliverer of the sender account.
+    body_template
+        Template of the body of the emails.
+    subject_template
+        Template of the subject line of the emails.
+    mimetype
+        MIME type of the rendered body.
+    records
+        Pairs of the index of each record within the job and the record.
+    connections
+        Number of parallel SMTP sessions.
+    report
+        Report the outcomes are added to. A new one by default.
+
+    Returns
+    -------
+    The summary of the job as returned by MergeReport.summary.
+    """
+    report = report or MergeReport()
+    senders = Senders(
+        postman,
+        connections,
+        queue_size=int(os.environ.get("MAIL_MERGE_QUEUE_SIZE", 100)),
+        limiter=host_limiter(postman.host),
+        report=report,
+        max_reconnects=int(os.environ.get("MAIL_MERGE_MAX_RECONNECTS", 3)),
+        backoff=float(os.environ.get("MAIL_MERGE_RECONNECT_BACKOFF_SECONDS", 1)),
+    )
+    try:
+        for job in render_messages(
+            body_template, subject_template, mimetype, records, report
+        ):
+            senders.put(job)
+    finally:
+        senders.join()
+
+    return report.summary()
+
+
+def _jobs_table() -> Any:
+    return utilities.setup_table_service(
+        os.environ["AzureWebJobsStorage"], JOBS_TABLE
+    )
+
+
+def _chunk_row(chunk: int) -> str:
+    return f"chunk-{chunk:06d}"
+
+
+def enqueue_job(params: Dict[str, Any], records: Iterable[Any]) -> Dict[str, Any]:
+    """Split the records of a merge in chunks and queue them.
+
+    Parameters
+    ----------
+    params
+        Parameters of the request as parsed with MERGE_FIELDS.
+    records
+        Recipient records.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError if the settings of the merge, e.g. its
+    subject, are too large to be repeated in every chunk.
+
+    Returns
+    -------
+    The job_id along with the number of records and chunks queued.
+    """
+    settings = {
+        name: params[name]
+        for name in [
+            "user",
+            "template_file",
+            "share_name",
+            "subject",
+            "mimetype",
+            "connections",
+        ]
+    }
+    settings_bytes = len(json.dumps(settings).encode("utf-8"))
+    if settings_bytes > MAX_SETTINGS_BYTES:
+        msg = (
+            f"The subject and settings of the merge take {settings_bytes} bytes, "
+            f"more than the {MAX_SETTINGS_BYTES} allowed."
+        )
+        raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=400))
+
+    job_id = uuid.uuid4().hex
+    table_service = _jobs_table()
+    with exceptions.span("table.insert"):
+        table_service.insert_entity(
+            JOBS_TABLE,
+            {
+                "PartitionKey": job_id,
+                "RowKey": JOB_ROW,
+                "state": "enqueueing",
+                "user": params["user"],
+                "template_file": params["template_file"],
+            },
+        )
+
+    max_records = min(
+        int(os.environ.get("MAIL_MERGE_CHUNK_RECORDS", MAX_CHUNK_RECORDS)),
+        MAX_CHUNK_RECORDS,
+    )
+    # Queue messages are base64 encoded, which takes 4 bytes for every 3.
+    max_bytes = queues.MAX_MESSAGE_BYTES * 3 // 4 - ENVELOPE_BYTES - settings_bytes
+    outbox = queues.get_queue(OUTBOX_QUEUE)
+    total = 0
+    chunks = 0
+    try:
+        for chunk in chunk_records(records, max_records, max_bytes):
+            envelope = {
+                "message_id": f"{job_id}-{chunks}",
+                "attempt": 0,
+                "merge": dict(
+                    settings, job_id=job_id, chunk=chunks, start=chunk.start
+                ),
+                "records": chunk.records,
+                "oversized": chunk.oversized,
+            }
+            with exceptions.span("queue.send"):
+                outbox.send(json.dumps(envelope))
+            total += len(chunk.records)
+            chunks += 1
+    except Exception as e:
+        table_service.merge_entity(
+            JOBS_TABLE,
+            {
+                "PartitionKey": job_id,
+                "RowKey": JOB_ROW,
+                "state": "aborted",
+                "error": str(e)[:MAX_ERROR_CHARS],
+                "total": total,
+                "chunks": chunks,
+            },
+        )
+        raise
+
+    with exceptions.span("table.update"):
+        table_service.merge_entity(
+            JOBS_TABLE,
+            {
+                "PartitionKey": job_id,
+                "RowKey": JOB_ROW,
+                "state": "enqueued",
+                "total": total,
+                "chunks": chunks,
+            },
+        )
+    exceptions.annotate(records=total, chunks=chunks)
+
+    return {"job_id": job_id, "total": total, "chunks": chunks}
+
+
+def _notable(outcome: Dict[str, Any]) -> bool:
+    return outcome["status"] != "accepted" or bool(outcome.get("refused"))
+
+
+def save_chunk(merge_settings: Dict[str, Any], report: MergeReport) -> None:
+    """Record the outcome of a chunk in the jobs table.
+
+    Only the outcomes of the records that were not accepted, or had
+    recipients refused, are kept. Error messages are truncated so that they
+    fit in a Table property.
+    """
+    summary = report.summary()
+    results = [
+        dict(x, error=x["error"][:MAX_ERROR_CHARS]) if x.get("error") else x
+        for x in summary["results"]
+        if _notable(x)
+    ]
+    with exceptions.span("table.update"):
+        _jobs_table().insert_or_replace_entity(
+            JOBS_TABLE,
+            {
+                "PartitionKey": merge_settings["job_id"],
+                "RowKey": _chunk_row(merge_settings["chunk"]),
+                "start": merge_settings["start"],
+                "total": summary["total"],
+                "accepted": summary.get("accepted", 0),
+                "refused": summary.get("refused", 0),
+                "failed": summary.get("failed", 0),
+                "results": json.dumps(results),
+            },
+        )
+
+
+def _indexed(
+    envelope: Dict[str, Any], report: MergeReport
+) -> Iterator[Tuple[int, Any]]:
+    start = envelope["merge"]["start"]
+    oversized = set(envelope["oversized"])
+    for position, record in enumerate(envelope["records"]):
+        if position in oversized:
+            report.record(
+                start + position, {"status": "failed", "error": RECORD_TOO_LARGE}
+            )
+        else:
+            yield start + position, record
+
+
+def send_chunk(envelope: Dict[str, Any]) -> None:
+    """Render and send the records of a queued chunk and record the outcome.
+
+    Called by HttpEmailWorker for the chunks queued by enqueue_job.
+
+    Raise
+    -----
+    Raises the errors that prevent the chunk from being sent at all, e.g. a
+    template or sender that can't be loaded, so that the chunk is retried.
+    """
+    settings = envelope["merge"]
+    body_template = get_template(
+        conn_str=os.environ["AzureWebJobsStorage"],
+        share_name=settings["share_name"],
+        template_path=settings["template_file"],
+    )
+    subject_template = body_template.environment.from_string(settings["subject"])
+
+    sender_details = get_sender_db().get_sender(settings["user"])
+    postman = EmailDeliverer.for_sender(sender_details, pool=_smtp_pool)
+
+    connections = settings["connections"] or int(
+        os.environ.get("MAIL_MERGE_CONNECTIONS", 4)
+    )
+    report = MergeReport()
+    summary = merge(
+        postman,
+        body_template,
+        subject_template,
+        settings["mimetype"],
+        _indexed(envelope, report),
+        max(1, min(connections, MAX_CONNECTIONS)),
+        report,
+    )
+    save_chunk(settings, report)
+    logging.info(
+        f"Mail merge {settings['job_id']} chunk {settings['chunk']}: "
+        f"{summary['total']} records in {summary['seconds']}s."
+    )
+
+
+def fail_chunk(envelope: Dict[str, Any], error: Exception) -> None:
+    """Record every record of a chunk that ran out of attempts as failed."""
+    report = MergeReport()
+    start = envelope["merge"]["start"]
+    for position in range(len(envelope["records"])):
+        report.record(start + position, _failed(error))
+    save_chunk(envelope["merge"], report)
+
+
+def _unknown_job() -> exceptions.HttpError:
+    msg = "Unknown job_id."
+    return exceptions.HttpError(msg, func.HttpResponse(msg, status_code=500))
+
+
+def job_progress(job_id: str) -> Dict[str, Any]:
+    """Add up the outcomes of the chunks of a job processed so far.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError if the job does not exist.
+    """
+    if not _JOB_ID_PATTERN.fullmatch(job_id):
+        raise _unknown_job()
+
+    table_service = _jobs_table()
+    progress: Dict[str, Any] = {
+        "chunks_done": 0,
+        "accepted": 0,
+        "refused": 0,
+        "failed": 0,
+    }
+    job = None
+    # Without num_results the SDK follows the continuation tokens itself.
+    with exceptions.span("table.query"):
+        entities = list(
+            table_service.query_entities(
+                JOBS_TABLE,
+                filter=f"PartitionKey eq '{job_id}'",
+                select="RowKey,state,total,chunks,error,accepted,refused,failed",
+            )
+        )
+    for entity in entities:
+        if entity["RowKey"] == JOB_ROW:
+            job = entity
+            continue
+        progress["chunks_done"] += 1
+        for status in ["accepted", "refused", "failed"]:
+            progress[status] += entity[status]
+
+    if job is None:
+        raise _unknown_job()
+
+    state = job["state"]
+    if state == "enqueued" and progress["chunks_done"] == job["chunks"]:
+        state = "done"
+
+    return {
+        "job_id": job_id,
+        "state": state,
+        "total": job.get("total"),
+        "chunks": job.get("chunks"),
+        "error": job.get("error"),
+        **progress,
+    }
+
+
+def chunk_results(job_id: str, chunk: int) -> Dict[str, Any]:
+    """Outcomes of the records of a chunk that were not cleanly accepted.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError if the chunk has not been processed yet.
+    """
+    if not _JOB_ID_PATTERN.fullmatch(job_id) or chunk < 0:
+        raise _unknown_job()
+
+    try:
+        with exceptions.span("table.get"):
+            entity = _jobs_table().get_entity(JOBS_TABLE, job_id, _chunk_row(chunk))
+    except AzureMissingResourceHttpError:
+        msg = f"Chunk {chunk} of the job has not been processed yet."
+        raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=500))
+
+    return {
+        "job_id": job_id,
+        "chunk": chunk,
+        "start": entity["start"],
+        "total": entity["total"],
+        "results": json.loads(entity["results"]),
+    }
+
+
+@exceptions.exceptions_as_response
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    if req.method == "GET":
+        params = schema.parse(req, PROGRESS_FIELDS)
+        if params["chunk"] is None:
+            progress = job_progress(params["job_id"])
+        else:
+            progress = chunk_results(params["job_id"], params["chunk"])
+        return func.HttpResponse(json.dumps(progress), mimetype="application/json")
+
+    params = schema.parse(req, MERGE_FIELDS)
+    if (params["recipients"] is None) == (params["recipients_file"] is None):
+        msg = "Exactly one of recipients and recipients_file is required."
+        raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=500))
+
+    if params["recipients"] is not None:
+        records: Iterable[Any] = params["recipients"]
+    else:
+        records = stream_recipients_file(**params["recipients_file"])
+
+    job = enqueue_job(params, records)
+    logging.info(
+        f"Mail merge {job['job_id']} queued with {job['total']} records "
+        f"in {job['chunks']} chunks."
+    )
+
+    return func.HttpResponse(
+        json.dumps(job), status_code=202, mimetype="application/json"
+    )
@@ -1,99 +1,258 @@
-"""Generate an Azure table entry that can be used to start an ADF pipeline.
-
-This function is used in conjunction with PipelineRestart which read the token
-parameter from its incoming request to find the table entry that has the details
-about the ADF pipeline that needs to be started.
-
-The incoming request to this function must contain the following parameters:
-- data: Contains contextual information for the restarted pipeline.
-- resource_group: Resource group where the ADF is located.
-- factory_name: Name of the ADF.
-- pipeline_name: Name of pipeline that needs to be triggered on restart.
-- expiration_time: Number of seconds until expiration of the restart parameters.
-- web_path:
-- share_name:
-
-Author: Guillem Ballesteros
-"""
-import json
-import os
-import secrets
-from typing import Any, Dict, Union
-
-from __app__.utilities import exceptions
-from __app__.utilities import utilities
-
-import azure.functions as func
-from azure.cosmosdb.table.models import Entity
-
-def get_pipeline_params(req: func.HttpRequest) -> Dict[str, Union[int, str]]:
-    pipeline_params = {
-        k: utilities.get_param(req, k)
-        for k in ["factory_name", "resource_group", "pipeline_name", "expiration_time"]
-    }
-
-    # All pipeline parameters are mandatory
-    if None in [pipeline_params[k] for k in pipeline_params]:
-        msg = (
-            "One of ['resource_group', 'factory_name', 'pipeline_name', 'expiration_time'] was not found.",
-        )
-        raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=500))
-
-    return pipeline_params
-
-
-def get_notification_web_params(req: func.HttpRequest) -> Dict[str, str]:
-    web_params = {k: utilities.get_param(req, k) for k in ["web_path", "share_name"]}
-
-    # All web parameters are mandatory
-    if None in [web_params[k] for k in web_params]:
-        msg = ("One of ['web_path', 'share_name'] was not found.",)
-        raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=500))
-
-    return web_params
-
-
-def prepare_pipeline_data(
-    partition_key: str,
-    token: str,
-    pipeline_params: Dict[str, Union[int, str]],
-    notification_web_params: Dict[str, str],
-    data: Any,
-) -> Entity:
-    pipeline_data = Entity()
-    pipeline_data.PartitionKey = partition_key
-    pipeline_data.RowKey = token
-    pipeline_data.factory_name = pipeline_params["factory_name"]
-    pipeline_data.resource_group = pipeline_params["resource_group"]
-    pipeline_data.pipeline_name = pipeline_params["pipeline_name"]
-    pipeline_data.expiration_time = pipeline_params["expiration_time"]
-    pipeline_data.data = json.dumps(data)
-    pipeline_data.acted_upon = (
-        0  # to be marked as read (1) once the pipeline has restarted
-    )
-    pipeline_data.web_path = notification_web_params["web_path"]
-    pipeline_data.share_name = notification_web_params["share_name"]
-
-    return pipeline_data
-
-
-@exceptions.exceptions_as_response
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    partition_key = "PauseData"
-    target_table = "PipelinePauseData"
-    table_service = utilities.setup_table_service(
-        os.environ["AzureWebJobsStorage"], target_table,
-    )
-
-    # Gather all the data we need for the table entry
-    data = utilities.get_param(req, "data")
-    pipeline_params = get_pipeline_params(req)
-    notification_web_params = get_notification_web_params(req)
-    token = secrets.token_urlsafe(64)
-
-    pipeline_data = prepare_pipeline_data(
-        partition_key, token, pipeline_params, notification_web_params, data
-    )
-    table_service.insert_entity(target_table, pipeline_data)
-
-    return func.HttpResponse(json.dumps({"token": token}))
+"""Generate an Azure table entry that can be used to start an ADF pipeline.
+
+This function is used in conjunction with PipelineRestart which read the token
+parameter from its incoming request to find the table entry that has the details
+about the ADF pipeline that needs to be started.
+
+The incoming request to this function must contain the following parameters:
+- data: Contains contextual information for the restarted pipeline.
+- resource_group: Resource group where the ADF is located.
+- factory_name: Name of the ADF.
+- pipeline_name: Name of pipeline that needs to be triggered on restart.
+- expiration_time: Number of seconds until expiration of the restart parameters.
+- web_path:
+- share_name:
+
+Entities are spread over several partitions of the table, see
+utilities.pausedata for the details. Large data payloads are compressed and,
+if needed, offloaded to a File Share as described there too.
+
+Alternatively the request can carry a JSON list named pauses where each item
+has all the parameters above. One token is generated per item and the tokens
+are returned in the same order. The entries are written in batch
+transactions and entries that can't be written are reported individually.
+
+An asyncio flavour of the entry point is available as main_async. Set
+"entryPoint": "main_async" in function.json to use it.
+
+Author: Guillem Ballesteros
+"""
+import json
+import logging
+import os
+from itertools import groupby
+from typing import Any, Dict, List, Mapping, Optional, Union
+
+from __app__.utilities import aio
+from __app__.utilities import exceptions
+from __app__.utilities import pausedata
+from __app__.utilities import schema
+from __app__.utilities import utilities
+
+import azure.functions as func
+from azure.cosmosdb.table.models import Entity
+from azure.cosmosdb.table.tablebatch import TableBatch
+from azure.cosmosdb.table.tableservice import TableService
+
+# Maximum number of operations in a Table batch transaction.
+MAX_BATCH_SIZE = 100
+
+PIPELINE_FIELDS = [
+    schema.Field("factory_name", required=True),
+    schema.Field("resource_group", required=True),
+    schema.Field("pipeline_name", required=True),
+    schema.Field("expiration_time", required=True, coerce=int),
+]
+NOTIFICATION_WEB_FIELDS = [
+    schema.Field("web_path", required=True),
+    schema.Field("share_name", required=True),
+]
+PAUSE_FIELDS = PIPELINE_FIELDS + NOTIFICATION_WEB_FIELDS + [schema.Field("data")]
+
+
+def get_pause_params(
+    source: Union[func.HttpRequest, Mapping[str, Any]], context: str = ""
+) -> Dict[str, Any]:
+    """Extract and validate the parameters of a single pause.
+
+    All the pipeline and notification web parameters are mandatory.
+    """
+    return schema.parse(source, PAUSE_FIELDS, context)
+
+
+def prepare_pipeline_data(
+    partition_key: str,
+    token: str,
+    pipeline_params: Dict[str, Union[int, str]],
+    notification_web_params: Dict[str, str],
+    data: Any,
+) -> Entity:
+    pipeline_data = Entity()
+    pipeline_data.PartitionKey = partition_key
+    pipeline_data.RowKey = token
+    pipeline_data.factory_name = pipeline_params["factory_name"]
+    pipeline_data.resource_group = pipeline_params["resource_group"]
+    pipeline_data.pipeline_name = pipeline_params["pipeline_name"]
+    pipeline_data.expiration_time = pipeline_params["expiration_time"]
+    pipeline_data.expires_at = pausedata.expires_at(
+        pipeline_params["expiration_time"]
+    )
+    pipeline_data.update(pausedata.encode_data(token, data))
+    pipeline_data.acted_upon = (
+        0  # to be marked as read (1) once the pipeline has restarted
+    )
+    pipeline_data.web_path = notification_web_params["web_path"]
+    pipeline_data.share_name = notification_web_params["share_name"]
+
+    return pipeline_data
+
+
+def get_pause_specs(
+    source: Union[func.HttpRequest, Mapping[str, Any]]
+) -> List[Dict[str, Any]]:
+    """Extract and validate the list of pauses of a batch request."""
+    pauses = schema.parse(
+        source, [schema.Field("pauses", required=True, coerce=schema.json_list)]
+    )["pauses"]
+
+    return [
+        get_pause_params(spec, f"pause {index}") for index, spec in enumerate(pauses)
+    ]
+
+
+def insert_batch(
+    table_service: TableService, target_table: str, entities: List[Entity]
+) -> List[Optional[str]]:
+    """Insert entities using batch transactions.
+
+    Batches are limited to MAX_BATCH_SIZE entities of the same partition. A
+    batch transaction fails as a whole so, if one does, its entities are
+    inserted one by one to find out which ones can't be written.
+
+    Parameters
+    ----------
+    table_service
+        Table service for the storage account.
+    target_table
+        Name of the table to insert to.
+    entities
+        Entities to insert.
+
+    Returns
+    -------
+    For each entity None if it was inserted or the error message otherwise.
+    """
+    errors: List[Optional[str]] = [None] * len(entities)
+    by_partition = sorted(
+        range(len(entities)), key=lambda i: entities[i].PartitionKey
+    )
+
+    for _, group in groupby(by_partition, key=lambda i: entities[i].PartitionKey):
+        indices = list(group)
+        for start in range(0, len(indices), MAX_BATCH_SIZE):
+            chunk = indices[start : start + MAX_BATCH_SIZE]
+            batch = TableBatch()
+            for i in chunk:
+                batch.insert_entity(entities[i])
+
+            try:
+                with exceptions.span("table.batch"):
+                    table_service.commit_batch(target_table, batch)
+            except Exception as e:
+                logging.info(f"Batch insert failed, inserting one by one: {e}")
+                for i in chunk:
+                    try:
+                        table_service.insert_entity(target_table, entities[i])
+                    except Exception as entity_error:
+                        errors[i] = str(entity_error)
+
+    return errors
+
+
+def batch_main(
+    req: Union[func.HttpRequest, Mapping[str, Any]]
+) -> func.HttpResponse:
+    """Generate the table entries for all the pauses of a batch request."""
+    target_table = pausedata.TARGET_TABLE
+    pause_specs = get_pause_specs(req)
+    table_service = utilities.setup_table_service(
+        os.environ["AzureWebJobsStorage"], target_table,
+    )
+
+    tokens = [pausedata.new_token() for _ in pause_specs]
+    entities = []
+    try:
+        for token, spec in zip(tokens, pause_specs):
+            entities.append(
+                prepare_pipeline_data(
+                    pausedata.partition_key(token), token, spec, spec, spec["data"]
+                )
+            )
+    except Exception:
+        # The data already offloaded for the earlier pauses would be orphaned.
+        for entity in entities:
+            pausedata.delete_offloaded_data(entity)
+        raise
+    exceptions.annotate(pauses=len(entities))
+    errors = insert_batch(table_service, target_table, entities)
+    # The data of the pauses that were not written would never be cleaned up.
+    for entity, error in zip(entities, errors):
+        if error:
+            pausedata.delete_offloaded_data(entity)
+
+    return func.HttpResponse(
+        json.dumps(
+            {
+                "tokens": [
+                    None if error else token for token, error in zip(tokens, errors)
+                ],
+                "errors": [
+                    {"index": index, "error": error}
+                    for index, error in enumerate(errors)
+                    if error
+                ],
+            }
+        )
+    )
+
+
+def pause_main(params: Mapping[str, Any]) -> func.HttpResponse:
+    """Generate the table entries for the pauses of a request.
+
+    Parameters
+    ----------
+    params
+        Parameters of the request, see schema.request_params.
+    """
+    if params.get("pauses") is not None:
+        return batch_main(params)
+
+    # Gather all the data we need for the table entry before touching storage
+    pause_params = get_pause_params(params)
+
+    target_table = pausedata.TARGET_TABLE
+    table_service = utilities.setup_table_service(
+        os.environ["AzureWebJobsStorage"], target_table,
+    )
+    token = pausedata.new_token()
+
+    pipeline_data = prepare_pipeline_data(
+        pausedata.partition_key(token),
+        token,
+        pause_params,
+        pause_params,
+        pause_params["data"],
+    )
+    try:
+        with exceptions.span("table.insert"):
+            table_service.insert_entity(target_table, pipeline_data)
+    except Exception:
+        pausedata.delete_offloaded_data(pipeline_data)
+        raise
+
+    return func.HttpResponse(json.dumps({"token": token}))
+
+
+@exceptions.exceptions_as_response
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    return pause_main(schema.request_params(req))
+
+
+@exceptions.exceptions_as_response_async
+async def main_async(req: func.HttpRequest) -> func.HttpResponse:
+    """Counterpart of main for the asyncio entry point.
+
+    The Table storage SDK has no asyncio flavour so the request is handled in
+    the default executor, see pause_main.
+    """
+    return await aio.run_blocking(pause_main, schema.request_params(req))
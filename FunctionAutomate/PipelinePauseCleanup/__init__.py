@@ -0,0 +1,260 @@
+"""Delete expired and consumed pause tokens from the PipelinePauseData table.
+
+Rows in the table are never deleted by PipelinePause or PipelineRestart.
+This timer triggered function streams the table page by page, selects the
+rows that were already acted upon or have expired and deletes them in batch
+transactions, one per partition. Payloads offloaded to a File Share by
+PipelinePause are deleted along with their rows.
+
+Only rows untouched for longer than a grace period are deleted, so consumed
+tokens can still be inspected for a while. The function is throttled to
+leave room for the live traffic on the table.
+
+A run stops once its time budget is spent, well before the function times
+out. The continuation marker of the table scan is then saved to the
+PAUSE_DATA_SHARE File Share and the next run resumes from it. Once a scan
+reaches the end of the table the marker is removed and the next run starts
+over from the beginning.
+
+Optional env variables:
+- PAUSE_CLEANUP_GRACE_SECONDS: Retention grace period. Defaults to a week.
+- PAUSE_CLEANUP_MAX_OPS_PER_SECOND: Maximum number of rows read plus deleted
+    per second.
+- PAUSE_CLEANUP_TIME_BUDGET_SECONDS: Seconds a run may spend scanning the
+    table. Defaults to 4 minutes, below the 5 minutes timeout of the
+    Consumption plan.
+"""
+import datetime
+import json
+import logging
+import os
+import time
+from itertools import groupby
+from typing import Any, Dict, List, Optional
+
+from __app__.utilities import clients
+from __app__.utilities import pausedata
+from __app__.utilities import throttling
+from __app__.utilities import utilities
+
+import azure.functions as func
+from azure.common import AzureMissingResourceHttpError
+from azure.core.exceptions import ResourceNotFoundError
+from azure.cosmosdb.table.tablebatch import TableBatch
+from azure.cosmosdb.table.tableservice import TableService
+
+import pytz
+
+# Maximum number of operations in a Table batch transaction.
+MAX_BATCH_SIZE = 100
+
+CLEANUP_PROPERTIES = [
+    "PartitionKey",
+    "RowKey",
+    "Timestamp",
+    "expiration_time",
+    "acted_upon",
+    "data_encoding",
+    "data_ref",
+]
+
+# Name of the file holding the continuation marker in the PAUSE_DATA_SHARE.
+MARKER_FILE = "cleanup-marker.json"
+
+
+def is_garbage(entity: Any, grace_period: float) -> bool:
+    """Check if a row can be deleted.
+
+    Parameters
+    ----------
+    entity
+        Row of the PipelinePauseData table.
+    grace_period
+        Seconds a row is kept for after it expired or was acted upon.
+    """
+    if entity.get("acted_upon") == 1:
+        return pausedata.check_if_expired(entity["Timestamp"], int(grace_period))
+
+    return pausedata.check_if_expired(
+        entity["Timestamp"], int(entity["expiration_time"]) + int(grace_period)
+    )
+
+
+def delete_entities(
+    table_service: TableService,
+    entities: List[Any],
+    rate_limiter: throttling.RateLimiter,
+) -> List[Any]:
+    """Delete entities in batch transactions of the same partition.
+
+    If a batch fails, e.g. because one of its rows was already deleted, its
+    rows are deleted one by one instead. Rows that still can't be deleted are
+    left for the next run.
+
+    Returns
+    -------
+    Entities whose row was deleted.
+    """
+    deleted = []
+    entities = sorted(entities, key=lambda x: x["PartitionKey"])
+
+    for partition_key, group in groupby(entities, key=lambda x: x["PartitionKey"]):
+        rows = list(group)
+        for start in range(0, len(rows), MAX_BATCH_SIZE):
+            chunk = rows[start : start + MAX_BATCH_SIZE]
+            rate_limiter.acquire(len(chunk))
+
+            batch = TableBatch()
+            for entity in chunk:
+                batch.delete_entity(partition_key, entity["RowKey"])
+
+            try:
+                table_service.commit_batch(pausedata.TARGET_TABLE, batch)
+                deleted.extend(chunk)
+            except Exception as e:
+                logging.info(f"Batch delete failed, deleting one by one: {e}")
+                for entity in chunk:
+                    try:
+                        table_service.delete_entity(
+                            pausedata.TARGET_TABLE, partition_key, entity["RowKey"]
+                        )
+                        deleted.append(entity)
+                    except AzureMissingResourceHttpError:
+                        pass
+                    except Exception as e:
+                        logging.info(f"Could not delete {entity['RowKey']}: {e}")
+
+    return deleted
+
+
+def collect_garbage(
+    table_service: TableService,
+    grace_period: float,
+    max_ops_per_second: float,
+    page_size: int = 1000,
+    time_budget: Optional[float] = None,
+    marker: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    """Delete the expired or consumed rows of the PipelinePauseData table.
+
+    Rows modified within the grace period can't be garbage so they are
+    filtered out server side. Only the properties needed to decide if a row
+    is garbage are retrieved. Offloaded payloads are only deleted along with
+    rows that were deleted.
+
+    Parameters
+    ----------
+    table_service
+        Table service for the storage account.
+    grace_period
+        Seconds a row is kept for after it expired or was acted upon.
+    max_ops_per_second
+        Maximum number of rows read plus deleted per second.
+    page_size
+        Number of rows retrieved per request.
+    time_budget
+        Seconds after which no further page is retrieved. Unlimited if None.
+    marker
+        Continuation marker to resume the scan from, as found in the report
+        of a previous call.
+
+    Returns
+    -------
+    Report with the number of rows scanned and deleted, the number of
+    offloaded payloads deleted, the run time and next_marker, the marker to
+    resume from or None if the scan reached the end of the table.
+    """
+    started_at = time.monotonic()
+    rate_limiter = throttling.RateLimiter(max_ops_per_second, burst=page_size)
+    cutoff = pytz.utc.localize(datetime.datetime.now()) - datetime.timedelta(
+        seconds=grace_period
+    )
+    query_filter = f"Timestamp lt datetime'{cutoff.strftime('%Y-%m-%dT%H:%M:%SZ')}'"
+
+    scanned = 0
+    deleted = 0
+    files_deleted = 0
+    while True:
+        rate_limiter.acquire(page_size)
+        page = table_service.query_entities(
+            pausedata.TARGET_TABLE,
+            filter=query_filter,
+            select=",".join(CLEANUP_PROPERTIES),
+            num_results=page_size,
+            marker=marker,
+        )
+        entities = list(page)
+        scanned += len(entities)
+
+        garbage = [x for x in entities if is_garbage(x, grace_period)]
+        for entity in delete_entities(table_service, garbage, rate_limiter):
+            deleted += 1
+            files_deleted += pausedata.delete_offloaded_data(entity)
+
+        marker = page.next_marker or None
+        if marker is None:
+            break
+        if time_budget is not None and time.monotonic() - started_at >= time_budget:
+            logging.info("Pause data cleanup ran out of time, stopping early.")
+            break
+
+    return {
+        "scanned": scanned,
+        "deleted": deleted,
+        "files_deleted": files_deleted,
+        "seconds": round(time.monotonic() - started_at, 3),
+        "next_marker": marker,
+    }
+
+
+def _marker_file() -> Any:
+    return clients.get_file_client(
+        conn_str=os.environ["AzureWebJobsStorage"],
+        share_name=os.environ.get("PAUSE_DATA_SHARE", "pipeline-pause-data"),
+        file_path=MARKER_FILE,
+    )
+
+
+def load_marker() -> Optional[Dict[str, str]]:
+    """Retrieve the marker saved by a run that did not reach the end."""
+    try:
+        return json.loads(_marker_file().download_file().readall())
+    except ResourceNotFoundError:
+        return None
+
+
+def save_marker(marker: Optional[Dict[str, str]]) -> None:
+    """Save the marker for the next run, or remove it if the scan finished."""
+    if marker is None:
+        try:
+            _marker_file().delete_file()
+        except ResourceNotFoundError:
+            pass
+        return
+
+    clients.ensure_share(
+        os.environ["AzureWebJobsStorage"],
+        os.environ.get("PAUSE_DATA_SHARE", "pipeline-pause-data"),
+    )
+    _marker_file().upload_file(json.dumps(marker).encode("utf-8"))
+
+
+def main(timer: func.TimerRequest) -> None:
+    if timer.past_due:
+        logging.info("Pause data cleanup is running late.")
+
+    table_service = utilities.setup_table_service(
+        os.environ["AzureWebJobsStorage"], pausedata.TARGET_TABLE,
+    )
+
+    report = collect_garbage(
+        table_service,
+        grace_period=float(os.environ.get("PAUSE_CLEANUP_GRACE_SECONDS", 604800)),
+        max_ops_per_second=float(
+            os.environ.get("PAUSE_CLEANUP_MAX_OPS_PER_SECOND", 200)
+        ),
+        time_budget=float(os.environ.get("PAUSE_CLEANUP_TIME_BUDGET_SECONDS", 240)),
+        marker=load_marker(),
+    )
+    save_marker(report["next_marker"])
+    logging.info(f"Pause data cleanup: {json.dumps(report)}")
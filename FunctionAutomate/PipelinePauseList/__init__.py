@@ -0,0 +1,211 @@
+"""List the pauses stored in the PipelinePauseData table, one page at a time.
+
+Operators use this endpoint to inspect outstanding pauses without exporting
+the table. The request may contain the following optional parameters:
+- factory_name: Only list the pauses of this data factory.
+- pipeline_name: Only list the pauses of this pipeline.
+- acted_upon: 0 for pauses still waiting for a restart, 1 for the others.
+- expires_after, expires_before: ISO 8601 datetimes bounding the expiry of
+    the pauses. Pauses written before the expiry was stored never match.
+- select: Comma separated list of the properties to return, out of
+    LIST_PROPERTIES. All of them by default. The data of the pauses can't be
+    selected as it can be large, see utilities.pausedata.
+- page_size: Number of pauses per page, at most MAX_PAGE_SIZE.
+- continuation_token: Token of the next page as returned by the previous one.
+
+All the filters are translated into an OData query so that only the matching
+rows leave Table storage. Each response holds a single page and the
+continuation_token of the next one, which is null on the last page.
+"""
+import base64
+import datetime
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+from __app__.utilities import exceptions
+from __app__.utilities import pausedata
+from __app__.utilities import schema
+from __app__.utilities import utilities
+
+import azure.functions as func
+
+# The token of each pause, its RowKey, is always returned.
+LIST_PROPERTIES = [
+    "Timestamp",
+    "resource_group",
+    "factory_name",
+    "pipeline_name",
+    "expiration_time",
+    "expires_at",
+    "acted_upon",
+    "run_id",
+    "web_path",
+    "share_name",
+    "data_encoding",
+]
+MAX_PAGE_SIZE = 1000
+
+
+def _datetime(value: str) -> datetime.datetime:
+    timestamp = datetime.datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=datetime.timezone.utc)
+
+    return timestamp.astimezone(datetime.timezone.utc)
+
+
+def _acted_upon(value: Any) -> int:
+    if str(value) not in ("0", "1"):
+        raise ValueError("expected 0 or 1")
+
+    return int(value)
+
+
+def _selection(value: Any) -> List[str]:
+    names = schema.comma_separated(value)
+    unknown = [x for x in names if x not in LIST_PROPERTIES]
+    if unknown:
+        raise ValueError(f"unknown properties {', '.join(unknown)}")
+
+    return names
+
+
+def _page_size(value: Any) -> int:
+    size = int(value)
+    if not 0 < size <= MAX_PAGE_SIZE:
+        raise ValueError(f"expected a number between 1 and {MAX_PAGE_SIZE}")
+
+    return size
+
+
+def encode_continuation_token(marker: Optional[Dict[str, str]]) -> Optional[str]:
+    """Turn the marker of the Table SDK into an opaque URL safe string."""
+    if not marker:
+        return None
+
+    return base64.urlsafe_b64encode(json.dumps(marker).encode("utf-8")).decode()
+
+
+def decode_continuation_token(token: str) -> Dict[str, str]:
+    """Counterpart of encode_continuation_token.
+
+    Raise
+    -----
+    Raises a ValueError if the token was not produced by
+    encode_continuation_token.
+    """
+    try:
+        marker = json.loads(base64.urlsafe_b64decode(token.encode("utf-8")))
+    except (TypeError, ValueError):
+        raise ValueError("malformed token")
+    if not isinstance(marker, dict) or not all(
+        isinstance(x, str) for x in marker.values()
+    ):
+        raise ValueError("malformed token")
+
+    return marker
+
+
+LIST_FIELDS = [
+    schema.Field("factory_name", coerce=str),
+    schema.Field("pipeline_name", coerce=str),
+    schema.Field("acted_upon", coerce=_acted_upon),
+    schema.Field("expires_after", coerce=_datetime),
+    schema.Field("expires_before", coerce=_datetime),
+    schema.Field("select", default=LIST_PROPERTIES, coerce=_selection),
+    schema.Field("page_size", default=100, coerce=_page_size),
+    schema.Field("continuation_token", coerce=decode_continuation_token),
+]
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _odata_datetime(value: datetime.datetime) -> str:
+    return f"datetime'{value.strftime('%Y-%m-%dT%H:%M:%SZ')}'"
+
+
+def build_filter(params: Dict[str, Any]) -> Optional[str]:
+    """Translate the filters of a listing request into an OData query.
+
+    Parameters
+    ----------
+    params
+        Parameters of the request as parsed with LIST_FIELDS.
+
+    Returns
+    -------
+    The query or None if the request has no filters.
+    """
+    clauses = []
+    if params["factory_name"] is not None:
+        clauses.append(f"factory_name eq {_quote(params['factory_name'])}")
+    if params["pipeline_name"] is not None:
+        clauses.append(f"pipeline_name eq {_quote(params['pipeline_name'])}")
+    if params["acted_upon"] is not None:
+        clauses.append(f"acted_upon eq {params['acted_upon']}")
+    if params["expires_after"] is not None:
+        clauses.append(f"expires_at ge {_odata_datetime(params['expires_after'])}")
+    if params["expires_before"] is not None:
+        clauses.append(f"expires_at lt {_odata_datetime(params['expires_before'])}")
+
+    return " and ".join(clauses) or None
+
+
+def _serialize(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+
+    return value
+
+
+def list_pauses(table_service: Any, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Retrieve a single page of pauses.
+
+    Parameters
+    ----------
+    table_service
+        Table service for the storage account.
+    params
+        Parameters of the request as parsed with LIST_FIELDS.
+
+    Returns
+    -------
+    The pauses of the page, with the token of each one under "token", and the
+    continuation_token of the next page.
+    """
+    with exceptions.span("table.query"):
+        page = table_service.query_entities(
+            pausedata.TARGET_TABLE,
+            filter=build_filter(params),
+            select=",".join(["RowKey"] + params["select"]),
+            num_results=params["page_size"],
+            marker=params["continuation_token"],
+        )
+        entities = list(page)
+    exceptions.annotate(pauses=len(entities))
+
+    pauses = []
+    for entity in entities:
+        pause = {"token": entity["RowKey"]}
+        pause.update({x: _serialize(entity.get(x)) for x in params["select"]})
+        pauses.append(pause)
+
+    return {
+        "pauses": pauses,
+        "continuation_token": encode_continuation_token(page.next_marker),
+    }
+
+
+@exceptions.exceptions_as_response
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    params = schema.parse(req, LIST_FIELDS)
+    table_service = utilities.setup_table_service(
+        os.environ["AzureWebJobsStorage"], pausedata.TARGET_TABLE,
+    )
+
+    return func.HttpResponse(
+        json.dumps(list_pauses(table_service, params)), mimetype="application/json"
+    )
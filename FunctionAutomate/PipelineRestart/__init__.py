@@ -1,157 +1,404 @@
-"""
-
-Author: Guillem Ballesteros
-"""
-import datetime
-import logging
-import os
-
-from __app__.utilities import exceptions
-from __app__.utilities import utilities
-
-import azure.functions as func
-from azure.common import AzureMissingResourceHttpError
-from azure.common.credentials import ServicePrincipalCredentials
-from azure.mgmt.datafactory import DataFactoryManagementClient
-from azure.storage.fileshare import ShareFileClient
-
-import pytz
-
-# ToDo
-#
-#
-# in ADF you also need to create a new Dataset for table storage
-# syntax for queries in https://docs.microsoft.com/en-us/rest/api/storageservices/Query-Operators-Supported-for-the-Table-Service?redirectedfrom=MSDN
-#
-# Docs for SDK
-# https://docs.microsoft.com/en-us/python/api/azure-mgmt-datafactory/azure.mgmt.datafactory.datafactorymanagementclient?view=azure-python
-# Factory Docs
-# https://docs.microsoft.com/en-us/python/api/azure-mgmt-datafactory/azure.mgmt.datafactory.models.factory?view=azure-python
-# https://docs.microsoft.com/en-us/python/api/azure-mgmt-datafactory/azure.mgmt.datafactory.operations.pipelinesoperations?view=azure-python
-
-
-def check_if_expired(timestamp: datetime.datetime, expiration_time: int) -> bool:
-    """
-    Check if a timestamp is older than the current time.
-
-    The current time is obtained through a call to datetime.now() and localized to
-    UTC as that is what the Azure cloud uses for its timestamps.
-
-    Parameters
-    ----------
-    timestamp
-        UTC time-zone aware timestamp.
-    expiration_time
-        Time to expiration in seconds.
-
-    Returns
-    -------
-    Has the timestamp expired?
-    """
-    expiration_timestamp = timestamp + datetime.timedelta(seconds=expiration_time)
-    current_time = pytz.utc.localize(datetime.datetime.now())
-
-    has_expired = current_time > expiration_timestamp
-    return has_expired
-
-
-def restart_pipeline(
-    adf_client: DataFactoryManagementClient,
-    resource_group: str,
-    factory_name: str,
-    pipeline_name: str,
-    token: str,
-):
-    pipelines = adf_client.pipelines.list_by_factory(
-        resource_group_name=resource_group, factory_name=factory_name,
-    )
-
-    available_pipelines = [pipeline.name for pipeline in pipelines]
-    if pipeline_name not in available_pipelines:
-        msg = f"{pipeline_name} is not available in the data factory."
-        raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=500))
-
-    run_response = adf_client.pipelines.create_run(
-        resource_group, factory_name, pipeline_name, parameters={"token": token},
-    )
-
-    return run_response
-
-
-@exceptions.exceptions_as_response
-def main(req: func.HttpRequest) -> func.HttpResponse:
-    target_table = "PipelinePauseData"
-    token = utilities.get_param(req, "token")
-
-    table_service = utilities.setup_table_service(
-        os.environ["AzureWebJobsStorage"], target_table,
-    )
-
-    # Since we can't use authentication for the API we will check as
-    # soon as possible if the token for the pipeline restart is valid.
-    # if it is not we halt execution and return a 500 code.
-    try:
-        paused_pipeline = table_service.get_entity(
-            table_name=target_table, partition_key="PauseData", row_key=token
-        )
-    except AzureMissingResourceHttpError as e:
-        raise exceptions.HttpError(
-            str(e),
-            func.HttpResponse(str(e), status_code=500)
-        )
-
-    # acted_upon monitors if a token has already been used. We use it here to
-    # block the second and further attempts at restarting.
-    acted_upon = paused_pipeline["acted_upon"]
-
-    has_expired = check_if_expired(
-        paused_pipeline["Timestamp"], paused_pipeline["expiration_time"],
-    )
-
-    if not acted_upon and not has_expired:
-        logging.info(token)
-
-        # DefaultAzureCredential does not work when manipulating ADF. It will
-        # complain about a missing session method.
-        # Remember to give the contributor role to the application.
-        # Azure Portal -> Subscriptions -> IAM roles
-        credentials = ServicePrincipalCredentials(
-            client_id=os.environ["AZURE_CLIENT_ID"],
-            secret=os.environ["AZURE_CLIENT_SECRET"],
-            tenant=os.environ["AZURE_TENANT_ID"],
-        )
-
-        subscription_id = os.environ["subscription_id"]
-        adf_client = DataFactoryManagementClient(credentials, subscription_id)
-        logging.info(adf_client)
-
-        # The restart data is accessed via a lookup activity from within ADF
-        run_response = restart_pipeline(
-            adf_client=adf_client,
-            resource_group=paused_pipeline["resource_group"],
-            factory_name=paused_pipeline["factory_name"],
-            pipeline_name=paused_pipeline["pipeline_name"],
-            token=token,
-        )
-        logging.info(run_response)
-
-        # After running acted_upon is set to 1
-        paused_pipeline["acted_upon"] = 1
-        table_service.update_entity(target_table, paused_pipeline)
-
-        # Retrieve and display success webpage.
-        confirmation_site = (
-            ShareFileClient.from_connection_string(
-                conn_str=os.environ["AzureWebJobsStorage"],
-                share_name=paused_pipeline["share_name"],
-                file_path=paused_pipeline["web_path"],
-            )
-            .download_file()
-            .readall()
-            .decode("utf-8")
-        )
-
-        return func.HttpResponse(confirmation_site, mimetype="text/html")
-
-    else:  # already acted_upon or expired
-        return func.HttpResponse("Invalid token.", status_code=500,)
+"""Restart an ADF pipeline paused with PipelinePause.
+
+The incoming request must contain the token returned by PipelinePause. It is
+used to find the table entry with the details of the pipeline to restart.
+
+The run receives two pipeline parameters, token and partition_key, which
+together are the key of the table entry holding the restart data. The Lookup
+activity reading that data has to filter on both of them:
+    PartitionKey eq '@{pipeline().parameters.partition_key}' and
+    RowKey eq '@{pipeline().parameters.token}'
+Entries are spread over several partitions (see utilities.pausedata), so
+pipelines with a Lookup on the single "PauseData" partition have to change.
+
+Pipelines are looked up with a targeted get before being restarted and the
+result is cached for PIPELINE_CATALOG_TTL_SECONDS (optional env variable).
+
+The endpoint is anonymous so most requests carry bogus, expired or already
+used tokens. Malformed tokens are rejected without touching Table storage and
+the tokens found to be unusable are remembered so that retries are answered
+from memory too. Counters of the rejections are attached to the invocation
+trace, see utilities.exceptions.
+Optional env variables:
+- REJECTED_TOKEN_TTL_SECONDS: Seconds an unusable token is remembered for.
+- REJECTED_TOKEN_CACHE_SIZE: Maximum number of unusable tokens remembered.
+
+An asyncio flavour of the entry point is available as main_async. Set
+"entryPoint": "main_async" in function.json to use it.
+
+Author: Guillem Ballesteros
+"""
+import logging
+import os
+import threading
+from typing import TYPE_CHECKING, Dict
+
+from __app__.utilities import aio
+from __app__.utilities import caching
+from __app__.utilities import clients
+from __app__.utilities import exceptions
+from __app__.utilities import pausedata
+from __app__.utilities import schema
+from __app__.utilities import utilities
+
+import azure.functions as func
+from azure.common import AzureMissingResourceHttpError
+
+if TYPE_CHECKING:
+    # The client itself is only imported once a valid token comes in, see
+    # utilities.clients.
+    from azure.mgmt.datafactory import DataFactoryManagementClient
+
+# ToDo
+#
+#
+# in ADF you also need to create a new Dataset for table storage
+# syntax for queries in https://docs.microsoft.com/en-us/rest/api/storageservices/Query-Operators-Supported-for-the-Table-Service?redirectedfrom=MSDN
+#
+# Docs for SDK
+# https://docs.microsoft.com/en-us/python/api/azure-mgmt-datafactory/azure.mgmt.datafactory.datafactorymanagementclient?view=azure-python
+# Factory Docs
+# https://docs.microsoft.com/en-us/python/api/azure-mgmt-datafactory/azure.mgmt.datafactory.models.factory?view=azure-python
+# https://docs.microsoft.com/en-us/python/api/azure-mgmt-datafactory/azure.mgmt.datafactory.operations.pipelinesoperations?view=azure-python
+
+
+def _is_not_found(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 404
+
+
+class PipelineCatalog:
+    """Cache of the pipelines known to exist in each data factory.
+
+    Listing every pipeline of a factory takes several paged calls to the
+    heavily throttled management API. Instead, pipelines are looked up one at
+    a time with a targeted get the first time they are restarted and then
+    trusted for ttl seconds.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 4096) -> None:
+        """Init the catalog.
+
+        Parameters
+        ----------
+        ttl
+            Seconds a pipeline is trusted to exist after being looked up.
+        max_entries
+            Maximum number of pipelines remembered.
+        """
+        self._cache = caching.TTLCache(ttl, max_entries)
+
+    def exists(
+        self,
+        adf_client: "DataFactoryManagementClient",
+        resource_group: str,
+        factory_name: str,
+        pipeline_name: str,
+    ) -> bool:
+        """Check if a pipeline exists in a data factory."""
+        key = (resource_group, factory_name, pipeline_name)
+        cached = self._cache.get(key)
+        exceptions.annotate(pipeline_catalog_hit=bool(cached))
+        if cached:
+            return True
+
+        try:
+            with exceptions.span("adf.get_pipeline"):
+                adf_client.pipelines.get(resource_group, factory_name, pipeline_name)
+        except Exception as e:
+            if _is_not_found(e):
+                return False
+            raise
+
+        self._cache.put(key, True)
+        return True
+
+    def forget(
+        self, resource_group: str, factory_name: str, pipeline_name: str
+    ) -> None:
+        """Drop a pipeline from the catalog, e.g. because it was deleted."""
+        self._cache.pop((resource_group, factory_name, pipeline_name))
+
+    def stats(self) -> Dict[str, int]:
+        """Report the cache counters."""
+        return self._cache.stats()
+
+
+_pipeline_catalog = PipelineCatalog(
+    ttl=float(os.environ.get("PIPELINE_CATALOG_TTL_SECONDS", 600))
+)
+
+
+class RejectedTokens:
+    """Filter answering requests with unusable tokens without a storage read.
+
+    Tokens that don't have the format of the ones issued by PipelinePause are
+    rejected outright. Tokens that were looked up and found to be unknown,
+    expired or already used can never become valid again, so they are
+    remembered for ttl seconds and rejected from memory.
+    """
+
+    def __init__(self, ttl: float, max_entries: int) -> None:
+        """Init the filter.
+
+        Parameters
+        ----------
+        ttl
+            Seconds an unusable token is remembered for.
+        max_entries
+            Maximum number of unusable tokens remembered.
+        """
+        self._cache = caching.TTLCache(ttl, max_entries)
+        self._counters = {"malformed": 0, "remembered": 0, "looked_up": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._counters[counter] += 1
+
+    def check(self, token: str) -> None:
+        """Reject a token known to be unusable.
+
+        Raise
+        -----
+        Raises an exceptions.HttpError if the token is malformed or
+        remembered as unusable.
+        """
+        if not pausedata.is_well_formed(token):
+            reason = "malformed"
+            self._count("malformed")
+        else:
+            reason = self._cache.get(token)
+            if reason is None:
+                self._count("looked_up")
+                return
+            self._count("remembered")
+
+        exceptions.annotate(token_rejected=reason)
+        raise exceptions.HttpError(
+            f"Token rejected without lookup ({reason}).", _invalid_token()
+        )
+
+    def remember(self, token: str, reason: str) -> None:
+        """Remember that a token turned out to be unusable.
+
+        Parameters
+        ----------
+        token
+            Token that was looked up.
+        reason
+            Why it is unusable: not_found, expired or acted_upon.
+        """
+        self._cache.put(token, reason)
+
+    def stats(self) -> Dict[str, int]:
+        """Report how many requests were rejected before reaching storage."""
+        with self._lock:
+            counters = dict(self._counters)
+
+        return dict(counters, cached_tokens=len(self._cache))
+
+
+def _invalid_token() -> func.HttpResponse:
+    return func.HttpResponse("Invalid token.", status_code=500)
+
+
+_rejected_tokens = RejectedTokens(
+    ttl=float(os.environ.get("REJECTED_TOKEN_TTL_SECONDS", 3600)),
+    max_entries=int(os.environ.get("REJECTED_TOKEN_CACHE_SIZE", 10000)),
+)
+
+
+def restart_pipeline(
+    adf_client: "DataFactoryManagementClient",
+    resource_group: str,
+    factory_name: str,
+    pipeline_name: str,
+    token: str,
+    partition_key: str,
+):
+    # The catalog may be stale if the pipeline was deleted after it was
+    # cached. If create_run can't find it the catalog is refreshed and, if it
+    # still claims the pipeline exists, the run is attempted once more.
+    for attempt in range(2):
+        if not _pipeline_catalog.exists(
+            adf_client, resource_group, factory_name, pipeline_name
+        ):
+            msg = f"{pipeline_name} is not available in the data factory."
+            raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=500))
+
+        try:
+            with exceptions.span("adf.create_run"):
+                return adf_client.pipelines.create_run(
+                    resource_group,
+                    factory_name,
+                    pipeline_name,
+                    parameters={"token": token, "partition_key": partition_key},
+                )
+        except Exception as e:
+            if not _is_not_found(e) or attempt:
+                raise
+            logging.info(f"{pipeline_name} was not found. Refreshing catalog.")
+            _pipeline_catalog.forget(resource_group, factory_name, pipeline_name)
+
+
+RESTART_FIELDS = [schema.Field("token", required=True)]
+
+# Everything but the data of the pause, which is only read by the pipeline.
+RESTART_PROPERTIES = [
+    "PartitionKey",
+    "RowKey",
+    "Timestamp",
+    "resource_group",
+    "factory_name",
+    "pipeline_name",
+    "expiration_time",
+    "acted_upon",
+    "web_path",
+    "share_name",
+]
+
+
+def restarted_entity(paused_pipeline: Dict, run_id: str) -> Dict:
+    """Properties merged into the entity of a pipeline once restarted.
+
+    After running acted_upon is set to 1. The run id is kept for
+    PipelineStatus. The entity is merged rather than replaced so that the
+    data of the pause, which was not retrieved, is kept.
+    """
+    return {
+        "PartitionKey": paused_pipeline["PartitionKey"],
+        "RowKey": paused_pipeline["RowKey"],
+        "acted_upon": 1,
+        "run_id": run_id,
+    }
+
+
+def parse_token(req: func.HttpRequest) -> str:
+    """Extract the token of a restart request, rejecting known bad tokens.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError if the token is missing, malformed or
+    already known to be unusable.
+    """
+    token = schema.parse(req, RESTART_FIELDS)["token"]
+    if exceptions.tracing_enabled():
+        exceptions.annotate(token_filter=_rejected_tokens.stats())
+    _rejected_tokens.check(token)
+
+    return token
+
+
+def restart_paused_pipeline(token: str) -> Dict:
+    """Restart the pipeline paused with a token and mark the token as used.
+
+    Parameters
+    ----------
+    token
+        Token returned by PipelinePause.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError if the token is unknown, already used or
+    expired.
+
+    Returns
+    -------
+    The entity of the paused pipeline, with the location of the confirmation
+    page.
+    """
+    target_table = pausedata.TARGET_TABLE
+    table_service = utilities.setup_table_service(
+        os.environ["AzureWebJobsStorage"], target_table,
+    )
+
+    # Since we can't use authentication for the API we will check as
+    # soon as possible if the token for the pipeline restart is valid.
+    # if it is not we halt execution and return a 500 code.
+    try:
+        paused_pipeline = pausedata.get_paused_pipeline(
+            table_service, token, select=",".join(RESTART_PROPERTIES)
+        )
+    except AzureMissingResourceHttpError as e:
+        _rejected_tokens.remember(token, "not_found")
+        raise exceptions.HttpError(
+            str(e),
+            func.HttpResponse(str(e), status_code=500)
+        )
+
+    # acted_upon monitors if a token has already been used. We use it here to
+    # block the second and further attempts at restarting.
+    acted_upon = paused_pipeline["acted_upon"]
+
+    has_expired = pausedata.check_if_expired(
+        paused_pipeline["Timestamp"], paused_pipeline["expiration_time"],
+    )
+
+    if acted_upon or has_expired:
+        _rejected_tokens.remember(token, "acted_upon" if acted_upon else "expired")
+        raise exceptions.HttpError("Token already used or expired.", _invalid_token())
+
+    logging.info(token)
+
+    adf_client = clients.get_adf_client()
+
+    # The restart data is accessed via a lookup activity from within ADF
+    run_response = restart_pipeline(
+        adf_client=adf_client,
+        resource_group=paused_pipeline["resource_group"],
+        factory_name=paused_pipeline["factory_name"],
+        pipeline_name=paused_pipeline["pipeline_name"],
+        token=token,
+        partition_key=paused_pipeline["PartitionKey"],
+    )
+    logging.info(run_response)
+
+    with exceptions.span("table.update"):
+        table_service.merge_entity(
+            target_table, restarted_entity(paused_pipeline, run_response.run_id)
+        )
+    # Double clicks on the approval link are answered from memory.
+    _rejected_tokens.remember(token, "acted_upon")
+
+    return paused_pipeline
+
+
+@exceptions.exceptions_as_response
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    paused_pipeline = restart_paused_pipeline(parse_token(req))
+
+    # Retrieve and display success webpage.
+    with exceptions.span("file_share.download"):
+        confirmation_site = (
+            clients.get_file_client(
+                conn_str=os.environ["AzureWebJobsStorage"],
+                share_name=paused_pipeline["share_name"],
+                file_path=paused_pipeline["web_path"],
+            )
+            .download_file()
+            .readall()
+        )
+
+    return func.HttpResponse(confirmation_site.decode("utf-8"), mimetype="text/html")
+
+
+@exceptions.exceptions_as_response_async
+async def main_async(req: func.HttpRequest) -> func.HttpResponse:
+    """Counterpart of main for the asyncio entry point.
+
+    Only the confirmation page is downloaded with an aio client. The Table
+    storage SDK has no asyncio flavour and the restart shares its caches and
+    Data Factory client with main, so it runs in the default executor, see
+    restart_paused_pipeline.
+    """
+    paused_pipeline = await aio.run_blocking(
+        restart_paused_pipeline, parse_token(req)
+    )
+
+    confirmation_site, _ = await aio.download_file(
+        conn_str=os.environ["AzureWebJobsStorage"],
+        share_name=paused_pipeline["share_name"],
+        file_path=paused_pipeline["web_path"],
+    )
+
+    return func.HttpResponse(confirmation_site.decode("utf-8"), mimetype="text/html")
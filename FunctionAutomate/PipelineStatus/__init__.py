@@ -0,0 +1,183 @@
+"""Report the state of the ADF pipeline run started by PipelineRestart.
+
+The incoming request must contain the token returned by PipelinePause. The
+response is a JSON object with the pipeline_name, the run_id and the status
+of the run as reported by ADF, along with its message, start, end and
+duration. Until the pipeline is restarted the status is "Paused". Pipelines
+restarted before run ids were stored report "Unknown".
+
+Dashboards poll this endpoint instead of the management API. The lookup of
+the token and the status of the run are cached process wide, and concurrent
+requests for the same run wait for a single call to ADF. Runs that reached a
+terminal state are cached until evicted, the others are refreshed at most
+once every PIPELINE_STATUS_TTL_SECONDS (optional env variable).
+
+The endpoint is anonymous, so tokens that are not found are remembered too
+and polling them doesn't reach Table storage. A token is never written after
+being handed out, so it stays unknown for good. Unknown tokens are kept for
+UNKNOWN_TOKEN_TTL_SECONDS (optional env variable, one hour by default) so
+that they can't crowd the cache out for long.
+
+An asyncio flavour of the entry point is available as main_async. Set
+"entryPoint": "main_async" in function.json to use it.
+"""
+import datetime
+import json
+import os
+from typing import Any, Dict, Optional
+
+from __app__.utilities import aio
+from __app__.utilities import caching
+from __app__.utilities import clients
+from __app__.utilities import exceptions
+from __app__.utilities import pausedata
+from __app__.utilities import schema
+from __app__.utilities import utilities
+
+import azure.functions as func
+from azure.common import AzureMissingResourceHttpError
+
+TERMINAL_STATES = {"Succeeded", "Failed", "Cancelled"}
+STATUS_FIELDS = [schema.Field("token", required=True)]
+
+# Everything but the data of the pause, which can be large.
+RUN_PROPERTIES = [
+    "resource_group",
+    "factory_name",
+    "pipeline_name",
+    "acted_upon",
+    "run_id",
+]
+
+_status_ttl = float(os.environ.get("PIPELINE_STATUS_TTL_SECONDS", 15))
+_unknown_token_ttl = float(os.environ.get("UNKNOWN_TOKEN_TTL_SECONDS", 3600))
+# Cached in place of the run of a token that is not found.
+_UNKNOWN_TOKEN: Dict[str, Any] = {}
+_runs_by_token = caching.CoalescingCache(ttl=_status_ttl, max_entries=10000)
+_run_statuses = caching.CoalescingCache(ttl=_status_ttl, max_entries=10000)
+
+
+def _invalid_token() -> exceptions.HttpError:
+    return exceptions.HttpError(
+        "Invalid token.", func.HttpResponse("Invalid token.", status_code=500)
+    )
+
+
+def find_run(token: str) -> Dict[str, Any]:
+    """Retrieve the pipeline and run id of a token.
+
+    The entity of a restarted pipeline does not change anymore, so it is
+    cached until evicted. Pipelines that are still paused are looked up again
+    once the status TTL expires. Unknown tokens are cached as such.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError if there is no entity for the token.
+    """
+
+    def load() -> Dict[str, Any]:
+        table_service = utilities.setup_table_service(
+            os.environ["AzureWebJobsStorage"], pausedata.TARGET_TABLE
+        )
+        try:
+            entity = pausedata.get_paused_pipeline(
+                table_service, token, select=",".join(RUN_PROPERTIES)
+            )
+        except AzureMissingResourceHttpError:
+            return _UNKNOWN_TOKEN
+
+        return {name: entity.get(name) for name in RUN_PROPERTIES}
+
+    def ttl(run: Dict[str, Any]) -> Optional[float]:
+        if run is _UNKNOWN_TOKEN:
+            return _unknown_token_ttl
+        return float("inf") if run["acted_upon"] else None
+
+    run = _runs_by_token.get(token, load, ttl=ttl)
+    if run is _UNKNOWN_TOKEN:
+        raise _invalid_token()
+
+    return run
+
+
+def _isoformat(timestamp: Optional[datetime.datetime]) -> Optional[str]:
+    return timestamp.isoformat() if timestamp is not None else None
+
+
+def get_run_status(
+    resource_group: str, factory_name: str, run_id: str
+) -> Dict[str, Any]:
+    """Retrieve the status of a pipeline run through the shared cache.
+
+    Parameters
+    ----------
+    resource_group
+        Resource group of the data factory.
+    factory_name
+        Name of the data factory.
+    run_id
+        Id of the run as returned by create_run.
+    """
+
+    def load() -> Dict[str, Any]:
+        adf_client = clients.get_adf_client()
+        with exceptions.span("adf.get_run"):
+            run = adf_client.pipeline_runs.get(resource_group, factory_name, run_id)
+
+        return {
+            "status": run.status,
+            "message": run.message,
+            "run_start": _isoformat(run.run_start),
+            "run_end": _isoformat(run.run_end),
+            "duration_in_ms": run.duration_in_ms,
+        }
+
+    return _run_statuses.get(
+        (resource_group, factory_name, run_id),
+        load,
+        ttl=lambda x: float("inf") if x["status"] in TERMINAL_STATES else None,
+    )
+
+
+def pipeline_status(token: str) -> Dict[str, Any]:
+    """Describe the state of the pipeline paused with a token."""
+    if not pausedata.is_well_formed(token):
+        raise _invalid_token()
+
+    run = find_run(token)
+    status = {"pipeline_name": run["pipeline_name"], "run_id": run["run_id"]}
+    if run["run_id"] is None:
+        status["status"] = "Unknown" if run["acted_upon"] else "Paused"
+    else:
+        status.update(
+            get_run_status(run["resource_group"], run["factory_name"], run["run_id"])
+        )
+
+    if exceptions.tracing_enabled():
+        exceptions.annotate(
+            token_cache=_runs_by_token.stats(), run_status_cache=_run_statuses.stats()
+        )
+    return status
+
+
+@exceptions.exceptions_as_response
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    token = schema.parse(req, STATUS_FIELDS)["token"]
+
+    return func.HttpResponse(
+        json.dumps(pipeline_status(token)), mimetype="application/json"
+    )
+
+
+@exceptions.exceptions_as_response_async
+async def main_async(req: func.HttpRequest) -> func.HttpResponse:
+    """Counterpart of main for the asyncio entry point.
+
+    The Table storage SDK has no asyncio flavour and the lookups share their
+    caches and Data Factory client with main, so they run in the default
+    executor.
+    """
+    token = schema.parse(req, STATUS_FIELDS)["token"]
+    status = await aio.run_blocking(pipeline_status, token)
+
+    return func.HttpResponse(json.dumps(status), mimetype="application/json")
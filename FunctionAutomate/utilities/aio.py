@@ -0,0 +1,117 @@
+"""Helpers for the asyncio entry points of the functions.
+
+The File Share and Key Vault calls use the aio flavour of their SDKs. The
+rest of the blocking work (Table storage, whose SDK has no aio flavour, Data
+Factory, Storage Queues and smtplib) is pushed to the event loop's default
+executor so that it never blocks the loop. It still holds an executor thread
+while it waits, so each entry point hands it over in as few calls as
+possible.
+
+The aio clients keep HTTP sessions open between invocations. They are
+closed when the worker shuts down, along with the ones registered by other
+modules with on_shutdown.
+"""
+import asyncio
+import atexit
+import contextvars
+import functools
+import logging
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Tuple, TypeVar
+
+from __app__.utilities import exceptions
+from __app__.utilities import lazy
+
+# aiohttp and the SDK are only loaded by the asyncio entry points.
+_fileshare_aio_sdk = lazy.lazy_import("azure.storage.fileshare.aio")
+
+if TYPE_CHECKING:
+    from azure.storage.fileshare.aio import ShareFileClient, ShareServiceClient
+
+T = TypeVar("T")
+
+# Only touched from the event loop, which runs one coroutine step at a time.
+_share_services: Dict[str, "ShareServiceClient"] = {}
+_closers: List[Callable[[], Awaitable[None]]] = []
+
+
+async def run_blocking(function: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking callable in the default executor and await its result.
+
+    The callable runs in a copy of the current context so that its stages are
+    added to the trace of the invocation, see utilities.exceptions.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+
+    return await loop.run_in_executor(
+        None, functools.partial(context.run, function, *args, **kwargs)
+    )
+
+
+def _file_client(conn_str: str, share_name: str, file_path: str) -> "ShareFileClient":
+    """Build a file client sharing the HTTP session of its storage account."""
+    share_service = _share_services.get(conn_str)
+    if share_service is None:
+        share_service = _fileshare_aio_sdk.ShareServiceClient.from_connection_string(
+            conn_str
+        )
+        _share_services[conn_str] = share_service
+
+    return share_service.get_share_client(share_name).get_file_client(file_path)
+
+
+async def download_file(
+    conn_str: str, share_name: str, file_path: str
+) -> Tuple[bytes, str]:
+    """Download a file from an Azure File Share.
+
+    Parameters
+    ----------
+    conn_str
+        Connection string to the storage account.
+    share_name
+        Name of the file share.
+    file_path
+        Path to the file relative to the root of the share.
+
+    Returns
+    -------
+    The content of the file and its ETag.
+    """
+    with exceptions.span("file_share.download"):
+        data = await _file_client(conn_str, share_name, file_path).download_file()
+        return await data.readall(), data.properties.etag
+
+
+async def get_etag(conn_str: str, share_name: str, file_path: str) -> str:
+    """Retrieve the ETag of a file in an Azure File Share."""
+    with exceptions.span("file_share.properties"):
+        file_client = _file_client(conn_str, share_name, file_path)
+        return (await file_client.get_file_properties()).etag
+
+
+def on_shutdown(closer: Callable[[], Awaitable[None]]) -> None:
+    """Register a coroutine function closing aio clients kept by a module."""
+    _closers.append(closer)
+
+
+async def close_async() -> None:
+    """Close every aio client, including the ones registered with on_shutdown."""
+    share_services = list(_share_services.values())
+    _share_services.clear()
+    for share_service in share_services:
+        await share_service.close()
+    for closer in _closers:
+        await closer()
+
+
+@atexit.register
+def _close_at_exit() -> None:
+    # The loop of the worker is gone by now, the sessions are closed on a new
+    # one. Nothing is left to do if that fails.
+    if not _share_services and not _closers:
+        return
+    try:
+        asyncio.run(close_async())
+    except Exception as e:
+        logging.info(f"Could not close the aio clients: {e}")
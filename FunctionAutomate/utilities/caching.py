@@ -0,0 +1,282 @@
+"""In-process caches shared across invocations of a warm worker.
+
+Azure Functions reuse the Python worker between invocations, so anything kept
+at module level survives until the instance is recycled. The caches in here
+are meant to be instantiated once per module and are safe to use from the
+worker's thread pool.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """Least recently used cache bounded by the total size of its values.
+
+    The size of each value is supplied by the caller on insertion since the
+    cache has no good way of measuring arbitrary objects. Hits and misses are
+    counted so that they can be reported alongside other metrics.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        """Init the cache.
+
+        Parameters
+        ----------
+        max_bytes
+            Upper bound for the sum of the sizes of all cached values. A value
+            bigger than the whole budget is never stored.
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Retrieve a value and mark it as the most recently used.
+
+        Returns
+        -------
+        The cached value or None if the key is not in the cache.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        """Store a value evicting the least recently used ones if needed.
+
+        Parameters
+        ----------
+        key
+            Key for the value.
+        value
+            Object to cache.
+        size
+            Size in bytes accounted against the cache budget.
+        """
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        """Remove a key from the cache if present."""
+        with self._lock:
+            self._discard(key)
+
+    def clear(self) -> None:
+        """Empty the cache. Counters are left untouched."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Report the cache counters."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+            }
+
+    def _discard(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class TTLCache:
+    """Cache whose entries expire after a fixed time.
+
+    The number of entries is bounded, the least recently used ones being
+    evicted first. Hits and misses are counted like in LRUCache.
+    """
+
+    def __init__(self, ttl: float, max_entries: int) -> None:
+        """Init the cache.
+
+        Parameters
+        ----------
+        ttl
+            Default number of seconds an entry is kept for.
+        max_entries
+            Maximum number of entries kept in the cache.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Retrieve a value if it has not expired.
+
+        Returns
+        -------
+        The cached value or None if the key is not in the cache or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Store a value.
+
+        Parameters
+        ----------
+        key
+            Key for the value.
+        value
+            Object to cache.
+        ttl
+            Seconds the value is kept for if different from the default.
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        """Remove a key from the cache if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Empty the cache. Counters are left untouched."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Report the cache counters."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class CoalescingCache:
+    """TTL cache that loads a missing key once however many callers want it.
+
+    Callers asking for a key that is already being loaded wait for that load
+    instead of starting their own, so any number of concurrent callers cost a
+    single load per expiry of the key. A failed load is raised to all the
+    callers that waited for it and nothing is cached.
+    """
+
+    def __init__(self, ttl: float, max_entries: int) -> None:
+        """Init the cache.
+
+        Parameters
+        ----------
+        ttl
+            Default number of seconds a loaded value is kept for.
+        max_entries
+            Maximum number of values kept in the cache.
+        """
+        self.loads = 0
+        self.coalesced = 0
+        self._cache = TTLCache(ttl, max_entries)
+        self._loading: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        key: Hashable,
+        load: Callable[[], Any],
+        ttl: Optional[Callable[[Any], Optional[float]]] = None,
+    ) -> Any:
+        """Retrieve a value, loading it if it is not cached.
+
+        Parameters
+        ----------
+        key
+            Key for the value.
+        load
+            Called without arguments to obtain the value on a miss. It must
+            not return None.
+        ttl
+            Called with the loaded value to obtain the seconds it is kept
+            for. The default TTL is used if not given or if it returns None.
+            Return float("inf") to keep a value until it is evicted.
+        """
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            future = self._loading.get(key)
+            is_loader = future is None
+            if is_loader:
+                # The value may have been stored since the lookup above.
+                value = self._cache.get(key)
+                if value is not None:
+                    return value
+                future = self._loading[key] = Future()
+                self.loads += 1
+            else:
+                self.coalesced += 1
+
+        if not is_loader:
+            return future.result()
+
+        try:
+            value = load()
+            self._cache.put(key, value, ttl(value) if ttl is not None else None)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+
+    def stats(self) -> Dict[str, int]:
+        """Report the cache counters."""
+        with self._lock:
+            return dict(
+                self._cache.stats(), loads=self.loads, coalesced=self.coalesced
+            )
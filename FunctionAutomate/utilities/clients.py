@@ -0,0 +1,198 @@
+"""Process wide registry of Azure clients.
+
+Building a client parses its connection string or credentials and opens a
+new HTTP connection pool. A warm worker serves many invocations, so clients
+are created lazily on first use and then shared by every invocation and
+thread, keeping their connections alive between requests.
+
+Tests and long running tools can drop every client with reset().
+"""
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Set, Tuple
+
+from __app__.utilities import exceptions
+from __app__.utilities import lazy
+from __app__.utilities import utilities
+
+import azure.functions as func
+from azure.core.exceptions import ResourceExistsError
+
+if TYPE_CHECKING:
+    from azure.cosmosdb.table.tableservice import TableService
+    from azure.mgmt.datafactory import DataFactoryManagementClient
+    from azure.storage.fileshare import (
+        ShareDirectoryClient,
+        ShareFileClient,
+        ShareServiceClient,
+    )
+
+# Each function only needs some of the SDKs, see utilities.lazy.
+_credentials_sdk = lazy.lazy_import("azure.common.credentials")
+_datafactory_sdk = lazy.lazy_import("azure.mgmt.datafactory")
+_fileshare_sdk = lazy.lazy_import("azure.storage.fileshare")
+_table_sdk = lazy.lazy_import("azure.cosmosdb.table.tableservice")
+
+_lock = threading.Lock()
+_table_services: Dict[str, "TableService"] = {}
+_existing_tables: Set[Tuple[str, str]] = set()
+_share_services: Dict[str, "ShareServiceClient"] = {}
+_existing_shares: Set[Tuple[str, str]] = set()
+_adf_clients: Dict[Tuple[str, ...], "DataFactoryManagementClient"] = {}
+
+
+def get_table_service(conn_str: str) -> "TableService":
+    """Retrieve the Table Service for a storage account."""
+    with _lock:
+        table_service = _table_services.get(conn_str)
+        if table_service is None:
+            storage_params = utilities.extract_storage_parameters(conn_str)
+            table_service = _table_sdk.TableService(
+                account_name=storage_params["AccountName"],
+                account_key=storage_params["AccountKey"],
+            )
+            _table_services[conn_str] = table_service
+
+    return table_service
+
+
+def ensure_table(conn_str: str, target_table: str) -> None:
+    """Check that a table exists in a storage account.
+
+    Only successful checks are remembered so that a missing table is picked up
+    as soon as it is created.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError if the table was not found in the storage
+    account.
+    """
+    if (conn_str, target_table) in _existing_tables:
+        return
+
+    with exceptions.span("table.exists"):
+        exists = get_table_service(conn_str).exists(target_table)
+    if not exists:
+        msg = f"Table {target_table} to store request info did not exist."
+        raise exceptions.HttpError(
+            msg, func.HttpResponse(msg, status_code=500),
+        )
+
+    with _lock:
+        _existing_tables.add((conn_str, target_table))
+
+
+def get_share_service(conn_str: str) -> "ShareServiceClient":
+    """Retrieve the File Share service client for a storage account."""
+    with _lock:
+        share_service = _share_services.get(conn_str)
+        if share_service is None:
+            share_service = _fileshare_sdk.ShareServiceClient.from_connection_string(
+                conn_str
+            )
+            _share_services[conn_str] = share_service
+
+    return share_service
+
+
+def ensure_share(conn_str: str, share_name: str) -> None:
+    """Create a File Share in a storage account unless it already exists.
+
+    Meant for the shares the functions own, as opposed to ensure_table which
+    only checks for tables that are provisioned with the app.
+    """
+    if (conn_str, share_name) in _existing_shares:
+        return
+
+    with exceptions.span("file_share.create"):
+        try:
+            get_share_service(conn_str).create_share(share_name)
+        except ResourceExistsError:
+            pass
+
+    with _lock:
+        _existing_shares.add((conn_str, share_name))
+
+
+def get_file_client(
+    conn_str: str, share_name: str, file_path: str
+) -> "ShareFileClient":
+    """Build a file client sharing the connection pool of its storage account.
+
+    Parameters
+    ----------
+    conn_str
+        Connection string to the storage account.
+    share_name
+        Name of the file share.
+    file_path
+        Path to the file relative to the root of the share.
+    """
+    return (
+        get_share_service(conn_str)
+        .get_share_client(share_name)
+        .get_file_client(file_path)
+    )
+
+
+def get_directory_client(
+    conn_str: str, share_name: str, directory_path: str
+) -> "ShareDirectoryClient":
+    """Build a directory client sharing the connection pool of its account."""
+    return (
+        get_share_service(conn_str)
+        .get_share_client(share_name)
+        .get_directory_client(directory_path)
+    )
+
+
+def get_adf_client() -> "DataFactoryManagementClient":
+    """Retrieve the Data Factory client for the subscription in the env variables.
+
+    The service principal token is refreshed by the credentials object itself
+    when it expires, so the client can be kept for the life of the worker.
+    """
+    key = (
+        os.environ["AZURE_CLIENT_ID"],
+        os.environ["AZURE_CLIENT_SECRET"],
+        os.environ["AZURE_TENANT_ID"],
+        os.environ["subscription_id"],
+    )
+    with _lock:
+        adf_client = _adf_clients.get(key)
+        if adf_client is None:
+            client_id, secret, tenant, subscription_id = key
+            # DefaultAzureCredential does not work when manipulating ADF. It will
+            # complain about a missing session method.
+            # Remember to give the contributor role to the application.
+            # Azure Portal -> Subscriptions -> IAM roles
+            credentials = _credentials_sdk.ServicePrincipalCredentials(
+                client_id=client_id, secret=secret, tenant=tenant,
+            )
+            adf_client = _datafactory_sdk.DataFactoryManagementClient(
+                credentials, subscription_id
+            )
+            _adf_clients[key] = adf_client
+
+    return adf_client
+
+
+def _close(client: Any) -> None:
+    try:
+        if hasattr(client, "_httpclient"):
+            client._httpclient.session.close()
+        else:
+            client.close()
+    except Exception:
+        pass
+
+
+def reset() -> None:
+    """Close every client and forget the memoized table and share checks."""
+    with _lock:
+        for registry in (_table_services, _share_services, _adf_clients):
+            for client in registry.values():
+                _close(client)
+            registry.clear()
+        _existing_tables.clear()
+        _existing_shares.clear()
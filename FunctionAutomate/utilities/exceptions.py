@@ -1,10 +1,27 @@
+"""Decorators for the HTTP entry points of the functions.
+
+Besides turning HttpErrors into responses, the decorators can trace every
+invocation. Stages of the work are timed with span and extra facts (cache
+hits, payload sizes...) are recorded with annotate. At the end of the
+invocation a single structured log record with all of it is emitted.
+
+Tracing is enabled with the optional TRACE_INVOCATIONS env variable set to 1.
+When disabled span and annotate return straight away.
+"""
+import contextlib
+import json
 import logging
-from typing import Callable
+import os
+import threading
+import time
+from contextvars import ContextVar, Token
+from typing import Any, Awaitable, Callable, ContextManager, Dict, Optional, Tuple
 from functools import wraps
 
 import azure.functions as func
 
 mainAlias = Callable[[func.HttpRequest], func.HttpResponse]
+asyncMainAlias = Callable[[func.HttpRequest], Awaitable[func.HttpResponse]]
 
 class HttpError(Exception):
     """Exception that also stores an HttpResponse describing the failutre.
@@ -17,6 +34,106 @@ class HttpError(Exception):
         self.response = response
 
 
+class Trace:
+    """Stage timings and annotations of a single invocation."""
+
+    def __init__(self, function_name: str) -> None:
+        self.function_name = function_name
+        self.started_at = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.attributes: Dict[str, Any] = {}
+        # Stages can run in the executor threads of the asyncio entry points.
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        """Accumulate the time spent in a stage."""
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def annotate(self, attributes: Dict[str, Any]) -> None:
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def record(self, status_code: int) -> Dict[str, Any]:
+        """Summary of the invocation to be logged."""
+        with self._lock:
+            return {
+                "function": self.function_name,
+                "status_code": status_code,
+                "total_ms": round((time.perf_counter() - self.started_at) * 1000, 3),
+                "stages_ms": {k: round(v * 1000, 3) for k, v in self.stages.items()},
+                **self.attributes,
+            }
+
+
+class _Span:
+    __slots__ = ("trace", "name", "started_at")
+
+    def __init__(self, trace: Trace, name: str) -> None:
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.started_at = time.perf_counter()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.trace.add_stage(self.name, time.perf_counter() - self.started_at)
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_no_span = contextlib.nullcontext()
+
+
+def tracing_enabled() -> bool:
+    """Check if the current invocation is being traced.
+
+    Useful to skip computing annotations that are expensive to obtain.
+    """
+    return _current_trace.get() is not None
+
+
+def span(name: str) -> ContextManager[None]:
+    """Time a stage of the current invocation.
+
+    Stages with the same name are added up.
+
+    Parameters
+    ----------
+    name
+        Name of the stage, e.g. "smtp.send" or "table.get".
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _no_span
+
+    return _Span(trace, name)
+
+
+def annotate(**attributes: Any) -> None:
+    """Attach facts such as cache hits or payload sizes to the current trace."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.annotate(attributes)
+
+
+def _begin_trace(main: Callable) -> Tuple[Optional[Trace], Optional[Token]]:
+    if os.environ.get("TRACE_INVOCATIONS", "0").lower() not in ("1", "true"):
+        return None, None
+
+    trace = Trace(main.__module__.rsplit(".", 1)[-1])
+    return trace, _current_trace.set(trace)
+
+
+def _end_trace(
+    trace: Optional[Trace], token: Optional[Token], status_code: int
+) -> None:
+    if trace is None:
+        return
+
+    _current_trace.reset(token)
+    logging.info(f"Invocation trace: {json.dumps(trace.record(status_code))}")
+
+
 def exceptions_as_response(main: mainAlias) -> mainAlias:
     """Decorate the main entry point of an Azure function.
 
@@ -25,15 +142,48 @@ def exceptions_as_response(main: mainAlias) -> mainAlias:
     """
     @wraps(main)
     def main_with_responses(req: func.HttpRequest) -> func.HttpResponse:
+        trace, token = _begin_trace(main)
+        status_code = 500
         try:
-            return main(req)
+            response = main(req)
+            status_code = response.status_code
+            return response
         except HttpError as e:
             # HttpErrors exceptions automatically end executing and return
             # the response wrapped by the exception.
             logging.info(str(e))
+            status_code = e.response.status_code
+            return e.response
+        except Exception as e:
+            logging.info(str(e))
+            raise e
+        finally:
+            _end_trace(trace, token, status_code)
+
+    return main_with_responses
+
+
+def exceptions_as_response_async(main: asyncMainAlias) -> asyncMainAlias:
+    """Decorate the asyncio main entry point of an Azure function.
+
+    Counterpart of exceptions_as_response for coroutine functions.
+    """
+    @wraps(main)
+    async def main_with_responses(req: func.HttpRequest) -> func.HttpResponse:
+        trace, token = _begin_trace(main)
+        status_code = 500
+        try:
+            response = await main(req)
+            status_code = response.status_code
+            return response
+        except HttpError as e:
+            logging.info(str(e))
+            status_code = e.response.status_code
             return e.response
         except Exception as e:
             logging.info(str(e))
             raise e
+        finally:
+            _end_trace(trace, token, status_code)
 
     return main_with_responses
@@ -0,0 +1,215 @@
+"""Cached access to Key Vault secrets.
+
+Building a DefaultAzureCredential probes the whole credential chain and the
+first request of every new SecretClient has to acquire an AAD token. One
+credential and one client are kept per vault instead, and the secret values
+themselves are cached for a configurable time.
+
+The aio client of the asyncio entry points holds an HTTP session, which is
+closed, along with its credential, when the worker shuts down.
+
+Optional env variables:
+- KEY_VAULT_SECRET_TTL_SECONDS: Seconds a secret value is cached for.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Set, Tuple
+
+from __app__.utilities import aio
+from __app__.utilities import exceptions
+from __app__.utilities import lazy
+
+if TYPE_CHECKING:
+    from azure.identity.aio import DefaultAzureCredential as AsyncCredential
+    from azure.keyvault.secrets.aio import SecretClient as AsyncSecretClient
+
+# Only needed once a secret is requested, see utilities.lazy.
+_identity_sdk = lazy.lazy_import("azure.identity")
+_identity_aio_sdk = lazy.lazy_import("azure.identity.aio")
+_secrets_sdk = lazy.lazy_import("azure.keyvault.secrets")
+_secrets_aio_sdk = lazy.lazy_import("azure.keyvault.secrets.aio")
+
+
+class SecretProvider:
+    """Cache of the secrets of a single Key Vault.
+
+    Secrets older than ttl seconds are fetched again before being returned.
+    Secrets that are used after refresh_ahead * ttl seconds are refreshed in
+    the background so that frequently used ones never expire on the hot path.
+    """
+
+    def __init__(
+        self, vault_url: str, ttl: float, refresh_ahead: float = 0.8
+    ) -> None:
+        """Init the provider.
+
+        Parameters
+        ----------
+        vault_url
+            URI of the Key Vault.
+        ttl
+            Seconds a secret value is cached for.
+        refresh_ahead
+            Fraction of the ttl after which a used secret is refreshed in the
+            background.
+        """
+        self.vault_url = vault_url
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._client = _secrets_sdk.SecretClient(
+            vault_url=vault_url, credential=_identity_sdk.DefaultAzureCredential()
+        )
+        self._async_client: Optional["AsyncSecretClient"] = None
+        self._async_credential: Optional["AsyncCredential"] = None
+        # Created by the event loop, see _get_async_client.
+        self._async_lock: Optional[asyncio.Lock] = None
+        self._secrets: Dict[str, Tuple[str, float]] = {}
+        self._refreshing: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def _fetch(self, name: str) -> str:
+        value = self._client.get_secret(name).value
+        with self._lock:
+            self._secrets[name] = (value, time.monotonic())
+
+        return value
+
+    def _refresh(self, name: str) -> None:
+        try:
+            self._fetch(name)
+        except Exception as e:
+            logging.info(f"Could not refresh secret {name}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(name)
+
+    def get(self, name: str) -> str:
+        """Retrieve the value of a secret.
+
+        Parameters
+        ----------
+        name
+            Name of the secret in the Key Vault.
+        """
+        value = self._cached(name)
+        exceptions.annotate(secret_cache_hit=value is not None)
+        if value is None:
+            with exceptions.span("keyvault.get_secret"):
+                value = self._fetch(name)
+
+        return value
+
+    async def get_async(self, name: str) -> str:
+        """Counterpart of get using the aio Key Vault client on cache misses."""
+        value = self._cached(name)
+        exceptions.annotate(secret_cache_hit=value is not None)
+        if value is None:
+            client = await self._get_async_client()
+            with exceptions.span("keyvault.get_secret"):
+                value = (await client.get_secret(name)).value
+            with self._lock:
+                self._secrets[name] = (value, time.monotonic())
+
+        return value
+
+    async def _get_async_client(self) -> "AsyncSecretClient":
+        """Create the aio client on first use, once for concurrent callers."""
+        # No await between the check and the assignment, so no race either.
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            if self._async_client is None:
+                self._async_credential = _identity_aio_sdk.DefaultAzureCredential()
+                self._async_client = _secrets_aio_sdk.SecretClient(
+                    vault_url=self.vault_url, credential=self._async_credential
+                )
+
+        return self._async_client
+
+    async def close_async(self) -> None:
+        """Close the aio client and its credential, if they were created."""
+        if self._async_lock is None:
+            return
+        async with self._async_lock:
+            client, self._async_client = self._async_client, None
+            credential, self._async_credential = self._async_credential, None
+        if client is not None:
+            await client.close()
+        if credential is not None:
+            await credential.close()
+
+    def _cached(self, name: str) -> Optional[str]:
+        """Look a secret up in the cache.
+
+        Returns None if the secret is not cached or has expired. Secrets close
+        to expiring are refreshed in the background.
+        """
+        with self._lock:
+            value, fetched_at = self._secrets.get(name, (None, 0.0))
+        age = time.monotonic() - fetched_at
+
+        if value is None or age >= self.ttl:
+            return None
+
+        if age >= self.ttl * self.refresh_ahead:
+            with self._lock:
+                start_refresh = name not in self._refreshing
+                self._refreshing.add(name)
+            if start_refresh:
+                threading.Thread(
+                    target=self._refresh, args=(name,), daemon=True
+                ).start()
+
+        return value
+
+    def prefetch(self, names: Iterable[str]) -> None:
+        """Fetch concurrently a set of secrets into the cache.
+
+        Secrets that can't be fetched are logged and skipped.
+
+        Parameters
+        ----------
+        names
+            Names of the secrets in the Key Vault.
+        """
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for name in set(names):
+                executor.submit(self._refresh, name)
+
+
+_providers: Dict[str, SecretProvider] = {}
+_providers_lock = threading.Lock()
+
+
+def get_secret_provider(vault_url: str) -> SecretProvider:
+    """Retrieve the process wide SecretProvider of a Key Vault.
+
+    Parameters
+    ----------
+    vault_url
+        URI of the Key Vault.
+    """
+    with _providers_lock:
+        if vault_url not in _providers:
+            _providers[vault_url] = SecretProvider(
+                vault_url,
+                ttl=float(os.environ.get("KEY_VAULT_SECRET_TTL_SECONDS", 3600)),
+            )
+
+        return _providers[vault_url]
+
+
+async def close_async() -> None:
+    """Close the aio clients of every SecretProvider."""
+    with _providers_lock:
+        providers = list(_providers.values())
+
+    for provider in providers:
+        await provider.close_async()
+
+
+aio.on_shutdown(close_async)
@@ -0,0 +1,64 @@
+"""Deferred imports of heavy dependencies.
+
+The Azure SDKs take hundreds of milliseconds to import and every one of them
+adds to the cold start of a function. Modules that are only needed on some
+branches are imported through lazy_import, which returns a stand-in that
+performs the actual import the first time one of its attributes is used.
+
+Names only needed for type annotations are imported under TYPE_CHECKING
+instead.
+
+The time spent in each deferred import is recorded so that it can be
+reported by the cold start benchmark.
+"""
+import importlib
+import threading
+import time
+from types import ModuleType
+from typing import Any, Dict, Optional
+
+_load_times: Dict[str, float] = {}
+
+
+class LazyModule:
+    """Stand-in for a module that is imported on first attribute access."""
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module: Optional[ModuleType] = None
+        self._lock = threading.Lock()
+
+    def load(self) -> ModuleType:
+        """Import the module if not done yet and return it."""
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started_at = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    _load_times[self._name] = time.perf_counter() - started_at
+                    self._module = module
+
+        return self._module
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.load(), name)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """Defer the import of a module until it is first used.
+
+    Parameters
+    ----------
+    name
+        Absolute name of the module, e.g. "azure.mgmt.datafactory".
+    """
+    return LazyModule(name)
+
+
+def load_times() -> Dict[str, float]:
+    """Seconds spent importing each deferred module loaded so far."""
+    return dict(_load_times)
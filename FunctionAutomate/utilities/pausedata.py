@@ -0,0 +1,282 @@
+"""Layout of the PipelinePauseData table shared by the pipeline functions.
+
+Entities are spread over several partitions to stay clear of the throughput
+cap of a single Table partition. The partition of an entity is derived from
+its token (the RowKey) so that it can be computed again from the token alone
+and lookups remain point reads.
+
+Entities written before sharding was introduced live in the legacy
+"PauseData" partition. Lookups fall back to it when the entity is not found
+in its sharded partition.
+
+The data of a pause is stored inline, as JSON in the data property, unless
+it is large. Larger payloads are gzipped into the data_gzip binary property
+and, if they still don't fit in a Table property, uploaded gzipped to a File
+Share and referenced from data_ref. The data_encoding property tells which
+one is used. Consumers that need the data read it with get_paused_data, the
+rest select the properties they need and never pay for it.
+
+Optional env variables:
+- PAUSE_PARTITION_BUCKETS: Number of partitions entities are spread over.
+    Changing it once tokens have been written makes the outstanding tokens
+    unreachable, so pick it once.
+- PAUSE_DATA_COMPRESS_BYTES: Size of the JSON payloads above which they are
+    compressed.
+- PAUSE_DATA_SHARE: File Share large payloads are offloaded to. It is
+    created on first use.
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import secrets
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from __app__.utilities import clients, exceptions, lazy
+
+from azure.common import AzureMissingResourceHttpError
+from azure.core.exceptions import ResourceNotFoundError
+
+if TYPE_CHECKING:
+    from azure.cosmosdb.table.tableservice import TableService
+
+# Only needed when a token is checked, see utilities.lazy.
+pytz = lazy.lazy_import("pytz")
+_table_models = lazy.lazy_import("azure.cosmosdb.table.models")
+
+TARGET_TABLE = "PipelinePauseData"
+LEGACY_PARTITION_KEY = "PauseData"
+
+# Tokens are the unpadded URL safe base64 encoding of TOKEN_BYTES random bytes.
+TOKEN_BYTES = 64
+_TOKEN_PATTERN = re.compile(f"[A-Za-z0-9_-]{{{math.ceil(TOKEN_BYTES * 4 / 3)}}}")
+
+
+def new_token() -> str:
+    """Generate the token identifying a new paused pipeline."""
+    return secrets.token_urlsafe(TOKEN_BYTES)
+
+
+def is_well_formed(token: Any) -> bool:
+    """Check if a value could be a token issued by new_token.
+
+    Meant to reject garbage before any storage is touched.
+    """
+    return isinstance(token, str) and _TOKEN_PATTERN.fullmatch(token) is not None
+
+
+def partition_key(token: str, buckets: Optional[int] = None) -> str:
+    """Compute the partition key of the entity for a token.
+
+    Parameters
+    ----------
+    token
+        Token identifying the paused pipeline. It is also the RowKey.
+    buckets
+        Number of partitions. Read from PAUSE_PARTITION_BUCKETS if not given.
+        With a single bucket the legacy partition is used.
+    """
+    if buckets is None:
+        buckets = int(os.environ.get("PAUSE_PARTITION_BUCKETS", 16))
+    if buckets <= 1:
+        return LEGACY_PARTITION_KEY
+
+    digest = hashlib.sha256(token.encode("utf-8")).digest()
+    bucket = int.from_bytes(digest[:4], "big") % buckets
+
+    return f"{LEGACY_PARTITION_KEY}-{bucket:03d}"
+
+
+def candidate_partition_keys(token: str) -> List[str]:
+    """Partition keys where the entity for a token may live, in lookup order."""
+    sharded = partition_key(token)
+    if sharded == LEGACY_PARTITION_KEY:
+        return [LEGACY_PARTITION_KEY]
+
+    return [sharded, LEGACY_PARTITION_KEY]
+
+
+def get_paused_pipeline(
+    table_service: "TableService", token: str, select: Optional[str] = None
+) -> Dict[str, Any]:
+    """Retrieve the entity for a token.
+
+    Parameters
+    ----------
+    table_service
+        Table service for the storage account.
+    token
+        Token identifying the paused pipeline.
+    select
+        Comma separated list of the properties to retrieve. All by default.
+
+    Raise
+    -----
+    Raises AzureMissingResourceHttpError if there is no entity for the token.
+    """
+    *sharded, legacy = candidate_partition_keys(token)
+    with exceptions.span("table.get"):
+        for key in sharded:
+            try:
+                return table_service.get_entity(
+                    TARGET_TABLE, key, token, select=select
+                )
+            except AzureMissingResourceHttpError:
+                pass
+
+        exceptions.annotate(legacy_partition=True)
+        return table_service.get_entity(TARGET_TABLE, legacy, token, select=select)
+
+
+# Maximum size of a binary Table property.
+MAX_PROPERTY_BYTES = 64 * 1024
+DATA_PROPERTIES = ["data", "data_encoding", "data_gzip", "data_ref"]
+
+
+def encode_data(token: str, data: Any) -> Dict[str, Any]:
+    """Properties storing the data of a pause on its entity.
+
+    Small payloads are stored inline. Larger ones are compressed and, if
+    needed, offloaded to the PAUSE_DATA_SHARE File Share, see the module
+    docstring.
+
+    Parameters
+    ----------
+    token
+        Token identifying the paused pipeline. Names the offloaded file.
+    data
+        JSON serializable payload of the pause.
+    """
+    serialized = json.dumps(data)
+    raw = serialized.encode("utf-8")
+    exceptions.annotate(data_bytes=len(raw))
+    if len(raw) <= int(os.environ.get("PAUSE_DATA_COMPRESS_BYTES", 8192)):
+        return {"data": serialized}
+
+    compressed = gzip.compress(raw)
+    if len(compressed) <= MAX_PROPERTY_BYTES:
+        return {
+            "data_encoding": "gzip",
+            "data_gzip": _table_models.EntityProperty(
+                _table_models.EdmType.BINARY, compressed
+            ),
+        }
+
+    share_name = os.environ.get("PAUSE_DATA_SHARE", "pipeline-pause-data")
+    file_path = f"{token}.json.gz"
+    clients.ensure_share(os.environ["AzureWebJobsStorage"], share_name)
+    with exceptions.span("file_share.upload"):
+        clients.get_file_client(
+            conn_str=os.environ["AzureWebJobsStorage"],
+            share_name=share_name,
+            file_path=file_path,
+        ).upload_file(compressed)
+
+    return {"data_encoding": "file", "data_ref": f"{share_name}/{file_path}"}
+
+
+def load_data(entity: Dict[str, Any]) -> Any:
+    """Decode the data of a pause from the properties set by encode_data.
+
+    Parameters
+    ----------
+    entity
+        Entity with, at least, the DATA_PROPERTIES it has.
+    """
+    encoding = entity.get("data_encoding")
+    if encoding is None:
+        return json.loads(entity["data"])
+
+    if encoding == "gzip":
+        compressed = entity["data_gzip"]
+        # The Table SDK returns binary properties wrapped in an EntityProperty.
+        compressed = getattr(compressed, "value", compressed)
+    elif encoding == "file":
+        share_name, file_path = entity["data_ref"].split("/", 1)
+        with exceptions.span("file_share.download"):
+            compressed = (
+                clients.get_file_client(
+                    conn_str=os.environ["AzureWebJobsStorage"],
+                    share_name=share_name,
+                    file_path=file_path,
+                )
+                .download_file()
+                .readall()
+            )
+    else:
+        raise ValueError(f"Unknown pause data encoding {encoding}")
+
+    return json.loads(gzip.decompress(compressed))
+
+
+def get_paused_data(table_service: "TableService", token: str) -> Any:
+    """Retrieve and decode the data of a pause.
+
+    Raise
+    -----
+    Raises AzureMissingResourceHttpError if there is no entity for the token.
+    """
+    entity = get_paused_pipeline(table_service, token, select=",".join(DATA_PROPERTIES))
+
+    return load_data(entity)
+
+
+def delete_offloaded_data(entity: Dict[str, Any]) -> bool:
+    """Delete the File Share copy of the data of a pause, if it has one.
+
+    Returns
+    -------
+    Whether a file was deleted.
+    """
+    if entity.get("data_encoding") != "file":
+        return False
+
+    share_name, file_path = entity["data_ref"].split("/", 1)
+    try:
+        clients.get_file_client(
+            conn_str=os.environ["AzureWebJobsStorage"],
+            share_name=share_name,
+            file_path=file_path,
+        ).delete_file()
+    except ResourceNotFoundError:
+        return False
+
+    return True
+
+
+def expires_at(expiration_time: int) -> datetime.datetime:
+    """UTC time at which a pause written now expires.
+
+    It is stored along with expiration_time so that pauses can be filtered
+    by expiry server side, see PipelinePauseList.
+    """
+    now = pytz.utc.localize(datetime.datetime.now())
+    return now + datetime.timedelta(seconds=expiration_time)
+
+
+def check_if_expired(timestamp: datetime.datetime, expiration_time: int) -> bool:
+    """
+    Check if a timestamp is older than the current time.
+
+    The current time is obtained through a call to datetime.now() and localized to
+    UTC as that is what the Azure cloud uses for its timestamps.
+
+    Parameters
+    ----------
+    timestamp
+        UTC time-zone aware timestamp.
+    expiration_time
+        Time to expiration in seconds.
+
+    Returns
+    -------
+    Has the timestamp expired?
+    """
+    expiration_timestamp = timestamp + datetime.timedelta(seconds=expiration_time)
+    current_time = pytz.utc.localize(datetime.datetime.now())
+
+    has_expired = current_time > expiration_timestamp
+    return has_expired
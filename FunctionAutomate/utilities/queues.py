@@ -0,0 +1,196 @@
+"""Message queues used to hand work over between functions.
+
+In Azure the queues are Storage Queues. For tests and local benchmarks they
+can be replaced by an in-memory stand-in with the same interface by setting
+the env variable QUEUE_BACKEND to "local".
+"""
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, NamedTuple, Tuple, Union
+
+from __app__.utilities import lazy
+
+from azure.core.exceptions import ResourceExistsError
+
+# Only needed when messages are queued, see utilities.lazy.
+_queue_sdk = lazy.lazy_import("azure.storage.queue")
+
+
+# Storage Queues reject messages larger than this once base64 encoded.
+MAX_MESSAGE_BYTES = 64 * 1024
+
+
+def encoded_size(content: str) -> int:
+    """Size of a message once base64 encoded, as it is sent to the queue."""
+    return 4 * math.ceil(len(content.encode("utf-8")) / 3)
+
+
+class QueueMessage(NamedTuple):
+    id: str
+    pop_receipt: str
+    content: str
+    dequeue_count: int
+
+
+class StorageQueue:
+    """Azure Storage Queue.
+
+    Messages are base64 encoded which is what queue triggered functions
+    expect by default. The queue is created on first use if needed.
+    """
+
+    def __init__(self, conn_str: str, queue_name: str) -> None:
+        """Init the queue.
+
+        Parameters
+        ----------
+        conn_str
+            Connection string to the storage account.
+        queue_name
+            Name of the queue.
+        """
+        self._client = _queue_sdk.QueueClient.from_connection_string(
+            conn_str=conn_str,
+            queue_name=queue_name,
+            message_encode_policy=_queue_sdk.TextBase64EncodePolicy(),
+            message_decode_policy=_queue_sdk.BinaryBase64DecodePolicy(),
+        )
+        try:
+            self._client.create_queue()
+        except ResourceExistsError:
+            pass
+
+    def send(self, content: str, visibility_timeout: int = 0) -> None:
+        """Put a message in the queue.
+
+        Parameters
+        ----------
+        content
+            Body of the message.
+        visibility_timeout
+            Seconds before the message can be received.
+        """
+        self._client.send_message(
+            content, visibility_timeout=visibility_timeout, time_to_live=-1
+        )
+
+    def receive(
+        self, max_messages: int = 32, visibility_timeout: int = 300
+    ) -> List[QueueMessage]:
+        """Take up to max_messages visible messages from the queue.
+
+        Received messages are hidden for visibility_timeout seconds and have
+        to be deleted once processed or they will be received again.
+        """
+        return [
+            QueueMessage(
+                msg.id,
+                msg.pop_receipt,
+                msg.content.decode("utf-8"),
+                msg.dequeue_count,
+            )
+            for msg in self._client.receive_messages(
+                messages_per_page=max_messages,
+                visibility_timeout=visibility_timeout,
+                max_messages=max_messages,
+            )
+        ]
+
+    def delete(self, message: QueueMessage) -> None:
+        """Remove a received message from the queue."""
+        self._client.delete_message(message.id, message.pop_receipt)
+
+
+class LocalQueue:
+    """In-memory stand-in for a Storage Queue with the same interface."""
+
+    def __init__(self) -> None:
+        self._visible_at: List[Tuple[float, int, str]] = []
+        self._messages: Dict[str, Tuple[str, int]] = {}
+        self._receipts: Dict[str, str] = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def send(self, content: str, visibility_timeout: int = 0) -> None:
+        # Same limit as a Storage Queue so that oversized messages fail here too.
+        if encoded_size(content) > MAX_MESSAGE_BYTES:
+            raise ValueError("The message is larger than the queue limit")
+
+        message_id = uuid.uuid4().hex
+        visible_at = time.monotonic() + visibility_timeout
+        with self._lock:
+            self._messages[message_id] = (content, 0)
+            heapq.heappush(
+                self._visible_at, (visible_at, next(self._counter), message_id)
+            )
+
+    def receive(
+        self, max_messages: int = 32, visibility_timeout: int = 300
+    ) -> List[QueueMessage]:
+        received = []
+        now = time.monotonic()
+        with self._lock:
+            while (
+                self._visible_at
+                and self._visible_at[0][0] <= now
+                and len(received) < max_messages
+            ):
+                _, _, message_id = heapq.heappop(self._visible_at)
+                if message_id not in self._messages:
+                    continue
+                content, dequeue_count = self._messages[message_id]
+                self._messages[message_id] = (content, dequeue_count + 1)
+                pop_receipt = uuid.uuid4().hex
+                self._receipts[message_id] = pop_receipt
+                heapq.heappush(
+                    self._visible_at,
+                    (now + visibility_timeout, next(self._counter), message_id),
+                )
+                received.append(
+                    QueueMessage(message_id, pop_receipt, content, dequeue_count + 1)
+                )
+
+        return received
+
+    def delete(self, message: QueueMessage) -> None:
+        with self._lock:
+            if self._receipts.get(message.id) == message.pop_receipt:
+                self._messages.pop(message.id, None)
+                self._receipts.pop(message.id, None)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+
+Queue = Union[StorageQueue, LocalQueue]
+
+_queues: Dict[str, Queue] = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(queue_name: str) -> Queue:
+    """Retrieve the process wide client for a queue.
+
+    Which backend is used is decided by the QUEUE_BACKEND env variable. Storage
+    Queues in the AzureWebJobsStorage account are used unless it is "local".
+
+    Parameters
+    ----------
+    queue_name
+        Name of the queue.
+    """
+    with _queues_lock:
+        if queue_name not in _queues:
+            if os.environ.get("QUEUE_BACKEND", "azure") == "local":
+                _queues[queue_name] = LocalQueue()
+            else:
+                _queues[queue_name] = StorageQueue(
+                    os.environ["AzureWebJobsStorage"], queue_name
+                )
+
+        return _queues[queue_name]
@@ -0,0 +1,140 @@
+"""Declarative parsing of the parameters of incoming requests.
+
+The parameters of a request can come from its query string or from its JSON
+body. The body is decoded once and merged with the query string, the query
+string taking precedence like in utilities.get_param. The merged parameters
+are then checked against a list of Fields in a single pass, so that every
+missing or malformed parameter is reported at once.
+"""
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Union,
+)
+
+from __app__.utilities import exceptions
+
+import azure.functions as func
+
+
+class Field(NamedTuple):
+    """Description of a request parameter.
+
+    A parameter that is absent, null or an empty string is considered to be
+    missing. Missing optional parameters take the default value, which is not
+    coerced.
+    """
+
+    name: str
+    required: bool = False
+    default: Any = None
+    coerce: Optional[Callable[[Any], Any]] = None
+
+
+def comma_separated(value: Union[str, List[str]]) -> List[str]:
+    """Coerce a list or a comma separated string into a list of strings."""
+    if isinstance(value, str):
+        return value.split(",")
+    if isinstance(value, list):
+        return [str(x) for x in value]
+
+    raise ValueError("expected a list or a comma separated string")
+
+
+def json_list(value: Any) -> List[Any]:
+    """Check that a parameter is a list."""
+    if not isinstance(value, list):
+        raise ValueError("expected a list")
+
+    return value
+
+
+def request_params(req: func.HttpRequest) -> Dict[str, Any]:
+    """Merge the query string and the JSON body of a request.
+
+    The body is decoded once. A body that is not a JSON object is ignored.
+    """
+    exceptions.annotate(request_bytes=len(req.get_body()))
+    with exceptions.span("request.parse"):
+        try:
+            body = req.get_json()
+        except ValueError:
+            body = None
+
+    params = dict(body) if isinstance(body, dict) else {}
+    params.update({k: v for k, v in req.params.items() if v})
+
+    return params
+
+
+def _is_missing(value: Any) -> bool:
+    return value is None or value == ""
+
+
+def parse(
+    source: Union[func.HttpRequest, Mapping[str, Any]],
+    fields: Sequence[Field],
+    context: str = "",
+) -> Dict[str, Any]:
+    """Extract and validate the parameters described by fields.
+
+    Parameters
+    ----------
+    source
+        Incoming request or parameters already merged with request_params.
+    fields
+        Parameters to extract.
+    context
+        Appended to the error message to locate the parameters, e.g. the
+        index of an item within a batch.
+
+    Returns
+    -------
+    Dictionary with one entry per field.
+
+    Raise
+    -----
+    Raises an exceptions.HttpError listing every missing and malformed
+    parameter.
+    """
+    params = request_params(source) if isinstance(source, func.HttpRequest) else source
+    location = f" in {context}." if context else "."
+    if not isinstance(params, Mapping):
+        msg = "Parameters must be a JSON object" + location
+        raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=500))
+
+    parsed: Dict[str, Any] = {}
+    missing = []
+    invalid = []
+    for field in fields:
+        value = params.get(field.name)
+        if _is_missing(value):
+            if field.required:
+                missing.append(field.name)
+            parsed[field.name] = field.default
+            continue
+
+        if field.coerce is not None:
+            try:
+                value = field.coerce(value)
+            except (TypeError, ValueError) as e:
+                invalid.append(f"{field.name} ({e})")
+                continue
+        parsed[field.name] = value
+
+    if missing or invalid:
+        problems = []
+        if missing:
+            problems.append(f"Missing parameters: {', '.join(missing)}")
+        if invalid:
+            problems.append(f"Invalid parameters: {', '.join(invalid)}")
+        msg = ". ".join(problems) + location
+        raise exceptions.HttpError(msg, func.HttpResponse(msg, status_code=500))
+
+    return parsed
@@ -0,0 +1,53 @@
+"""Client side throttling.
+"""
+import threading
+import time
+
+
+class RateLimiter:
+    """Token bucket limiting the rate of some operation.
+
+    Callers ask for permission to perform a number of operations and are made
+    to wait until the bucket holds enough tokens. The bucket refills at rate
+    tokens per second and holds at most burst tokens. A rate of 0 or less
+    disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0) -> None:
+        """Init the limiter.
+
+        Parameters
+        ----------
+        rate
+            Sustained number of operations per second. Unlimited if not
+            positive.
+        burst
+            Number of operations that can be performed at once after a
+            period of inactivity.
+        """
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, operations: float = 1.0) -> None:
+        """Block until the given number of operations can be performed.
+
+        Asking for more operations than the burst size is allowed, the caller
+        then waits for the whole amount to accumulate.
+        """
+        if self.rate <= 0:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            self._tokens -= operations
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
@@ -2,12 +2,14 @@
 
 Author: Guillem Ballesteros
 """
-from typing import Any, Dict, List, Tuple
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
 
-from __app__.utilities import exceptions
+from __app__.utilities import clients
 
 import azure.functions as func
-from azure.cosmosdb.table.tableservice import TableService
+
+if TYPE_CHECKING:
+    from azure.cosmosdb.table.tableservice import TableService
 
 
 def get_param(request: func.HttpRequest, param_name: str) -> Any:
@@ -70,9 +72,12 @@ def extract_storage_parameters(conn_str: str) -> Dict[str, str]:
     return params
 
 
-def setup_table_service(conn_str: str, target_table: str) -> TableService:
+def setup_table_service(conn_str: str, target_table: str) -> "TableService":
     """Setup a Table Service for a the target_table.
 
+    The Table Service and the existence check of the table are shared by every
+    invocation of the worker, see utilities.clients.
+
     Parameters
     ----------
     conn_str
@@ -85,16 +90,6 @@ def setup_table_service(conn_str: str, target_table: str) -> TableService:
     Raises an exceptions.HttpError if the table was not found in the storage
     account.
     """
-    storage_params = extract_storage_parameters(conn_str)
-    table_service = TableService(
-        account_name=storage_params["AccountName"],
-        account_key=storage_params["AccountKey"],
-    )
-
-    if not table_service.exists(target_table):
-        msg = f"Table {target_table} to store request info did not exist."
-        raise exceptions.HttpError(
-            msg, func.HttpResponse(msg, status_code=500),
-        )
-
-    return table_service
+    clients.ensure_table(conn_str, target_table)
+
+    return clients.get_table_service(conn_str)
@@ -0,0 +1,41 @@
+"""Make the function app importable outside of the Functions host.
+
+The Functions host exposes the function app folder as the __app__ package,
+which is how the functions import each other. The benchmarks run the
+functions in a plain interpreter, so __app__ is mapped onto the
+FunctionAutomate package instead.
+"""
+import importlib
+import importlib.abc
+import importlib.util
+import os
+import sys
+from types import ModuleType
+from typing import Any, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _AppAlias(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """Resolve __app__.X to FunctionAutomate.X so modules are loaded once."""
+
+    def find_spec(
+        self, fullname: str, path: Any, target: Any = None
+    ) -> Optional[importlib.machinery.ModuleSpec]:
+        if fullname == "__app__" or fullname.startswith("__app__."):
+            return importlib.util.spec_from_loader(fullname, self)
+        return None
+
+    def create_module(self, spec: importlib.machinery.ModuleSpec) -> ModuleType:
+        return importlib.import_module("FunctionAutomate" + spec.name[7:])
+
+    def exec_module(self, module: ModuleType) -> None:
+        pass
+
+
+def install_app_alias() -> None:
+    """Make __app__ importable. Safe to call more than once."""
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    if not any(isinstance(finder, _AppAlias) for finder in sys.meta_path):
+        sys.meta_path.insert(0, _AppAlias())
@@ -0,0 +1,301 @@
+"""Cold start benchmark of the function app entry points.
+
+Every sample runs in a fresh interpreter and measures, for each function:
+- import_seconds: Importing the function module, which the host does before
+    the first invocation. azure.functions is imported beforehand since the
+    host has it loaded already.
+- first_invocation_seconds: First successful call of main against the
+    stand-ins of fakes.py, with the requests of the throughput scenarios.
+    The time spent importing deferred SDKs is left out, it is reported below.
+- deferred_seconds: Importing, in another fresh interpreter, the SDKs that
+    the first invocation deferred to first use (see utilities.lazy). Those
+    are the lazy modules it loaded plus the ones the clients replaced by the
+    stand-ins would have loaded, so the list follows the code.
+
+The median over all samples is reported as JSON. With --baseline the results
+are compared against a previous run and the script exits with status 1 if any
+of the timings regressed by more than the tolerance.
+
+Usage:
+    python benchmarks/cold_start.py --repeat 5 --output cold_start.json
+    python benchmarks/cold_start.py --baseline cold_start.json
+"""
+import argparse
+import contextlib
+import importlib
+import inspect
+import json
+import statistics
+import subprocess
+import sys
+import time
+from types import FunctionType, ModuleType
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple
+from unittest import mock
+
+from _app import REPO_ROOT, install_app_alias
+
+# Function -> name of the throughput scenario whose request is sent, or None
+# for the functions that are not HTTP triggered, see first_call.
+ENTRY_POINTS: Dict[str, Any] = {
+    "EmailCompose": "EmailCompose",
+    "HttpEmail": "HttpEmail",
+    "HttpEmailWorker": None,
+    "MailMerge": "MailMerge",
+    "PipelinePause": "PipelinePause",
+    "PipelineRestart": "PipelineRestart",
+    "PipelineStatus": "PipelineStatus",
+    "PipelinePauseCleanup": None,
+}
+
+# Module, name and real function replaced there by a stand-in.
+StandIn = Tuple[ModuleType, str, FunctionType]
+
+# Differences below this many seconds are never reported as regressions.
+ABSOLUTE_SLACK = 0.01
+
+
+def first_call(function_name: str, services: Any) -> Callable[[], Any]:
+    """Prepare the stand-ins and build the first invocation of a function.
+
+    HTTP functions get the request of their throughput scenario. The worker
+    gets a message enqueued by HttpEmail and the cleanup a timer tick over
+    the pause data of a pipeline.
+    """
+    import azure.functions as func
+    import throughput
+    from azure.functions.timer import TimerRequest
+
+    module = importlib.import_module(f"__app__.{function_name}")
+    scenario = ENTRY_POINTS[function_name]
+    if scenario is not None:
+        req = throughput.SCENARIOS[scenario][1](services)()
+        return lambda: module.main(req)
+
+    if function_name == "HttpEmailWorker":
+        http_email = importlib.import_module("__app__.HttpEmail")
+        from __app__.utilities import queues
+
+        throughput._sender_db(services)
+        http_email.main(throughput.http_email_queued(services)())
+        (message,) = queues.get_queue(http_email.OUTBOX_QUEUE).receive(1)
+        msg = func.QueueMessage(id=message.id, body=message.content.encode())
+        return lambda: module.main(msg)
+
+    pause = importlib.import_module("__app__.PipelinePause")
+    pause.main(throughput._request("PipelinePause", throughput.PAUSE))
+    timer = TimerRequest(past_due=False)
+    return lambda: module.main(timer)
+
+
+def _lazy_modules_of(function: FunctionType, seen: Set[Any]) -> Set[str]:
+    """Lazy modules used by a function, the functions of its module it calls
+    and the classes of its module it builds."""
+    from __app__.utilities import lazy
+
+    seen.add(function)
+    names = set()
+    for name in function.__code__.co_names:
+        value = function.__globals__.get(name)
+        if isinstance(value, lazy.LazyModule):
+            names.add(value._name)
+        elif inspect.isclass(value):
+            value = value.__init__
+        if (
+            inspect.isfunction(value)
+            and value.__module__ == function.__module__
+            and value not in seen
+        ):
+            names |= _lazy_modules_of(value, seen)
+
+    return names
+
+
+def _replaced(originals: Dict[ModuleType, Dict[str, Any]]) -> Iterator[StandIn]:
+    """Functions of the modules that no longer are what they were."""
+    for module, attributes in originals.items():
+        for name, real in attributes.items():
+            if inspect.isfunction(real) and getattr(module, name) is not real:
+                yield module, name, real
+
+
+@contextlib.contextmanager
+def recording(stand_ins: List[StandIn]) -> Iterator[Set[str]]:
+    """Record the lazy modules needed while the context is active.
+
+    Those are the lazy modules loaded, and the ones the real functions would
+    have loaded when their stand-ins are called.
+
+    Parameters
+    ----------
+    stand_ins
+        Module, name of the stand-in and real function it replaces.
+    """
+    from __app__.utilities import lazy
+
+    needed: Set[str] = set()
+    load = lazy.LazyModule.load
+
+    def recorded_load(self: Any) -> ModuleType:
+        needed.add(self._name)
+        return load(self)
+
+    def recorded(real: FunctionType, stand_in: Callable) -> Callable:
+        def call(*args: Any, **kwargs: Any) -> Any:
+            needed.update(_lazy_modules_of(real, set()))
+            return stand_in(*args, **kwargs)
+
+        return call
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(lazy.LazyModule, "load", recorded_load))
+        for module, name, real in stand_ins:
+            stand_in = recorded(real, getattr(module, name))
+            stack.enter_context(mock.patch.object(module, name, stand_in))
+        yield needed
+
+
+def measure(function_name: str) -> Dict[str, Any]:
+    """Take one sample for a function. Meant to run in a fresh interpreter.
+
+    Besides the timings, deferred_modules lists the deferred SDKs of the first
+    invocation for measure_deferred.
+    """
+    install_app_alias()
+    import azure.functions  # noqa: F401
+
+    started_at = time.perf_counter()
+    importlib.import_module(f"__app__.{function_name}")
+    sample: Dict[str, Any] = {"import_seconds": time.perf_counter() - started_at}
+
+    # Imported after timing the function since the stand-ins import SDKs too.
+    import fakes
+    from __app__.utilities import clients, keyvault, lazy, queues
+
+    originals = {module: dict(vars(module)) for module in (clients, keyvault)}
+    with fakes.installed() as services:
+        call = first_call(function_name, services)
+        # QUEUE_BACKEND=local swaps the Storage Queues for LocalQueue.
+        stand_ins = list(_replaced(originals))
+        stand_ins.append((queues, "LocalQueue", queues.StorageQueue.__init__))
+        with recording(stand_ins) as needed:
+            loaded_before = lazy.load_times()
+            started_at = time.perf_counter()
+            response = call()
+            elapsed = time.perf_counter() - started_at
+            loaded = lazy.load_times()
+
+    if response is not None and response.status_code >= 400:
+        raise RuntimeError(
+            f"First invocation of {function_name} failed with "
+            f"{response.status_code}: {response.get_body()!r}"
+        )
+    sample["first_invocation_seconds"] = elapsed - sum(
+        seconds for name, seconds in loaded.items() if name not in loaded_before
+    )
+    sample["deferred_modules"] = sorted(needed)
+
+    return sample
+
+
+def measure_deferred(function_name: str, module_names: List[str]) -> float:
+    """Time the import of deferred SDKs. Meant to run in a fresh interpreter."""
+    install_app_alias()
+    import azure.functions  # noqa: F401
+
+    importlib.import_module(f"__app__.{function_name}")
+    started_at = time.perf_counter()
+    for name in module_names:
+        importlib.import_module(name)
+
+    return time.perf_counter() - started_at
+
+
+def _child(*args: str) -> Any:
+    child = subprocess.run(
+        [sys.executable, __file__, *args],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+
+def run(function_names: List[str], repeat: int) -> Dict[str, Dict[str, float]]:
+    """Sample every function repeat times and keep the medians."""
+    results = {}
+    for function_name in function_names:
+        samples = []
+        for _ in range(repeat):
+            sample = _child("--child", function_name)
+            sample["deferred_seconds"] = _child(
+                "--deferred", function_name, *sample.pop("deferred_modules")
+            )
+            samples.append(sample)
+
+        results[function_name] = {
+            metric: round(statistics.median(x[metric] for x in samples), 4)
+            for metric in samples[0]
+        }
+
+    return results
+
+
+def regressions(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+) -> List[str]:
+    """List the timings that are slower than the baseline beyond tolerance."""
+    slower = []
+    for function_name, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(function_name, {}).get(metric)
+            if reference is None:
+                continue
+            if value > reference * (1 + tolerance) + ABSOLUTE_SLACK:
+                slower.append(f"{function_name}.{metric}: {reference} -> {value}")
+
+    return slower
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--deferred", nargs="+", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--functions", nargs="+", default=list(ENTRY_POINTS), choices=ENTRY_POINTS
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="File to write the results to.")
+    parser.add_argument("--baseline", help="Results of a previous run.")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return 0
+    if args.deferred:
+        print(json.dumps(measure_deferred(args.deferred[0], args.deferred[1:])))
+        return 0
+
+    results = run(args.functions, args.repeat)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for line in slower:
+            print(f"Regression {line}", file=sys.stderr)
+        if slower:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
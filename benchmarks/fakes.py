@@ -0,0 +1,504 @@
+"""In-process stand-ins for the services the functions talk to.
+
+They let the benchmarks drive every main without network access:
+- LocalSMTPServer: SMTP server on the loopback interface speaking just enough
+    of the protocol (EHLO, STARTTLS, AUTH, MAIL, RCPT, DATA, NOOP, RSET,
+    QUIT) for smtplib. STARTTLS uses a self-signed certificate generated on
+    start.
+- InMemoryTableService: Subset of TableService used by the functions.
+- InMemoryFileShare: File and directory clients backed by a dict.
+- FakeSecretProvider and FakeDataFactory: Key Vault and Data Factory.
+
+installed() swaps them in for the real clients of utilities.clients and
+utilities.keyvault.
+"""
+import base64
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import re
+import socketserver
+import ssl
+import tempfile
+import threading
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from unittest import mock
+
+from azure.common import AzureConflictHttpError, AzureMissingResourceHttpError
+from azure.core.exceptions import ResourceNotFoundError
+from azure.cosmosdb.table.models import EdmType, Entity, EntityProperty
+
+import pytz
+
+CONN_STR = (
+    "DefaultEndpointsProtocol=https;AccountName=benchmark;"
+    "AccountKey=YmVuY2htYXJr;EndpointSuffix=core.windows.net"
+)
+
+
+def _self_signed_certificate(directory: str) -> Tuple[str, str]:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+
+    return cert_path, key_path
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    server: "_SMTPServer"
+
+    def reply(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode())
+        self.wfile.flush()
+
+    def ehlo(self, tls: bool) -> None:
+        extensions = ["SIZE 52428800", "8BITMIME"]
+        extensions.append("AUTH PLAIN LOGIN" if tls else "STARTTLS")
+        lines = ["localhost"] + extensions
+        for line in lines[:-1]:
+            self.wfile.write(f"250-{line}\r\n".encode())
+        self.reply(f"250 {lines[-1]}")
+
+    def handle(self) -> None:
+        tls = False
+        self.reply("220 localhost ESMTP benchmark")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+
+            if verb in ("EHLO", "HELO"):
+                self.ehlo(tls)
+            elif verb == "STARTTLS":
+                self.reply("220 Ready to start TLS")
+                self.request = self.server.tls.wrap_socket(
+                    self.request, server_side=True
+                )
+                self.rfile = self.request.makefile("rb")
+                self.wfile = self.request.makefile("wb")
+                tls = True
+            elif verb == "AUTH":
+                self.reply("235 Authentication successful")
+            elif verb == "MAIL":
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                if "refused" in command.lower():
+                    self.reply("550 No such user")
+                else:
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    size += len(data_line)
+                self.server.received(size)
+                self.reply("250 OK queued")
+            elif verb in ("NOOP", "RSET"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class _SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tls: ssl.SSLContext) -> None:
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.tls = tls
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def received(self, size: int) -> None:
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+
+class LocalSMTPServer:
+    """SMTP server listening on a free port of the loopback interface."""
+
+    def __init__(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        tls.load_cert_chain(*_self_signed_certificate(self._directory.name))
+        self._server = _SMTPServer(tls)
+        self.host, self.port = self._server.server_address
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+
+    @property
+    def messages(self) -> int:
+        return self._server.messages
+
+    def start(self) -> "LocalSMTPServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._directory.cleanup()
+
+
+class _Page(list):
+    def __init__(self, entities: Iterable[Entity], next_marker: Any) -> None:
+        super().__init__(entities)
+        self.next_marker = next_marker
+
+
+def _decode(body: bytes) -> Entity:
+    properties = json.loads(body)
+    entity = Entity()
+    for name, value in properties.items():
+        if name.endswith("@odata.type"):
+            continue
+        if properties.get(f"{name}@odata.type") == "Edm.Int64":
+            value = int(value)
+        elif properties.get(f"{name}@odata.type") == "Edm.Binary":
+            value = EntityProperty(EdmType.BINARY, base64.b64decode(value))
+        entity[name] = value
+
+    return entity
+
+
+class InMemoryTableService:
+    """Subset of TableService keeping entities in memory."""
+
+    def __init__(self) -> None:
+        self.tables: Dict[str, Dict[Tuple[str, str], Entity]] = {}
+        self._lock = threading.Lock()
+
+    def _table(self, table_name: str) -> Dict[Tuple[str, str], Entity]:
+        return self.tables.setdefault(table_name, {})
+
+    def exists(self, table_name: str) -> bool:
+        return True
+
+    def _stored(self, entity: Any) -> Entity:
+        stored = Entity(entity)
+        stored["Timestamp"] = pytz.utc.localize(datetime.datetime.now())
+        return stored
+
+    def insert_entity(self, table_name: str, entity: Any) -> None:
+        key = (entity["PartitionKey"], entity["RowKey"])
+        with self._lock:
+            table = self._table(table_name)
+            if key in table:
+                raise AzureConflictHttpError("Entity already exists", 409)
+            table[key] = self._stored(entity)
+
+    def update_entity(self, table_name: str, entity: Any) -> None:
+        key = (entity["PartitionKey"], entity["RowKey"])
+        with self._lock:
+            table = self._table(table_name)
+            if key not in table:
+                raise AzureMissingResourceHttpError("Not found", 404)
+            table[key] = self._stored(entity)
+
+    def insert_or_replace_entity(self, table_name: str, entity: Any) -> None:
+        key = (entity["PartitionKey"], entity["RowKey"])
+        with self._lock:
+            self._table(table_name)[key] = self._stored(entity)
+
+    def merge_entity(self, table_name: str, entity: Any) -> None:
+        key = (entity["PartitionKey"], entity["RowKey"])
+        with self._lock:
+            table = self._table(table_name)
+            if key not in table:
+                raise AzureMissingResourceHttpError("Not found", 404)
+            table[key] = self._stored(dict(table[key], **entity))
+
+    def get_entity(
+        self,
+        table_name: str,
+        partition_key: str,
+        row_key: str,
+        select: Optional[str] = None,
+    ) -> Entity:
+        with self._lock:
+            entity = self._table(table_name).get((partition_key, row_key))
+        if entity is None:
+            raise AzureMissingResourceHttpError("Not found", 404)
+        if select:
+            return Entity({k: entity[k] for k in select.split(",") if k in entity})
+        return Entity(entity)
+
+    def delete_entity(self, table_name: str, partition_key: str, row_key: str) -> None:
+        with self._lock:
+            if self._table(table_name).pop((partition_key, row_key), None) is None:
+                raise AzureMissingResourceHttpError("Not found", 404)
+
+    def commit_batch(self, table_name: str, batch: Any) -> None:
+        """Apply the inserts and deletes of a TableBatch atomically."""
+        with self._lock:
+            table = self._table(table_name)
+            changes = []
+            for row_key, request in batch._requests:
+                key = (batch._partition_key, row_key)
+                if request.method == "DELETE":
+                    if key not in table:
+                        raise AzureMissingResourceHttpError("Not found", 404)
+                    changes.append((key, None))
+                else:
+                    if key in table:
+                        raise AzureConflictHttpError("Entity already exists", 409)
+                    changes.append((key, self._stored(_decode(request.body))))
+
+            for key, entity in changes:
+                if entity is None:
+                    del table[key]
+                else:
+                    table[key] = entity
+
+    def query_entities(
+        self,
+        table_name: str,
+        filter: Optional[str] = None,
+        select: Optional[str] = None,
+        num_results: Optional[int] = None,
+        marker: Any = None,
+    ) -> _Page:
+        with self._lock:
+            entities = sorted(
+                self._table(table_name).values(),
+                key=lambda x: (x["PartitionKey"], x["RowKey"]),
+            )
+        # Only single partition queries are understood, other filters are
+        # ignored.
+        partition = re.fullmatch(r"PartitionKey eq '([^']*)'", filter or "")
+        if partition:
+            entities = [x for x in entities if x["PartitionKey"] == partition[1]]
+        keys = [(x["PartitionKey"], x["RowKey"]) for x in entities]
+        # Markers have the shape of the ones of the SDK so that they survive
+        # being handed out as continuation tokens.
+        start = 0
+        if marker:
+            next_key = (marker["nextpartitionkey"], marker["nextrowkey"])
+            start = sum(1 for x in keys if x < next_key)
+        end = start + num_results if num_results else len(entities)
+        next_marker = None
+        if end < len(entities):
+            next_marker = {"nextpartitionkey": keys[end][0], "nextrowkey": keys[end][1]}
+        if select:
+            names = select.split(",")
+            entities = [Entity({k: x[k] for k in names if k in x}) for x in entities]
+        return _Page(entities[start:end], next_marker)
+
+
+class _FileClient:
+    def __init__(self, share: "InMemoryFileShare", key: Tuple[str, str]) -> None:
+        self._share = share
+        self._key = key
+
+    def _properties(self) -> SimpleNamespace:
+        content = self._share.files.get(self._key)
+        if content is None:
+            raise ResourceNotFoundError("The specified resource does not exist.")
+        return SimpleNamespace(etag=hashlib.md5(content).hexdigest())
+
+    def get_file_properties(self) -> SimpleNamespace:
+        return self._properties()
+
+    def download_file(self) -> SimpleNamespace:
+        properties = self._properties()
+        content = self._share.files[self._key]
+        self._share.downloads += 1
+        return SimpleNamespace(readall=lambda: content, properties=properties)
+
+    def upload_file(self, data: bytes) -> None:
+        self._share.files[self._key] = data
+
+    def delete_file(self) -> None:
+        self._properties()
+        del self._share.files[self._key]
+
+
+class _DirectoryClient:
+    def __init__(self, share: "InMemoryFileShare", share_name: str, path: str):
+        self._share = share
+        self._share_name = share_name
+        self._path = path.strip("/")
+
+    def list_directories_and_files(self) -> List[Dict[str, Any]]:
+        prefix = f"{self._path}/" if self._path else ""
+        names = {}
+        for share_name, path in self._share.files:
+            if share_name == self._share_name and path.startswith(prefix):
+                head, _, rest = path[len(prefix) :].partition("/")
+                names[head] = bool(rest)
+        return [{"name": k, "is_directory": v} for k, v in sorted(names.items())]
+
+
+class InMemoryFileShare:
+    """File Shares of a storage account kept in a dict.
+
+    downloads counts the files downloaded so far.
+    """
+
+    def __init__(self) -> None:
+        self.files: Dict[Tuple[str, str], bytes] = {}
+        self.downloads = 0
+
+    def put(self, share_name: str, file_path: str, content: str) -> None:
+        self.files[(share_name, file_path)] = content.encode("utf-8")
+
+    def get_file_client(
+        self, conn_str: str, share_name: str, file_path: str
+    ) -> _FileClient:
+        return _FileClient(self, (share_name, file_path))
+
+    def get_directory_client(
+        self, conn_str: str, share_name: str, directory_path: str
+    ) -> _DirectoryClient:
+        return _DirectoryClient(self, share_name, directory_path)
+
+
+class FakeSecretProvider:
+    """Key Vault with every secret set to the same value."""
+
+    def __init__(self, value: str = "password") -> None:
+        self.value = value
+
+    def get(self, name: str) -> str:
+        return self.value
+
+    async def get_async(self, name: str) -> str:
+        return self.value
+
+    def prefetch(self, names: Iterable[str]) -> None:
+        pass
+
+
+class _Pipelines:
+    def __init__(self) -> None:
+        self.runs = 0
+        self._lock = threading.Lock()
+
+    def get(self, resource_group: str, factory_name: str, pipeline_name: str) -> Any:
+        return SimpleNamespace(name=pipeline_name)
+
+    def create_run(
+        self,
+        resource_group: str,
+        factory_name: str,
+        pipeline_name: str,
+        parameters: Optional[Dict[str, Any]] = None,
+    ) -> Any:
+        with self._lock:
+            self.runs += 1
+            return SimpleNamespace(run_id=f"run-{self.runs}")
+
+
+class _PipelineRuns:
+    def __init__(self) -> None:
+        self.gets = 0
+
+    def get(self, resource_group: str, factory_name: str, run_id: str) -> Any:
+        self.gets += 1
+        return SimpleNamespace(
+            run_id=run_id,
+            status="InProgress",
+            message="",
+            run_start=None,
+            run_end=None,
+            duration_in_ms=None,
+        )
+
+
+class FakeDataFactory:
+    """Data Factory where every pipeline exists and runs never finish."""
+
+    def __init__(self) -> None:
+        self.pipelines = _Pipelines()
+        self.pipeline_runs = _PipelineRuns()
+
+
+class Services(SimpleNamespace):
+    smtp: LocalSMTPServer
+    table: InMemoryTableService
+    share: InMemoryFileShare
+    secrets: FakeSecretProvider
+    adf: FakeDataFactory
+
+
+@contextlib.contextmanager
+def installed() -> Iterator[Services]:
+    """Start the stand-ins and route the function clients to them.
+
+    Must be used after the function app is importable, see _app.
+    """
+    from __app__.utilities import clients, keyvault
+
+    services = Services(
+        smtp=LocalSMTPServer().start(),
+        table=InMemoryTableService(),
+        share=InMemoryFileShare(),
+        secrets=FakeSecretProvider(),
+        adf=FakeDataFactory(),
+    )
+    patches = [
+        mock.patch.object(clients, "get_table_service", lambda _: services.table),
+        mock.patch.object(clients, "ensure_table", lambda *_: None),
+        mock.patch.object(clients, "ensure_share", lambda *_: None),
+        mock.patch.object(clients, "get_file_client", services.share.get_file_client),
+        mock.patch.object(
+            clients, "get_directory_client", services.share.get_directory_client
+        ),
+        mock.patch.object(clients, "get_adf_client", lambda: services.adf),
+        mock.patch.object(keyvault, "get_secret_provider", lambda _: services.secrets),
+        mock.patch.dict(
+            os.environ,
+            {
+                "AzureWebJobsStorage": CONN_STR,
+                "KEY_VAULT_URI": "https://benchmark.vault.azure.net/",
+                "QUEUE_BACKEND": "local",
+            },
+        ),
+    ]
+    with contextlib.ExitStack() as stack:
+        for patch in patches:
+            stack.enter_context(patch)
+        stack.callback(services.smtp.stop)
+        yield services
+
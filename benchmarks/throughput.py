@@ -0,0 +1,331 @@
+"""Latency and throughput benchmark of the HTTP functions.
+
+Every main is driven against the in-process stand-ins of fakes.py, so no
+network access is needed. For each function and concurrency level a number of
+requests is sent from a thread pool, like the Functions host does, and the
+p50/p95/p99 latency and the requests per second are recorded.
+
+Results are printed and optionally saved as JSON together with the commit
+they were taken at. Pass a previous results file with --compare to print the
+relative change of every metric.
+
+Usage:
+    python benchmarks/throughput.py --concurrency 1 8 --output results.json
+    python benchmarks/throughput.py --compare results.json
+"""
+import argparse
+import datetime
+import importlib
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from _app import REPO_ROOT, install_app_alias
+
+import fakes
+
+install_app_alias()
+
+import azure.functions as func  # noqa: E402
+
+RequestFactory = Callable[[], func.HttpRequest]
+
+
+def _request(function_name: str, body: Dict[str, Any]) -> func.HttpRequest:
+    return func.HttpRequest(
+        method="POST", url=f"/api/{function_name}", body=json.dumps(body).encode()
+    )
+
+
+def email_compose(services: fakes.Services) -> RequestFactory:
+    services.share.put(
+        "templates",
+        "base.html",
+        "<html><body>{% block content %}{% endblock %}</body></html>",
+    )
+    services.share.put(
+        "templates",
+        "welcome.html",
+        '{% extends "base.html" %}{% block content %}<h1>Hi {{ name }}</h1>'
+        "<ul>{% for item in items %}<li>{{ item }}</li>{% endfor %}</ul>"
+        "{% endblock %}",
+    )
+    body = {
+        "template_file": "welcome.html",
+        "share_name": "templates",
+        "template_parameters": {"name": "Bob", "items": list(range(20))},
+    }
+
+    return lambda: _request("EmailCompose", body)
+
+
+def _sender_db(services: fakes.Services) -> None:
+    services.share.put(
+        "email-app",
+        "emails.json",
+        json.dumps(
+            [
+                {
+                    "user": "benchmark",
+                    "email": "benchmark@localhost",
+                    "host": services.smtp.host,
+                    "port": services.smtp.port,
+                    "keyvault_secret": "benchmark-password",
+                }
+            ]
+        ),
+    )
+
+
+def http_email(services: fakes.Services) -> RequestFactory:
+    _sender_db(services)
+    body = {
+        "user": "benchmark",
+        "recipients": "a@localhost,b@localhost",
+        "subject": "Benchmark",
+        "body": "Hello " * 200,
+    }
+
+    return lambda: _request("HttpEmail", body)
+
+
+def http_email_queued(services: fakes.Services) -> RequestFactory:
+    body = {
+        "user": "benchmark",
+        "recipients": "a@localhost",
+        "subject": "Benchmark",
+        "body": "Hello " * 200,
+        "delivery": "queued",
+    }
+
+    return lambda: _request("HttpEmail", body)
+
+
+def mail_merge(services: fakes.Services) -> RequestFactory:
+    _sender_db(services)
+    services.share.put(
+        "templates", "merge.html", "<p>Dear {{ name }}, your code is {{ code }}</p>"
+    )
+    body = {
+        "user": "benchmark",
+        "template_file": "merge.html",
+        "share_name": "templates",
+        "subject": "Hello {{ name }}",
+        "recipients": [
+            {"email": f"{i}@localhost", "name": f"User {i}", "code": i}
+            for i in range(50)
+        ],
+    }
+
+    # Only the enqueueing of the job is timed, HttpEmailWorker sends the chunks.
+    return lambda: _request("MailMerge", body)
+
+
+PAUSE = {
+    "factory_name": "adf",
+    "resource_group": "rg",
+    "pipeline_name": "pipeline",
+    "expiration_time": 3600,
+    "web_path": "restarted.html",
+    "share_name": "web",
+    "data": {"rows": [{"id": i, "value": "x" * 32} for i in range(16)]},
+}
+
+
+def pipeline_pause(services: fakes.Services) -> RequestFactory:
+    return lambda: _request("PipelinePause", PAUSE)
+
+
+def pipeline_restart(services: fakes.Services) -> RequestFactory:
+    services.share.put("web", "restarted.html", "<html>Restarted</html>")
+    pause_main = importlib.import_module("__app__.PipelinePause").main
+
+    # Tokens can only be used once so a new one is paused for every request.
+    lock = threading.Lock()
+
+    def make_request() -> func.HttpRequest:
+        with lock:
+            response = pause_main(_request("PipelinePause", PAUSE))
+        token = json.loads(response.get_body())["token"]
+        return _request("PipelineRestart", {"token": token})
+
+    return make_request
+
+
+def pipeline_status(services: fakes.Services) -> RequestFactory:
+    services.share.put("web", "restarted.html", "<html>Restarted</html>")
+    pause_main = importlib.import_module("__app__.PipelinePause").main
+    restart_main = importlib.import_module("__app__.PipelineRestart").main
+
+    # Dashboards poll a handful of runs many times each.
+    tokens = []
+    for _ in range(4):
+        response = pause_main(_request("PipelinePause", PAUSE))
+        tokens.append(json.loads(response.get_body())["token"])
+        restart_main(_request("PipelineRestart", {"token": tokens[-1]}))
+    polls = itertools.cycle(tokens)
+
+    return lambda: func.HttpRequest(
+        method="GET",
+        url="/api/PipelineStatus",
+        params={"token": next(polls)},
+        body=b"",
+    )
+
+
+# Scenario name -> (function module, request factory builder)
+SCENARIOS: Dict[str, Any] = {
+    "EmailCompose": ("EmailCompose", email_compose),
+    "HttpEmail": ("HttpEmail", http_email),
+    "HttpEmailQueued": ("HttpEmail", http_email_queued),
+    "MailMerge": ("MailMerge", mail_merge),
+    "PipelinePause": ("PipelinePause", pipeline_pause),
+    "PipelineRestart": ("PipelineRestart", pipeline_restart),
+    "PipelineStatus": ("PipelineStatus", pipeline_status),
+}
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest rank percentile of an already sorted list."""
+    index = max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def load(
+    main: Callable[[func.HttpRequest], func.HttpResponse],
+    make_request: RequestFactory,
+    requests: int,
+    concurrency: int,
+) -> Dict[str, float]:
+    """Send requests to main from concurrency threads and time them.
+
+    Requests are built before the clock starts so that only main is timed.
+    """
+    batch = [make_request() for _ in range(requests)]
+    latencies = [0.0] * requests
+    errors = [False] * requests
+
+    def call(index: int) -> None:
+        started_at = time.perf_counter()
+        response = main(batch[index])
+        latencies[index] = time.perf_counter() - started_at
+        errors[index] = response.status_code >= 400
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, range(requests)))
+    elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": sum(errors),
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run(
+    scenario_names: List[str],
+    concurrency_levels: List[int],
+    requests: int,
+    warmup: int,
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Benchmark every scenario at every concurrency level."""
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    with fakes.installed() as services:
+        for name in scenario_names:
+            module_name, scenario = SCENARIOS[name]
+            main = importlib.import_module(f"__app__.{module_name}").main
+            make_request = scenario(services)
+            load(main, make_request, warmup, 1)
+
+            results[name] = {
+                str(concurrency): load(main, make_request, requests, concurrency)
+                for concurrency in concurrency_levels
+            }
+
+        logging.info(f"Emails received by the SMTP server: {services.smtp.messages}")
+
+    return results
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: Dict[str, Any], previous: Dict[str, Any]) -> List[str]:
+    """Describe the relative change of every metric found in both runs."""
+    lines = []
+    for name, levels in results["results"].items():
+        for concurrency, metrics in levels.items():
+            before = previous["results"].get(name, {}).get(concurrency)
+            if before is None:
+                continue
+            changes = [
+                f"{metric} {(value - before[metric]) / before[metric]:+.1%}"
+                for metric, value in metrics.items()
+                if metric in ("rps", "p50_ms", "p95_ms", "p99_ms") and before[metric]
+            ]
+            lines.append(f"{name} x{concurrency}: {', '.join(changes)}")
+
+    return lines
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--functions", nargs="+", default=list(SCENARIOS), choices=SCENARIOS
+    )
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--output", help="File to write the results to.")
+    parser.add_argument("--compare", help="Results of a previous run.")
+    args = parser.parse_args()
+
+    os.environ.setdefault("TEMPLATE_BYTECODE_DIR", tempfile.mkdtemp())
+    results = {
+        "commit": _commit(),
+        "taken_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "results": run(args.functions, args.concurrency, args.requests, args.warmup),
+    }
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print(f"Compared with {previous.get('commit', 'unknown')}:")
+        for line in compare(results, previous):
+            print(f"  {line}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
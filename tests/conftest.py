@@ -0,0 +1,179 @@
+"""Fakes shared by the tests of every function.
+
+Table storage and File Shares are the in-memory stand-ins of the benchmarks,
+see benchmarks.fakes, with the Table calls the tests assert on recorded.
+
+The __app__ package the functions import each other through is mapped onto
+FunctionAutomate, see benchmarks._app, so that `python -m pytest tests` runs
+outside of the Functions host.
+"""
+import os
+import smtplib
+import sys
+
+import pytest
+
+# Plain `pytest` does not put the repo root on the path, benchmarks needs it.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks._app import install_app_alias  # noqa: E402
+
+install_app_alias()
+
+import FunctionAutomate.HttpEmail as http_email  # noqa: E402
+from FunctionAutomate.utilities import clients  # noqa: E402
+
+from benchmarks.fakes import InMemoryFileShare, InMemoryTableService  # noqa: E402
+
+
+class RecordingTableService(InMemoryTableService):
+    """InMemoryTableService keeping track of its queries and batches."""
+
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+        self.batches = []
+
+    def put(self, table_name, entities):
+        """Store entities as they are, Timestamp included."""
+        table = self._table(table_name)
+        for entity in entities:
+            table[(entity["PartitionKey"], entity["RowKey"])] = entity
+
+    def row_keys(self, table_name):
+        return sorted(row_key for _, row_key in self._table(table_name))
+
+    def query_entities(self, table_name, filter=None, select=None, **kwargs):
+        self.queries.append({"filter": filter, "select": select})
+        return super().query_entities(table_name, filter, select, **kwargs)
+
+    def commit_batch(self, table_name, batch):
+        self.batches.append(len(batch._requests))
+        super().commit_batch(table_name, batch)
+
+
+@pytest.fixture()
+def table_service():
+    yield RecordingTableService()
+
+
+@pytest.fixture()
+def file_shares(monkeypatch):
+    shares = InMemoryFileShare()
+    monkeypatch.setenv("AzureWebJobsStorage", "conn")
+    monkeypatch.setattr(clients, "get_file_client", shares.get_file_client)
+    monkeypatch.setattr(clients, "get_directory_client", shares.get_directory_client)
+    monkeypatch.setattr(clients, "ensure_share", lambda conn_str, share_name: None)
+    yield shares
+
+
+class FakeSMTP:
+    """Stand-in for smtplib.SMTP that records what happens to each session.
+
+    Recipients starting with refused@ are refused. Messages are either sent
+    whole with send_message or streamed with the DATA phase methods, see
+    HttpEmail.streaming. The class attributes make the next sessions fail:
+    - connect_error and login_error: Raised when a session is opened.
+    - failures: Number of the next messages answered with a 451 reply.
+    """
+
+    opened = []
+    connect_error = None
+    login_error = None
+    failures = 0
+
+    def __init__(self, host, port, timeout=None):
+        if self.connect_error is not None:
+            raise self.connect_error
+        self.alive = True
+        self.sent = []
+        self.data = []
+        self.opened.append(self)
+
+    @classmethod
+    def messages(cls):
+        """Every message sent whole by any session."""
+        return [msg for session in cls.opened for msg in session.sent]
+
+    def starttls(self):
+        pass
+
+    def login(self, email, password):
+        if self.login_error is not None:
+            raise self.login_error
+
+    def noop(self):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected()
+        return (250, b"OK")
+
+    def send_message(self, msg):
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected()
+        if FakeSMTP.failures:
+            FakeSMTP.failures -= 1
+            raise smtplib.SMTPResponseException(451, b"Try again later")
+        if msg["To"].startswith("refused@"):
+            raise smtplib.SMTPRecipientsRefused({msg["To"]: (550, b"No such user")})
+        self.sent.append(msg)
+        return {}
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def mail(self, from_addr):
+        return (250, b"OK")
+
+    def rcpt(self, addr):
+        return (550, b"No such user") if addr.startswith("refused@") else (250, b"")
+
+    def docmd(self, cmd):
+        return (354, b"Go ahead")
+
+    def send(self, chunk):
+        self.data.append(chunk)
+
+    def getreply(self):
+        return (250, b"Queued")
+
+    def quit(self):
+        self.alive = False
+
+    def close(self):
+        self.alive = False
+
+
+@pytest.fixture()
+def fake_smtp(monkeypatch):
+    monkeypatch.setattr(FakeSMTP, "opened", [])
+    monkeypatch.setattr(FakeSMTP, "connect_error", None)
+    monkeypatch.setattr(FakeSMTP, "login_error", None)
+    monkeypatch.setattr(FakeSMTP, "failures", 0)
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+    # Sessions opened by other tests must not be reused.
+    http_email._smtp_pool.close_all()
+    yield FakeSMTP
+    http_email._smtp_pool.close_all()
+
+
+class FakeSenderDB:
+    """Sender DB where every user but "unknown" exists."""
+
+    def get_sender(self, user):
+        if user == "unknown":
+            raise KeyError("Sender not found in DB.")
+        return {"host": "host", "port": 25, "email": "me@a.com", "password": "pwd"}
+
+    async def get_sender_async(self, user):
+        return self.get_sender(user)
+
+
+@pytest.fixture()
+def sender_db(monkeypatch):
+    monkeypatch.setenv("AzureWebJobsStorage", "conn")
+    monkeypatch.setattr(
+        http_email.SenderDB, "get_instance", lambda **kwargs: FakeSenderDB()
+    )
+    yield FakeSenderDB
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import os
+import stat
+
+import pytest
+
+import azure.functions as func
+
+import FunctionAutomate.EmailCompose as email_compose
+from FunctionAutomate.EmailCompose import (
+    RenderCache,
+    TemplateCache,
+    batch_response,
+    loader,
+    main_async,
+    render_batch,
+)
+from FunctionAutomate.utilities.exceptions import HttpError
+
+from jinja2 import Template
+
+
+@pytest.fixture()
+def file_share(monkeypatch, tmp_path, file_shares):
+    file_shares.put("share", "a.txt", "Hello {{ name }}")
+    monkeypatch.setattr(loader, "_environments", {})
+    monkeypatch.setenv("TEMPLATE_BYTECODE_DIR", str(tmp_path))
+    yield file_shares
+
+
+@pytest.fixture()
+def aio_file_share(monkeypatch, file_share):
+    async def download_file(conn_str, share_name, file_path):
+        client = file_share.get_file_client(conn_str, share_name, file_path)
+        downloader = client.download_file()
+        return downloader.readall(), downloader.properties.etag
+
+    monkeypatch.setattr(loader.aio, "download_file", download_file)
+    yield file_share
+
+
+class TestTemplateCache:
+    def test_second_get_is_a_hit(self, file_share):
+        cache = TemplateCache(max_bytes=1024, revalidate_after=60)
+        cache.get("conn", "share", "a.txt")
+        template = cache.get("conn", "share", "a.txt")
+
+        assert template.render(name="Bob") == "Hello Bob"
+        assert file_share.downloads == 1
+        assert cache.stats()["hits"] == 1
+
+    def test_unchanged_etag_is_not_downloaded_again(self, file_share):
+        cache = TemplateCache(max_bytes=1024, revalidate_after=0)
+        cache.get("conn", "share", "a.txt")
+        cache.get("conn", "share", "a.txt")
+
+        assert file_share.downloads == 1
+        assert cache.stats()["revalidations"] == 1
+
+    def test_changed_etag_reloads(self, file_share):
+        cache = TemplateCache(max_bytes=1024, revalidate_after=0)
+        cache.get("conn", "share", "a.txt")
+        file_share.put("share", "a.txt", "Bye {{ name }}")
+
+        assert cache.get("conn", "share", "a.txt").render(name="Bob") == "Bye Bob"
+        assert file_share.downloads == 2
+
+    def test_templates_over_budget_are_evicted(self, file_share):
+        file_share.put("share", "b.txt", "Bye {{ name }}")
+        cache = TemplateCache(max_bytes=20, revalidate_after=60)
+        cache.get("conn", "share", "a.txt")
+        cache.get("conn", "share", "b.txt")
+
+        assert cache.stats()["entries"] == 1
+        assert cache.stats()["evictions"] == 1
+
+    def test_templates_can_extend_others(self, file_share):
+        file_share.put("share", "base.txt", "<{% block body %}{% endblock %}>")
+        file_share.put(
+            "share",
+            "child.txt",
+            '{% extends "base.txt" %}{% block body %}Hi {{ name }}{% endblock %}',
+        )
+        cache = TemplateCache(max_bytes=1024, revalidate_after=60)
+        template = cache.get("conn", "share", "child.txt")
+
+        assert template.render(name="Bob") == "<Hi Bob>"
+        assert file_share.downloads == 2
+
+
+class TestTemplateCacheAsync:
+    def test_async_get_uses_the_same_cache(self, aio_file_share):
+        cache = TemplateCache(max_bytes=1024, revalidate_after=60)
+        template = asyncio.run(cache.get_async("conn", "share", "a.txt"))
+        cache.get("conn", "share", "a.txt")
+
+        assert template.render(name="Bob") == "Hello Bob"
+        assert aio_file_share.downloads == 1
+        assert cache.stats()["hits"] == 1
+
+
+class TestMainAsync:
+    @pytest.fixture(autouse=True)
+    def caches(self, monkeypatch, aio_file_share):
+        monkeypatch.setattr(
+            email_compose,
+            "_template_cache",
+            TemplateCache(max_bytes=1024, revalidate_after=60),
+        )
+        monkeypatch.setattr(email_compose, "_render_cache", RenderCache(1024))
+
+    def request(self, body):
+        body = {"template_file": "a.txt", "share_name": "share", **body}
+        return func.HttpRequest(
+            method="POST", url="/api/EmailCompose", body=json.dumps(body).encode()
+        )
+
+    def test_template_is_rendered(self):
+        response = asyncio.run(
+            main_async(self.request({"template_parameters": {"name": "Bob"}}))
+        )
+
+        assert json.loads(response.get_body())["output_text"] == "Hello Bob"
+
+    def test_batches_are_rendered(self):
+        batch = [{"name": "a"}, {"name": "b"}]
+        response = asyncio.run(
+            main_async(self.request({"template_parameters_batch": batch}))
+        )
+
+        lines = [json.loads(x) for x in response.get_body().splitlines()]
+        assert [x["output_text"] for x in lines] == ["Hello a", "Hello b"]
+
+    def test_errors_are_returned_as_responses(self):
+        req = func.HttpRequest(
+            method="POST", url="/api/EmailCompose", body=json.dumps({}).encode()
+        )
+
+        assert asyncio.run(main_async(req)).status_code == 500
+
+
+class TestBytecodeCache:
+    def test_default_folder_is_private(self, monkeypatch):
+        monkeypatch.delenv("TEMPLATE_BYTECODE_DIR", raising=False)
+        directory = loader.bytecode_cache().directory
+
+        assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+        assert os.stat(directory).st_uid == os.getuid()
+
+    def test_configured_folder_is_created_private(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("TEMPLATE_BYTECODE_DIR", str(tmp_path / "bytecode"))
+        directory = loader.bytecode_cache().directory
+
+        assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+
+
+class TestRenderBatch:
+    def test_one_line_per_parameter_set(self):
+        lines = list(
+            render_batch(Template("Hi {{ name }}"), [{"name": "a"}, {"name": "b"}])
+        )
+
+        assert [json.loads(x)["output_text"] for x in lines] == ["Hi a", "Hi b"]
+        assert all(x.endswith("\n") for x in lines)
+
+    def test_errors_do_not_stop_the_batch(self):
+        template = Template("{{ 1 // d }}")
+        lines = [json.loads(x) for x in render_batch(template, [{"d": 0}, {"d": 1}])]
+
+        assert "ZeroDivisionError" in lines[0]["error"]
+        assert lines[1] == {"index": 1, "output_text": "1"}
+
+    def test_batches_are_bounded(self, monkeypatch):
+        monkeypatch.setenv("COMPOSE_BATCH_MAX_ITEMS", "2")
+        monkeypatch.setenv("COMPOSE_BATCH_MAX_BYTES", "100")
+        template = Template("{{ text }}")
+
+        with pytest.raises(HttpError) as e:
+            batch_response(template, [{"text": "a"}] * 3)
+        assert e.value.response.status_code == 413
+
+        with pytest.raises(HttpError) as e:
+            batch_response(template, [{"text": "a" * 60}] * 2)
+        assert e.value.response.status_code == 413
+
+        response = batch_response(template, [{"text": "a"}] * 2)
+        assert len(response.get_body().splitlines()) == 2
+
+
+class TestRenderCache:
+    def render(self, cache, template_cache, template_path, parameters):
+        template = template_cache.get("conn", "share", template_path)
+        return cache.render(template, "share", template_path, parameters)
+
+    def test_repeats_are_served_from_cache(self, file_share):
+        cache = RenderCache(max_bytes=1024)
+        template_cache = TemplateCache(max_bytes=1024, revalidate_after=60)
+        parameters = {"name": "Bob", "x": [1, 2]}
+
+        assert self.render(cache, template_cache, "a.txt", parameters) == (
+            "Hello Bob",
+            False,
+        )
+        reordered = {"x": [1, 2], "name": "Bob"}
+        assert self.render(cache, template_cache, "a.txt", reordered)[1]
+        assert not self.render(cache, template_cache, "a.txt", {"name": "Al"})[1]
+
+    def test_changed_dependency_invalidates(self, file_share):
+        file_share.put("share", "base.txt", "<{% block body %}{% endblock %}>")
+        file_share.put(
+            "share",
+            "child.txt",
+            '{% extends "base.txt" %}{% block body %}Hi {{ name }}{% endblock %}',
+        )
+        cache = RenderCache(max_bytes=1024)
+        template_cache = TemplateCache(max_bytes=1024, revalidate_after=0)
+        self.render(cache, template_cache, "child.txt", {"name": "Bob"})
+
+        file_share.put("share", "base.txt", "[{% block body %}{% endblock %}]")
+
+        assert self.render(cache, template_cache, "child.txt", {"name": "Bob"}) == (
+            "[Hi Bob]",
+            False,
+        )
+
+    def test_disabled_cache_always_renders(self, file_share):
+        cache = RenderCache(max_bytes=0)
+        template_cache = TemplateCache(max_bytes=1024, revalidate_after=60)
+        self.render(cache, template_cache, "a.txt", {"name": "Bob"})
+
+        assert not self.render(cache, template_cache, "a.txt", {"name": "Bob"})[1]
@@ -1,8 +1,23 @@
+import asyncio
+import base64
+import email
 import json
+from types import SimpleNamespace
 
 import pytest
 
-from FunctionAutomate.HttpEmail import get_param, parse_request
+import FunctionAutomate.HttpEmail as http_email
+from FunctionAutomate.HttpEmail import (
+    EmailDeliverer,
+    SenderDB,
+    parse_bulk_request,
+    parse_request,
+    smtp_pool,
+    streaming,
+)
+from FunctionAutomate.utilities import clients, keyvault
+from FunctionAutomate.utilities.exceptions import HttpError
+from FunctionAutomate.utilities.utilities import get_param
 
 import azure.functions as func
 
@@ -82,3 +97,363 @@ class TestParseRequest:
             "mimetype": "plain",
         }
         assert all([email_params[k] == expected[k] for k in expected])
+
+    def test_every_missing_param_is_reported(self):
+        req = func.HttpRequest(method="GET", body=b"", url="/api/x")
+
+        with pytest.raises(HttpError) as e:
+            parse_request(req)
+
+        assert str(e.value) == "Missing parameters: user, recipients."
+
+    def test_body_is_decoded_once(self, monkeypatch, request_2):
+        calls = []
+        get_json = request_2.get_json
+        monkeypatch.setattr(
+            request_2, "get_json", lambda: calls.append(1) or get_json()
+        )
+        parse_request(request_2)
+
+        assert len(calls) == 1
+
+
+@pytest.fixture()
+def bulk_request():
+    req = func.HttpRequest(
+        method="POST",
+        body=json.dumps(
+            {
+                "user": "user",
+                "messages": [
+                    {"recipients": "a@a.com,b@b.com", "subject": "Hi"},
+                    {"recipients": ["refused@a.com"], "body": "body"},
+                ],
+            }
+        ).encode(),
+        url="/api/x",
+    )
+    yield req
+
+
+class TestParseBulkRequest:
+    def test_messages_get_defaults(self, bulk_request):
+        bulk_params = parse_bulk_request(bulk_request)
+
+        assert bulk_params["user"] == "user"
+        assert bulk_params["messages"][0] == {
+            "recipients": ["a@a.com", "b@b.com"],
+            "subject": "Hi",
+            "body": "",
+            "mimetype": "plain",
+            "attachments": [],
+        }
+        assert bulk_params["messages"][1]["recipients"] == ["refused@a.com"]
+
+    def test_bad_message_is_located(self):
+        req = func.HttpRequest(
+            method="POST",
+            body=json.dumps({"user": "u", "messages": [{}, "x"]}).encode(),
+            url="/api/x",
+        )
+
+        with pytest.raises(HttpError) as e:
+            parse_bulk_request(req)
+
+        assert str(e.value) == "Missing parameters: recipients in message 0."
+
+
+class TestSMTPSessionPool:
+    def deliverer(self, pool):
+        return EmailDeliverer("host", 25, "me@a.com", "pwd", pool=pool)
+
+    def test_sessions_are_reused(self, fake_smtp):
+        postman = self.deliverer(smtp_pool.SMTPSessionPool())
+        postman.send_email(["a@a.com"], "Hi", "body", "plain")
+        postman.send_email(["a@a.com"], "Hi", "body", "plain")
+
+        assert len(fake_smtp.opened) == 1
+        assert len(fake_smtp.opened[0].sent) == 2
+
+    def test_dead_sessions_are_replaced(self, fake_smtp):
+        postman = self.deliverer(smtp_pool.SMTPSessionPool())
+        postman.send_email(["a@a.com"], "Hi", "body", "plain")
+        fake_smtp.opened[0].alive = False
+        postman.send_email(["a@a.com"], "Hi", "body", "plain")
+
+        assert len(fake_smtp.opened) == 2
+        assert len(fake_smtp.opened[1].sent) == 1
+
+    def test_idle_sessions_expire(self, fake_smtp):
+        postman = self.deliverer(smtp_pool.SMTPSessionPool(idle_timeout=0))
+        postman.send_email(["a@a.com"], "Hi", "body", "plain")
+        postman.send_email(["a@a.com"], "Hi", "body", "plain")
+
+        assert len(fake_smtp.opened) == 2
+        assert not fake_smtp.opened[0].alive
+
+    def test_broken_sessions_are_closed_without_quit(self, monkeypatch, fake_smtp):
+        quits = []
+        monkeypatch.setattr(fake_smtp, "quit", lambda server: quits.append(server))
+        pool = smtp_pool.SMTPSessionPool()
+
+        with pytest.raises(streaming.AttachmentError):
+            with pool.session("host", 25, "me@a.com", "pwd") as server:
+                raise streaming.AttachmentError("Attachment changed while sent")
+        assert quits == []
+        assert not server.alive
+
+        with pool.session("host", 25, "me@a.com", "pwd") as server:
+            pass
+        pool.close_all()
+        assert quits == [server]
+
+    def test_bulk_reports_per_message_status(self, fake_smtp, bulk_request):
+        postman = self.deliverer(smtp_pool.SMTPSessionPool())
+        statuses = postman.send_emails(parse_bulk_request(bulk_request)["messages"])
+
+        assert len(fake_smtp.opened) == 1
+        assert statuses[0] == {"index": 0, "status": "accepted", "refused": {}}
+        assert statuses[1]["status"] == "refused"
+        assert statuses[1]["refused"] == {"refused@a.com": [550, "No such user"]}
+
+    def test_failed_reconnects_keep_the_statuses(self, monkeypatch, fake_smtp):
+        send_message = fake_smtp.send_message
+
+        def send_and_drop(server, msg):
+            # The server goes away right after taking the first message.
+            refused = send_message(server, msg)
+            server.alive = False
+            fake_smtp.connect_error = ConnectionRefusedError(111, "Refused")
+            return refused
+
+        monkeypatch.setattr(fake_smtp, "send_message", send_and_drop)
+        postman = self.deliverer(smtp_pool.SMTPSessionPool())
+        messages = [
+            {"recipients": ["a@a.com"], "subject": "", "body": "", "mimetype": "plain"}
+        ] * 3
+
+        statuses = postman.send_emails(messages)
+
+        assert [x["status"] for x in statuses] == ["accepted", "failed", "failed"]
+        assert "Refused" in statuses[1]["error"]
+        assert len(fake_smtp.messages()) == 1
+
+
+class FakeDBFile:
+    """Stand-in for the ShareFileClient holding the sender DB."""
+
+    def __init__(self, senders, etag="etag-1"):
+        self.senders = senders
+        self.etag = etag
+        self.downloads = 0
+
+    def from_connection_string(self, conn_str, share_name, file_path):
+        return self
+
+    def get_file_properties(self):
+        return SimpleNamespace(etag=self.etag)
+
+    def download_file(self):
+        self.downloads += 1
+        content = json.dumps(self.senders).encode()
+        return SimpleNamespace(
+            readall=lambda: content, properties=SimpleNamespace(etag=self.etag)
+        )
+
+
+class TestSenderDB:
+    senders = [
+        {"user": "a", "email": "a@a.com", "host": "h", "port": 25},
+        {"user": "b", "email": "b@a.com", "host": "h", "port": 25},
+    ]
+
+    def test_duplicates_are_rejected_on_load(self, monkeypatch):
+        db_file = FakeDBFile(self.senders + self.senders[:1])
+        monkeypatch.setattr(
+            clients, "get_file_client", db_file.from_connection_string
+        )
+
+        with pytest.raises(KeyError):
+            SenderDB("conn", "share", "emails.json")
+
+    def test_refresh_reloads_changed_db(self, monkeypatch):
+        db_file = FakeDBFile(self.senders)
+        monkeypatch.setattr(
+            clients, "get_file_client", db_file.from_connection_string
+        )
+        sender_db = SenderDB("conn", "share", "emails.json")
+
+        sender_db.refresh()
+        assert db_file.downloads == 1
+
+        db_file.senders = self.senders[:1]
+        db_file.etag = "etag-2"
+        sender_db.refresh()
+        assert db_file.downloads == 2
+        assert sender_db.email_db == self.senders[:1]
+
+
+class FakeAttachmentFile:
+    """Stand-in for the ShareFileClient of an attachment."""
+
+    def __init__(self, content):
+        self.content = content
+        self.ranges = []
+
+    def get_file_properties(self):
+        return SimpleNamespace(size=len(self.content), etag="etag")
+
+    def download_file(self, offset, length):
+        self.ranges.append(length)
+        chunk = self.content[offset : offset + length]
+        return SimpleNamespace(
+            readall=lambda: chunk, properties=SimpleNamespace(etag="etag")
+        )
+
+
+@pytest.fixture()
+def attachment_file(monkeypatch):
+    attachment = FakeAttachmentFile(bytes(range(256)) * 41)
+    monkeypatch.setenv("AzureWebJobsStorage", "conn")
+    monkeypatch.setattr(
+        clients, "get_file_client", lambda conn_str, share_name, file_path: attachment
+    )
+    yield attachment
+
+
+class TestStreamedAttachments:
+    references = streaming.attachment_list([{"share_name": "s", "path": "r/a.pdf"}])
+
+    def test_base64_lines_do_not_depend_on_chunking(self):
+        content = bytes(range(256)) * 10
+        chunks = [content[i : i + 100] for i in range(0, len(content), 100)]
+
+        encoded = b"".join(streaming.base64_lines(chunks))
+        assert encoded == base64.encodebytes(content).replace(b"\n", b"\r\n")
+
+    def test_attachments_are_streamed_in_ranges(self, attachment_file, fake_smtp):
+        postman = EmailDeliverer("host", 25, "me@a.com", "pwd")
+        recipients = ["a@a.com", "refused@a.com"]
+        msg = postman.build_message(recipients, "Hi", "body", "plain")
+        files = streaming.open_attachments(self.references, chunk_size=1000)
+        server = fake_smtp("host", 25)
+
+        refused = streaming.send_streamed(
+            server,
+            "me@a.com",
+            recipients,
+            streaming.message_stream(msg, files),
+        )
+
+        assert refused == {"refused@a.com": (550, b"No such user")}
+        assert attachment_file.ranges == [1000] * 10 + [496]
+        assert b"".join(server.data).endswith(b"\r\n.\r\n")
+        parsed = email.message_from_bytes(b"".join(server.data)[:-3])
+        body, attachment = parsed.get_payload()
+        assert body.get_payload() == "body"
+        assert attachment.get_filename() == "a.pdf"
+        assert attachment.get_content_type() == "application/pdf"
+        assert attachment.get_payload(decode=True) == attachment_file.content
+
+    def test_unreadable_attachments_only_fail_their_message(
+        self, monkeypatch, attachment_file, fake_smtp
+    ):
+        def download_file(offset, length):
+            raise IOError("Attachment a.pdf changed while sent")
+
+        monkeypatch.setattr(attachment_file, "download_file", download_file)
+        postman = EmailDeliverer(
+            "host", 25, "me@a.com", "pwd", pool=smtp_pool.SMTPSessionPool()
+        )
+        messages = [
+            {"recipients": ["a@a.com"], "subject": "", "body": "", "mimetype": "plain"}
+        ] * 3
+        messages[1] = dict(messages[1], attachments=self.references)
+
+        statuses = postman.send_emails(messages)
+
+        assert [x["status"] for x in statuses] == ["accepted", "failed", "accepted"]
+        assert "changed while sent" in statuses[1]["error"]
+        assert len(fake_smtp.opened) == 2
+        assert not fake_smtp.opened[0].alive
+
+    def test_size_limit_is_enforced(self, attachment_file):
+        with pytest.raises(HttpError) as e:
+            streaming.open_attachments(self.references, max_bytes=1000)
+
+        assert e.value.response.status_code == 413
+        assert attachment_file.ranges == []
+
+
+class TestMainAsync:
+    def test_emails_are_sent(self, fake_smtp, sender_db, request_2):
+        response = asyncio.run(http_email.main_async(request_2))
+
+        assert response.status_code == 200
+        assert len(fake_smtp.messages()) == 1
+
+    def test_bulk_requests_report_every_message(
+        self, fake_smtp, sender_db, bulk_request
+    ):
+        response = asyncio.run(http_email.main_async(bulk_request))
+
+        statuses = json.loads(response.get_body())["results"]
+        assert [x["status"] for x in statuses] == ["accepted", "refused"]
+
+    def test_unknown_senders_are_reported(self, sender_db, request_3):
+        req = func.HttpRequest(
+            method="GET",
+            url="/api/HttpEmail",
+            body=b"",
+            params=dict(request_3.params, user="unknown"),
+        )
+
+        with pytest.raises(KeyError, match="Sender not found"):
+            asyncio.run(http_email.main_async(req))
+
+
+class FakeAsyncClient:
+    """Stand-in for the aio SecretClient and DefaultAzureCredential."""
+
+    created = []
+
+    def __init__(self, **kwargs):
+        self.closed = False
+        FakeAsyncClient.created.append(self)
+
+    async def get_secret(self, name):
+        await asyncio.sleep(0)
+        return SimpleNamespace(value=f"{name}-value")
+
+    async def close(self):
+        self.closed = True
+
+
+class TestSecretProviderAsync:
+    @pytest.fixture()
+    def provider(self, monkeypatch):
+        fake_sdk = SimpleNamespace(
+            SecretClient=FakeAsyncClient, DefaultAzureCredential=FakeAsyncClient
+        )
+        for name in ("_secrets", "_identity", "_secrets_aio", "_identity_aio"):
+            monkeypatch.setattr(keyvault, f"{name}_sdk", fake_sdk)
+        FakeAsyncClient.created = []
+        return keyvault.SecretProvider("https://vault", ttl=60)
+
+    def test_concurrent_first_calls_create_one_client(self, provider):
+        async def get_all():
+            return await asyncio.gather(
+                provider.get_async("a"), provider.get_async("b")
+            )
+
+        assert asyncio.run(get_all()) == ["a-value", "b-value"]
+        # The sync client and credential, then one aio credential and client.
+        assert len(FakeAsyncClient.created) == 4
+
+    def test_close_closes_client_and_credential(self, provider):
+        async def get_and_close():
+            await provider.get_async("a")
+            await provider.close_async()
+
+        asyncio.run(get_and_close())
+        assert [c.closed for c in FakeAsyncClient.created[2:]] == [True, True]
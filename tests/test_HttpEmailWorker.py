@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+import FunctionAutomate.HttpEmail as http_email
+import FunctionAutomate.HttpEmailWorker as worker
+
+import azure.functions as func
+
+
+@pytest.fixture()
+def local_queues(monkeypatch, sender_db, fake_smtp):
+    monkeypatch.setenv("QUEUE_BACKEND", "local")
+    monkeypatch.setenv("AzureWebJobsStorage", "conn")
+    monkeypatch.setenv("EMAIL_WORKER_BACKOFF_SECONDS", "0")
+    monkeypatch.setattr(worker.queues, "_queues", {})
+    yield worker.queues
+
+
+def queued(**params):
+    return func.HttpRequest(
+        method="GET",
+        body=b"",
+        url="/api/x",
+        params=dict(
+            {"user": "user", "recipients": "a@a.com", "delivery": "queued"}, **params
+        ),
+    )
+
+
+@pytest.fixture()
+def queued_request():
+    yield queued()
+
+
+class TestQueuedDelivery:
+    def test_enqueue_answers_202(self, local_queues, queued_request):
+        response = http_email.main(queued_request)
+
+        assert response.status_code == 202
+        assert "message_id" in json.loads(response.get_body())
+        assert len(local_queues.get_queue(worker.OUTBOX_QUEUE)) == 1
+
+    def test_failed_deliveries_are_retried(
+        self, local_queues, fake_smtp, queued_request
+    ):
+        fake_smtp.failures = 1
+        http_email.main(queued_request)
+
+        assert worker.drain() == 2
+        assert len(fake_smtp.messages()) == 1
+        assert len(local_queues.get_queue(worker.OUTBOX_QUEUE)) == 0
+
+    def test_exhausted_deliveries_are_dead_lettered(
+        self, monkeypatch, local_queues, fake_smtp, queued_request
+    ):
+        monkeypatch.setenv("EMAIL_WORKER_MAX_ATTEMPTS", "2")
+        fake_smtp.failures = 2
+        http_email.main(queued_request)
+
+        assert worker.drain() == 2
+        assert fake_smtp.messages() == []
+        assert len(local_queues.get_queue(worker.DEAD_LETTER_QUEUE)) == 1
+
+    def test_unknown_senders_are_dead_lettered_at_once(self, local_queues):
+        http_email.main(queued(user="unknown"))
+
+        assert worker.drain() == 1
+        assert len(local_queues.get_queue(worker.DEAD_LETTER_QUEUE)) == 1
+
+    def test_oversized_emails_are_rejected(self, local_queues):
+        response = http_email.main(queued(body="x" * worker.queues.MAX_MESSAGE_BYTES))
+
+        assert response.status_code == 413
+        assert len(local_queues.get_queue(worker.OUTBOX_QUEUE)) == 0
+
+    def test_retries_back_off_exponentially(self, monkeypatch):
+        monkeypatch.setenv("EMAIL_WORKER_BACKOFF_SECONDS", "10")
+
+        assert [worker.retry_delay(x) for x in [1, 2, 3]] == [10, 20, 40]
@@ -0,0 +1,219 @@
+import json
+import smtplib
+
+import pytest
+
+import FunctionAutomate.HttpEmailWorker as worker
+import FunctionAutomate.MailMerge as mail_merge
+from FunctionAutomate.HttpEmail import EmailDeliverer, smtp_pool
+
+import azure.functions as func
+
+from jinja2 import Template
+
+
+@pytest.fixture()
+def postman(monkeypatch, fake_smtp):
+    monkeypatch.setattr(mail_merge, "_host_limiters", {})
+    monkeypatch.setenv("MAIL_MERGE_HOST_RATE", "10000")
+    monkeypatch.setenv("MAIL_MERGE_QUEUE_SIZE", "2")
+    monkeypatch.setenv("MAIL_MERGE_RECONNECT_BACKOFF_SECONDS", "0")
+
+    yield EmailDeliverer(
+        "host", 25, "me@a.com", "pwd", pool=smtp_pool.SMTPSessionPool(max_size=3)
+    )
+
+
+def run_merge(postman, records):
+    return mail_merge.merge(
+        postman,
+        Template("Hello {{ name }}"),
+        Template("For {{ name }}"),
+        "plain",
+        enumerate(records),
+        connections=3,
+    )
+
+
+class TestReadRecords:
+    def test_records_span_chunks(self):
+        chunks = [b'{"email": "a@a.com"}\n{"em', b'ail": "b@a.com"}\nnot json\n\n']
+
+        assert list(mail_merge.read_records(chunks)) == [
+            {"email": "a@a.com"},
+            {"email": "b@a.com"},
+            None,
+        ]
+
+
+class TestMerge:
+    def test_every_record_gets_an_outcome(self, postman, fake_smtp):
+        records = [{"email": f"{i}@a.com", "name": str(i)} for i in range(20)]
+        records[3] = {"email": "refused@a.com", "name": "x"}
+        records[7] = {"name": "no email"}
+
+        summary = run_merge(postman, records)
+
+        assert summary["total"] == 20
+        assert summary["accepted"] == 18
+        assert summary["refused"] == summary["failed"] == 1
+        assert [x["index"] for x in summary["results"]] == list(range(20))
+        assert summary["results"][7]["error"] == mail_merge.INVALID_RECORD
+
+        assert len(fake_smtp.opened) <= 3
+        assert sorted(msg["Subject"] for msg in fake_smtp.messages())[0] == "For 0"
+
+    def test_failing_sessions_do_not_stall_the_job(self, postman, fake_smtp):
+        fake_smtp.login_error = smtplib.SMTPAuthenticationError(535, b"Bad login")
+        records = [{"email": f"{i}@a.com", "name": str(i)} for i in range(10)]
+
+        summary = run_merge(postman, records)
+
+        assert summary["total"] == 10
+        assert summary["failed"] == 10
+
+    def test_zero_host_rate_is_unlimited(self, monkeypatch, postman):
+        monkeypatch.setenv("MAIL_MERGE_HOST_RATE", "0")
+        records = [{"email": f"{i}@a.com", "name": str(i)} for i in range(5)]
+
+        assert run_merge(postman, records)["accepted"] == 5
+
+    def test_reconnections_are_bounded(self, postman, fake_smtp):
+        fake_smtp.connect_error = smtplib.SMTPServerDisconnected("Connection lost")
+        records = [{"email": f"{i}@a.com", "name": str(i)} for i in range(10)]
+
+        summary = run_merge(postman, records)
+
+        assert summary["failed"] == 10
+        assert summary["results"][0]["error"] == "Connection lost"
+
+
+class TestChunkRecords:
+    def test_chunks_are_bounded_by_records_and_bytes(self):
+        records = [{"email": f"{i}@a.com"} for i in range(5)]
+        records[3] = {"email": "big@a.com", "name": "x" * 100}
+
+        chunks = list(mail_merge.chunk_records(records, 2, 60))
+
+        assert [x.start for x in chunks] == [0, 2, 4]
+        assert chunks[1].records == [records[2], None]
+        assert chunks[1].oversized == [1]
+        assert [x.oversized for x in chunks[::2]] == [[], []]
+
+
+@pytest.fixture()
+def jobs(postman, monkeypatch, table_service, sender_db):
+    templates = {"body.html": "Hello {{ name }}"}
+    monkeypatch.setenv("QUEUE_BACKEND", "local")
+    monkeypatch.setenv("AzureWebJobsStorage", "conn")
+    monkeypatch.setenv("MAIL_MERGE_CHUNK_RECORDS", "4")
+    monkeypatch.setattr(worker.queues, "_queues", {})
+    monkeypatch.setattr(
+        mail_merge.utilities, "setup_table_service", lambda *_: table_service
+    )
+    monkeypatch.setattr(
+        mail_merge,
+        "get_template",
+        lambda template_path, **kwargs: Template(templates[template_path]),
+    )
+    monkeypatch.setattr(mail_merge, "_smtp_pool", postman.pool)
+    yield table_service
+
+
+def request(method, **params):
+    return func.HttpRequest(
+        method=method,
+        url="/api/MailMerge",
+        body=json.dumps(params).encode() if method == "POST" else b"",
+        params=params if method == "GET" else {},
+    )
+
+
+def start_job(records):
+    return mail_merge.main(
+        request(
+            "POST",
+            user="user",
+            template_file="body.html",
+            share_name="templates",
+            subject="For {{ name }}",
+            mimetype="plain",
+            recipients=records,
+        )
+    )
+
+
+class TestJobs:
+    def test_jobs_are_queued_in_chunks(self, jobs):
+        records = [{"email": f"{i}@a.com", "name": str(i)} for i in range(10)]
+
+        response = start_job(records)
+
+        assert response.status_code == 202
+        job = json.loads(response.get_body())
+        assert job["total"] == 10
+        assert job["chunks"] == 3
+        progress = json.loads(
+            mail_merge.main(request("GET", job_id=job["job_id"])).get_body()
+        )
+        assert progress["state"] == "enqueued"
+        assert progress["chunks_done"] == 0
+
+    def test_worker_sends_the_chunks(self, jobs, fake_smtp):
+        records = [{"email": f"{i}@a.com", "name": str(i)} for i in range(10)]
+        records[5] = {"email": "refused@a.com", "name": "x"}
+        job_id = json.loads(start_job(records).get_body())["job_id"]
+
+        assert worker.drain() == 3
+
+        progress = json.loads(
+            mail_merge.main(request("GET", job_id=job_id)).get_body()
+        )
+        assert progress["state"] == "done"
+        assert progress["accepted"] == 9
+        assert progress["refused"] == 1
+        chunk = json.loads(
+            mail_merge.main(request("GET", job_id=job_id, chunk="1")).get_body()
+        )
+        assert [x["index"] for x in chunk["results"]] == [5]
+        assert len(fake_smtp.messages()) == 9
+
+    def test_dead_lettered_chunks_are_failed(self, jobs, monkeypatch):
+        def missing_template(**kwargs):
+            raise mail_merge.exceptions.HttpError("Template not found.", None)
+
+        monkeypatch.setattr(mail_merge, "get_template", missing_template)
+        records = [{"email": f"{i}@a.com", "name": str(i)} for i in range(3)]
+        job_id = json.loads(start_job(records).get_body())["job_id"]
+
+        worker.drain()
+
+        progress = json.loads(
+            mail_merge.main(request("GET", job_id=job_id)).get_body()
+        )
+        assert progress["state"] == "done"
+        assert progress["failed"] == 3
+
+    def test_long_subjects_still_fit_in_queue_messages(self, jobs, monkeypatch):
+        monkeypatch.setenv("MAIL_MERGE_CHUNK_RECORDS", "100")
+        records = [{"email": f"{i}@a.com", "name": "x" * 1000} for i in range(100)]
+        params = dict(
+            user="user",
+            template_file="body.html",
+            share_name="templates",
+            mimetype="plain",
+            recipients=records,
+        )
+
+        response = mail_merge.main(request("POST", subject="s" * 10000, **params))
+        assert response.status_code == 202
+        assert json.loads(response.get_body())["total"] == 100
+
+        response = mail_merge.main(request("POST", subject="s" * 20000, **params))
+        assert response.status_code == 400
+
+    def test_unknown_jobs_are_rejected(self, jobs):
+        response = mail_merge.main(request("GET", job_id="0" * 32))
+
+        assert response.status_code == 500
+        assert b"Unknown job_id" in response.get_body()
@@ -0,0 +1,253 @@
+import asyncio
+import base64
+import json
+import os
+
+import pytest
+
+import FunctionAutomate.PipelinePause as pipeline_pause
+from FunctionAutomate.PipelinePause import insert_batch
+from FunctionAutomate.utilities import clients, pausedata
+from FunctionAutomate.utilities.exceptions import HttpError
+
+import azure.functions as func
+from azure.core.exceptions import ResourceExistsError
+from azure.cosmosdb.table.models import Entity
+
+
+def entity(partition_key, row_key):
+    return Entity(PartitionKey=partition_key, RowKey=row_key)
+
+
+@pytest.fixture()
+def batch_request():
+    spec = {
+        "factory_name": "adf",
+        "resource_group": "rg",
+        "pipeline_name": "p1",
+        "expiration_time": 3600,
+        "web_path": "ok.html",
+        "share_name": "web",
+    }
+    req = func.HttpRequest(
+        method="POST",
+        body=json.dumps(
+            {"pauses": [dict(spec, data={"i": i}) for i in range(3)]}
+        ).encode(),
+        url="/api/x",
+    )
+    yield req
+
+
+class TestInsertBatch:
+    def test_batches_are_split_by_partition_and_size(
+        self, monkeypatch, table_service
+    ):
+        monkeypatch.setattr(pipeline_pause, "MAX_BATCH_SIZE", 2)
+        entities = [entity("a", "1"), entity("b", "2"), entity("a", "3")]
+        entities.append(entity("a", "4"))
+
+        assert insert_batch(table_service, "t", entities) == [None] * 4
+        assert sorted(table_service.batches) == [1, 1, 2]
+
+    def test_conflicts_are_reported_per_entity(self, table_service):
+        table_service.insert_entity("t", entity("a", "1"))
+        errors = insert_batch(table_service, "t", [entity("a", "1"), entity("a", "2")])
+
+        assert errors[0] is not None
+        assert errors[1] is None
+        assert table_service.row_keys("t") == ["1", "2"]
+
+
+class TestBatchMain:
+    def test_tokens_are_returned_in_order(
+        self, monkeypatch, table_service, batch_request
+    ):
+        monkeypatch.setenv("AzureWebJobsStorage", "conn")
+        monkeypatch.setattr(
+            pipeline_pause.utilities,
+            "setup_table_service",
+            lambda conn_str, target_table: table_service,
+        )
+        response = json.loads(pipeline_pause.main(batch_request).get_body())
+
+        assert len(response["tokens"]) == 3
+        assert response["errors"] == []
+        assert table_service.row_keys(pausedata.TARGET_TABLE) == sorted(
+            response["tokens"]
+        )
+
+    def test_async_entry_point_pauses_the_same(
+        self, monkeypatch, table_service, batch_request
+    ):
+        monkeypatch.setenv("AzureWebJobsStorage", "conn")
+        monkeypatch.setattr(
+            pipeline_pause.utilities,
+            "setup_table_service",
+            lambda conn_str, target_table: table_service,
+        )
+        response = asyncio.run(pipeline_pause.main_async(batch_request))
+
+        tokens = json.loads(response.get_body())["tokens"]
+        assert table_service.row_keys(pausedata.TARGET_TABLE) == sorted(tokens)
+
+
+class TestPauseParams:
+    def test_expiration_time_is_coerced(self):
+        params = pipeline_pause.get_pause_params(
+            {
+                "factory_name": "adf",
+                "resource_group": "rg",
+                "pipeline_name": "p1",
+                "expiration_time": "3600",
+                "web_path": "ok.html",
+                "share_name": "web",
+            }
+        )
+
+        assert params["expiration_time"] == 3600
+        assert params["data"] is None
+
+    def test_problems_are_reported_together(self):
+        with pytest.raises(HttpError) as e:
+            pipeline_pause.get_pause_params(
+                {"factory_name": "adf", "expiration_time": "soon"}
+            )
+
+        message = str(e.value)
+        assert "resource_group, pipeline_name, web_path, share_name" in message
+        assert "Invalid parameters: expiration_time" in message
+
+
+class TestEncodeData:
+    def test_small_payloads_stay_inline(self, file_shares):
+        properties = pausedata.encode_data("token", {"rows": [1, 2]})
+
+        assert properties == {"data": json.dumps({"rows": [1, 2]})}
+        assert pausedata.load_data(properties) == {"rows": [1, 2]}
+
+    def test_large_payloads_are_compressed(self, file_shares):
+        data = {"rows": [{"id": i, "value": "x" * 32} for i in range(1000)]}
+        properties = pausedata.encode_data("token", data)
+
+        assert properties["data_encoding"] == "gzip"
+        assert "data" not in properties
+        assert pausedata.load_data(properties) == data
+        assert file_shares.files == {}
+
+    def test_incompressible_payloads_are_offloaded(self, file_shares):
+        data = base64.b64encode(os.urandom(100000)).decode()
+        properties = pausedata.encode_data("token", data)
+
+        assert properties == {
+            "data_encoding": "file",
+            "data_ref": "pipeline-pause-data/token.json.gz",
+        }
+        assert list(file_shares.files) == [("pipeline-pause-data", "token.json.gz")]
+        assert pausedata.load_data(properties) == data
+
+
+class FakeShareService:
+    def __init__(self):
+        self.created = []
+
+    def create_share(self, share_name):
+        self.created.append(share_name)
+        if self.created.count(share_name) > 1:
+            raise ResourceExistsError("The specified share already exists.")
+
+
+class TestEnsureShare:
+    def test_shares_are_created_once(self, monkeypatch):
+        share_service = FakeShareService()
+        monkeypatch.setattr(clients, "get_share_service", lambda _: share_service)
+        monkeypatch.setattr(clients, "_existing_shares", set())
+
+        clients.ensure_share("conn", "data")
+        clients.ensure_share("conn", "data")
+        clients._existing_shares.clear()
+        clients.ensure_share("conn", "data")
+
+        assert share_service.created == ["data", "data"]
+
+
+class FailingTableService:
+    def insert_entity(self, table_name, entity):
+        raise ValueError("Table unavailable")
+
+    def commit_batch(self, table_name, batch):
+        raise ValueError("Table unavailable")
+
+
+class TestFailedInserts:
+    @pytest.fixture()
+    def failing_table(self, monkeypatch, file_shares):
+        monkeypatch.setattr(
+            pipeline_pause.utilities,
+            "setup_table_service",
+            lambda conn_str, target_table: FailingTableService(),
+        )
+
+    def pause(self, **params):
+        return dict(
+            {
+                "factory_name": "adf",
+                "resource_group": "rg",
+                "pipeline_name": "p1",
+                "expiration_time": 3600,
+                "web_path": "ok.html",
+                "share_name": "web",
+                "data": base64.b64encode(os.urandom(100000)).decode(),
+            },
+            **params,
+        )
+
+    def test_offloaded_data_of_failed_batch_inserts_is_deleted(
+        self, failing_table, file_shares
+    ):
+        req = func.HttpRequest(
+            method="POST",
+            body=json.dumps({"pauses": [self.pause(), self.pause()]}).encode(),
+            url="/api/x",
+        )
+
+        response = json.loads(pipeline_pause.main(req).get_body())
+
+        assert response["tokens"] == [None, None]
+        assert file_shares.files == {}
+
+    def test_offloaded_data_is_deleted_when_a_later_upload_fails(
+        self, monkeypatch, failing_table, file_shares
+    ):
+        encode_data = pipeline_pause.pausedata.encode_data
+        calls = []
+
+        def flaky_encode_data(token, data):
+            calls.append(token)
+            if len(calls) == 2:
+                raise OSError("Upload failed")
+            return encode_data(token, data)
+
+        monkeypatch.setattr(pipeline_pause.pausedata, "encode_data", flaky_encode_data)
+        req = func.HttpRequest(
+            method="POST",
+            body=json.dumps({"pauses": [self.pause(), self.pause()]}).encode(),
+            url="/api/x",
+        )
+
+        with pytest.raises(OSError):
+            pipeline_pause.main(req)
+        assert len(calls) == 2
+        assert file_shares.files == {}
+
+    def test_offloaded_data_of_a_failed_insert_is_deleted(
+        self, failing_table, file_shares
+    ):
+        req = func.HttpRequest(
+            method="POST", body=json.dumps(self.pause()).encode(), url="/api/x"
+        )
+
+        with pytest.raises(ValueError):
+            pipeline_pause.main(req)
+
+        assert file_shares.files == {}
@@ -0,0 +1,142 @@
+import datetime
+
+import pytz
+
+import FunctionAutomate.PipelinePauseCleanup as cleanup
+from FunctionAutomate.PipelinePauseCleanup import (
+    collect_garbage,
+    is_garbage,
+    load_marker,
+    save_marker,
+)
+from FunctionAutomate.utilities.pausedata import TARGET_TABLE
+
+from azure.cosmosdb.table.models import Entity
+
+
+def row(
+    row_key,
+    age,
+    expiration_time,
+    acted_upon=0,
+    partition_key="PauseData-000",
+    **properties,
+):
+    timestamp = pytz.utc.localize(datetime.datetime.now()) - datetime.timedelta(
+        seconds=age
+    )
+    return Entity(
+        PartitionKey=partition_key,
+        RowKey=row_key,
+        Timestamp=timestamp,
+        expiration_time=expiration_time,
+        acted_upon=acted_upon,
+        **properties,
+    )
+
+
+class TestIsGarbage:
+    def test_consumed_rows_are_kept_during_grace_period(self):
+        assert not is_garbage(row("a", 50, 10000, acted_upon=1), 100)
+        assert is_garbage(row("a", 150, 10000, acted_upon=1), 100)
+
+    def test_expired_rows_are_kept_during_grace_period(self):
+        assert not is_garbage(row("a", 150, 100), 100)
+        assert is_garbage(row("a", 250, 100), 100)
+
+
+class TestCollectGarbage:
+    def test_garbage_is_deleted_across_pages_and_partitions(self, table_service):
+        table_service.put(
+            TARGET_TABLE,
+            [
+                row("1", 500, 100),
+                row("2", 500, 10000),
+                row("3", 500, 10000, acted_upon=1, partition_key="PauseData-001"),
+                row("4", 500, 100, partition_key="PauseData-002"),
+                row("5", 10, 10000),
+            ],
+        )
+
+        report = collect_garbage(table_service, 100, 10 ** 6, page_size=2)
+
+        assert report["scanned"] == 5
+        assert report["deleted"] == 3
+        assert table_service.row_keys(TARGET_TABLE) == ["2", "5"]
+        assert len(table_service.queries) == 3
+
+    def test_rows_deleted_concurrently_are_skipped(self, monkeypatch, table_service):
+        table_service.put(TARGET_TABLE, [row("1", 500, 100), row("2", 500, 100)])
+        original = table_service.commit_batch
+
+        def commit_batch(table_name, batch):
+            table_service.delete_entity(table_name, "PauseData-000", "1")
+            original(table_name, batch)
+
+        monkeypatch.setattr(table_service, "commit_batch", commit_batch)
+        report = collect_garbage(table_service, 100, 10 ** 6)
+
+        assert report["deleted"] == 1
+        assert table_service.row_keys(TARGET_TABLE) == []
+
+    def test_batches_are_bounded(self, monkeypatch, table_service):
+        monkeypatch.setattr(cleanup, "MAX_BATCH_SIZE", 1)
+        table_service.put(TARGET_TABLE, [row("1", 500, 100), row("2", 500, 100)])
+
+        assert collect_garbage(table_service, 100, 10 ** 6)["deleted"] == 2
+
+    def test_stops_on_time_budget_and_resumes_from_marker(self, table_service):
+        table_service.put(TARGET_TABLE, [row(str(i), 500, 100) for i in range(5)])
+
+        report = collect_garbage(table_service, 100, 10 ** 6, 2, time_budget=0)
+        assert report["deleted"] == 2
+        assert report["next_marker"] is not None
+
+        report = collect_garbage(
+            table_service, 100, 10 ** 6, 2, marker=report["next_marker"]
+        )
+        assert report["deleted"] == 3
+        assert report["next_marker"] is None
+        assert table_service.row_keys(TARGET_TABLE) == []
+
+    def test_files_of_rows_not_deleted_are_kept(
+        self, monkeypatch, table_service, file_shares
+    ):
+        table_service.put(
+            TARGET_TABLE,
+            [
+                row(str(i), 500, 100, data_encoding="file", data_ref=f"share/{i}")
+                for i in range(2)
+            ],
+        )
+        file_shares.put("share", "0", "data")
+        file_shares.put("share", "1", "data")
+        delete_entity = table_service.delete_entity
+
+        def commit_batch(table_name, batch):
+            raise RuntimeError("Batch failed")
+
+        def flaky_delete(table_name, partition_key, row_key):
+            if row_key == "1":
+                raise RuntimeError("Server busy")
+            delete_entity(table_name, partition_key, row_key)
+
+        monkeypatch.setattr(table_service, "commit_batch", commit_batch)
+        monkeypatch.setattr(table_service, "delete_entity", flaky_delete)
+        report = collect_garbage(table_service, 100, 10 ** 6)
+
+        assert report["deleted"] == report["files_deleted"] == 1
+        assert table_service.row_keys(TARGET_TABLE) == ["1"]
+        assert list(file_shares.files) == [("share", "1")]
+
+
+class TestMarker:
+    def test_marker_is_kept_until_the_scan_finishes(self, file_shares):
+        assert load_marker() is None
+
+        marker = {"nextpartitionkey": "PauseData-003", "nextrowkey": "abc"}
+        save_marker(marker)
+        assert load_marker() == marker
+
+        save_marker(None)
+        assert load_marker() is None
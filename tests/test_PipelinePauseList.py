@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+import FunctionAutomate.PipelinePauseList as pause_list
+from FunctionAutomate.utilities import schema
+from FunctionAutomate.utilities.exceptions import HttpError
+
+import azure.functions as func
+from azure.cosmosdb.table.models import Entity
+
+
+@pytest.fixture()
+def pauses(table_service):
+    table_service.put(
+        pause_list.pausedata.TARGET_TABLE,
+        [
+            Entity(
+                PartitionKey="PauseData-000",
+                RowKey=f"token-{i}",
+                pipeline_name="p",
+                acted_upon=0,
+                data="{}",
+            )
+            for i in range(10)
+        ],
+    )
+    yield table_service
+
+
+def parse(params):
+    return schema.parse(params, pause_list.LIST_FIELDS)
+
+
+class TestBuildFilter:
+    def test_filters_are_combined(self):
+        query = pause_list.build_filter(
+            parse(
+                {
+                    "factory_name": "adf",
+                    "pipeline_name": "it's",
+                    "acted_upon": "0",
+                    "expires_before": "2020-01-02T03:04:05",
+                }
+            )
+        )
+
+        assert query == (
+            "factory_name eq 'adf' and pipeline_name eq 'it''s' and acted_upon eq 0"
+            " and expires_at lt datetime'2020-01-02T03:04:05Z'"
+        )
+
+    def test_no_filters(self):
+        assert pause_list.build_filter(parse({})) is None
+
+    def test_data_can_not_be_selected(self):
+        with pytest.raises(HttpError) as e:
+            parse({"select": "pipeline_name,data"})
+
+        assert "unknown properties data" in str(e.value)
+
+
+class TestListPauses:
+    def test_pages_are_chained_with_continuation_tokens(self, pauses):
+        params = {"select": "pipeline_name", "page_size": "4"}
+
+        tokens = []
+        while True:
+            page = pause_list.list_pauses(pauses, parse(params))
+            tokens += [x["token"] for x in page["pauses"]]
+            if page["continuation_token"] is None:
+                break
+            params["continuation_token"] = page["continuation_token"]
+
+        assert tokens == [f"token-{i}" for i in range(10)]
+        assert len(pauses.queries) == 3
+        assert pauses.queries[0]["select"] == "RowKey,pipeline_name"
+        assert page["pauses"][0] == {"token": "token-8", "pipeline_name": "p"}
+
+    def test_malformed_continuation_tokens_are_rejected(self, monkeypatch):
+        monkeypatch.setenv("AzureWebJobsStorage", "conn")
+        req = func.HttpRequest(
+            method="GET",
+            url="/api/PipelinePauseList",
+            body=b"",
+            params={"continuation_token": "not a token"},
+        )
+
+        response = pause_list.main(req)
+
+        assert response.status_code == 500
+        assert b"continuation_token" in response.get_body()
+
+    def test_main_returns_json(self, monkeypatch, pauses):
+        monkeypatch.setenv("AzureWebJobsStorage", "conn")
+        monkeypatch.setattr(
+            pause_list.utilities,
+            "setup_table_service",
+            lambda conn_str, target_table: pauses,
+        )
+        req = func.HttpRequest(method="GET", url="/api/PipelinePauseList", body=b"")
+
+        page = json.loads(pause_list.main(req).get_body())
+
+        assert len(page["pauses"]) == 10
+        assert "data" not in page["pauses"][0]
+        assert page["continuation_token"] is None
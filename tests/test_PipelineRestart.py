@@ -0,0 +1,338 @@
+import asyncio
+import datetime
+import json
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+import FunctionAutomate.PipelineRestart as pipeline_restart
+from FunctionAutomate.PipelineRestart import PipelineCatalog, restart_pipeline
+from FunctionAutomate.utilities import aio, clients, exceptions, pausedata, utilities
+from FunctionAutomate.utilities.exceptions import HttpError
+
+import azure.functions as func
+from azure.common import AzureMissingResourceHttpError
+from azure.cosmosdb.table.models import Entity
+
+
+class NotFound(Exception):
+    status_code = 404
+
+
+class FakePipelines:
+    """Stand-in for the pipelines operations of DataFactoryManagementClient."""
+
+    def __init__(self, names):
+        self.names = set(names)
+        self.gets = 0
+        self.runs = []
+        self.parameters = []
+
+    def get(self, resource_group, factory_name, pipeline_name):
+        self.gets += 1
+        if pipeline_name not in self.names:
+            raise NotFound()
+        return SimpleNamespace(name=pipeline_name)
+
+    def create_run(self, resource_group, factory_name, pipeline_name, parameters):
+        if pipeline_name not in self.names:
+            raise NotFound()
+        self.runs.append(pipeline_name)
+        self.parameters.append(parameters)
+        return SimpleNamespace(run_id=f"run-{len(self.runs)}")
+
+
+@pytest.fixture()
+def adf_client(monkeypatch):
+    monkeypatch.setattr(pipeline_restart, "_pipeline_catalog", PipelineCatalog(60))
+    yield SimpleNamespace(pipelines=FakePipelines(["p1"]))
+
+
+class TestRestartPipeline:
+    def test_catalog_avoids_repeated_lookups(self, adf_client):
+        restart_pipeline(adf_client, "rg", "adf", "p1", "token", "PauseData-001")
+        restart_pipeline(adf_client, "rg", "adf", "p1", "token", "PauseData-001")
+
+        assert adf_client.pipelines.gets == 1
+        assert adf_client.pipelines.runs == ["p1", "p1"]
+
+    def test_missing_pipeline_is_rejected(self, adf_client):
+        with pytest.raises(HttpError):
+            restart_pipeline(adf_client, "rg", "adf", "p2", "token", "PauseData-001")
+
+    def test_deleted_pipeline_refreshes_catalog(self, adf_client):
+        restart_pipeline(adf_client, "rg", "adf", "p1", "token", "PauseData-001")
+        adf_client.pipelines.names = set()
+
+        with pytest.raises(HttpError):
+            restart_pipeline(adf_client, "rg", "adf", "p1", "token", "PauseData-001")
+        assert adf_client.pipelines.gets == 2
+
+
+class TestPartitionKeys:
+    def test_partition_key_is_deterministic(self):
+        keys = {pausedata.partition_key("token", buckets=16) for _ in range(3)}
+
+        assert len(keys) == 1
+        assert keys.pop().startswith("PauseData-")
+
+    def test_single_bucket_is_legacy_partition(self):
+        assert pausedata.partition_key("token", buckets=1) == "PauseData"
+
+    def test_lookup_falls_back_to_legacy_partition(self, table_service):
+        table_service.put(
+            pausedata.TARGET_TABLE,
+            [Entity(PartitionKey="PauseData", RowKey="token", acted_upon=0)],
+        )
+
+        entity = pausedata.get_paused_pipeline(table_service, "token")
+        assert entity["PartitionKey"] == "PauseData"
+        assert entity["acted_upon"] == 0
+        with pytest.raises(AzureMissingResourceHttpError):
+            pausedata.get_paused_pipeline(table_service, "other")
+
+
+@pytest.fixture()
+def registry():
+    clients.reset()
+    yield clients
+    clients.reset()
+
+
+class ExistsCheckingTable:
+    exists_result = True
+
+    def __init__(self):
+        self.checks = []
+
+    def exists(self, table_name):
+        self.checks.append(table_name)
+        return self.exists_result
+
+
+class TestClients:
+    def test_table_check_is_memoized(self, registry):
+        table_service = ExistsCheckingTable()
+        registry._table_services["conn"] = table_service
+
+        assert utilities.setup_table_service("conn", "t") is table_service
+        assert utilities.setup_table_service("conn", "t") is table_service
+        assert table_service.checks == ["t"]
+
+    def test_missing_table_is_checked_again(self, registry):
+        table_service = ExistsCheckingTable()
+        table_service.exists_result = False
+        registry._table_services["conn"] = table_service
+
+        with pytest.raises(HttpError):
+            utilities.setup_table_service("conn", "t")
+
+        table_service.exists_result = True
+        assert utilities.setup_table_service("conn", "t") is table_service
+        assert table_service.checks == ["t", "t"]
+
+
+@pytest.fixture()
+def token_filter(monkeypatch, table_service):
+    lookups = []
+    monkeypatch.setenv("AzureWebJobsStorage", "conn")
+    monkeypatch.setattr(
+        pipeline_restart.utilities,
+        "setup_table_service",
+        lambda conn_str, table: lookups.append(table) or table_service,
+    )
+    monkeypatch.setattr(
+        pipeline_restart, "_rejected_tokens", pipeline_restart.RejectedTokens(60, 10)
+    )
+    yield lookups
+
+
+def restart_request(token):
+    return func.HttpRequest(
+        method="GET", url="/api/PipelineRestart", params={"token": token}, body=b""
+    )
+
+
+class TestRejectedTokens:
+    def test_malformed_tokens_skip_storage(self, token_filter):
+        for token in ["abc", "x" * 85 + "!", "x" * 87]:
+            response = pipeline_restart.main(restart_request(token))
+            assert response.status_code == 500
+
+        assert token_filter == []
+        assert pipeline_restart._rejected_tokens.stats()["malformed"] == 3
+
+    def test_unknown_tokens_are_looked_up_once(self, token_filter):
+        token = pausedata.new_token()
+        assert pausedata.is_well_formed(token)
+
+        for _ in range(3):
+            response = pipeline_restart.main(restart_request(token))
+            assert response.status_code == 500
+
+        assert len(token_filter) == 1
+        stats = pipeline_restart._rejected_tokens.stats()
+        assert stats["looked_up"] == 1
+        assert stats["remembered"] == 2
+
+
+@exceptions.exceptions_as_response
+def traced_main(req):
+    with exceptions.span("stage"):
+        exceptions.annotate(cache_hit=True)
+    raise HttpError("Nope", func.HttpResponse("Nope", status_code=404))
+
+
+class TestTracing:
+    def test_one_record_per_invocation(self, monkeypatch, caplog):
+        monkeypatch.setenv("TRACE_INVOCATIONS", "1")
+        with caplog.at_level(logging.INFO):
+            traced_main(None)
+
+        traces = [
+            json.loads(r.getMessage().split(": ", 1)[1])
+            for r in caplog.records
+            if r.getMessage().startswith("Invocation trace:")
+        ]
+        assert len(traces) == 1
+        assert traces[0]["status_code"] == 404
+        assert traces[0]["cache_hit"] is True
+        assert set(traces[0]["stages_ms"]) == {"stage"}
+
+    def test_disabled_tracing_is_a_no_op(self, monkeypatch, caplog):
+        monkeypatch.delenv("TRACE_INVOCATIONS", raising=False)
+        with caplog.at_level(logging.INFO):
+            traced_main(None)
+
+        assert exceptions.span("stage") is exceptions.span("other")
+        assert not exceptions.tracing_enabled()
+        assert not any("Invocation trace" in r.getMessage() for r in caplog.records)
+
+
+@exceptions.exceptions_as_response_async
+async def traced_main_async(req):
+    def stage():
+        with exceptions.span("stage"):
+            exceptions.annotate(cache_hit=True)
+
+    await aio.run_blocking(stage)
+    if req == "fail":
+        raise ValueError("Unexpected")
+    raise HttpError("Nope", func.HttpResponse("Nope", status_code=404))
+
+
+class TestTracingAsync:
+    def test_stages_in_the_executor_are_traced(self, monkeypatch, caplog):
+        monkeypatch.setenv("TRACE_INVOCATIONS", "1")
+        with caplog.at_level(logging.INFO):
+            response = asyncio.run(traced_main_async(None))
+
+        assert response.status_code == 404
+        traces = [
+            json.loads(r.getMessage().split(": ", 1)[1])
+            for r in caplog.records
+            if r.getMessage().startswith("Invocation trace:")
+        ]
+        assert traces[0]["status_code"] == 404
+        assert traces[0]["cache_hit"] is True
+        assert set(traces[0]["stages_ms"]) == {"stage"}
+
+    def test_other_errors_are_raised(self):
+        with pytest.raises(ValueError):
+            asyncio.run(traced_main_async("fail"))
+
+
+class TestMainAsync:
+    @pytest.fixture()
+    def paused(self, monkeypatch, table_service, token_filter, adf_client):
+        token = pausedata.new_token()
+        table_service.put(
+            pausedata.TARGET_TABLE,
+            [
+                Entity(
+                    PartitionKey=pausedata.partition_key(token),
+                    RowKey=token,
+                    Timestamp=datetime.datetime.now(datetime.timezone.utc),
+                    resource_group="rg",
+                    factory_name="adf",
+                    pipeline_name="p1",
+                    expiration_time=3600,
+                    acted_upon=0,
+                    web_path="ok.html",
+                    share_name="web",
+                )
+            ],
+        )
+
+        async def download_file(conn_str, share_name, file_path):
+            return b"<html>Restarted</html>", "etag"
+
+        monkeypatch.setattr(clients, "get_adf_client", lambda: adf_client)
+        monkeypatch.setattr(aio, "download_file", download_file)
+        yield token
+
+    def test_tokens_restart_their_pipeline_once(self, paused, adf_client):
+        main_async = pipeline_restart.main_async
+
+        response = asyncio.run(main_async(restart_request(paused)))
+        assert response.status_code == 200
+        assert response.get_body() == b"<html>Restarted</html>"
+        assert adf_client.pipelines.runs == ["p1"]
+        assert adf_client.pipelines.parameters == [
+            {"token": paused, "partition_key": pausedata.partition_key(paused)}
+        ]
+
+        response = asyncio.run(main_async(restart_request(paused)))
+        assert response.status_code == 500
+        assert adf_client.pipelines.runs == ["p1"]
+
+
+class FakeShareService:
+    """Stand-in for the aio ShareServiceClient, down to its file clients."""
+
+    def __init__(self):
+        self.closed = False
+
+    def get_share_client(self, share_name):
+        return self
+
+    def get_file_client(self, file_path):
+        return self
+
+    async def get_file_properties(self):
+        return SimpleNamespace(etag="etag")
+
+    async def close(self):
+        self.closed = True
+
+
+class TestAioClients:
+    def test_share_service_is_reused_and_closed(self, monkeypatch):
+        created = []
+
+        def from_connection_string(conn_str):
+            created.append(FakeShareService())
+            return created[-1]
+
+        monkeypatch.setattr(
+            aio,
+            "_fileshare_aio_sdk",
+            SimpleNamespace(
+                ShareServiceClient=SimpleNamespace(
+                    from_connection_string=from_connection_string
+                )
+            ),
+        )
+        monkeypatch.setattr(aio, "_share_services", {})
+        monkeypatch.setattr(aio, "_closers", [])
+
+        async def get_etags_and_close():
+            etags = [await aio.get_etag("conn", "web", f"{i}.html") for i in range(3)]
+            await aio.close_async()
+            return etags
+
+        assert asyncio.run(get_etags_and_close()) == ["etag"] * 3
+        assert len(created) == 1
+        assert created[0].closed
+        assert aio._share_services == {}
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import FunctionAutomate.PipelineStatus as pipeline_status
+from FunctionAutomate.utilities import caching, clients, pausedata
+from FunctionAutomate.utilities.exceptions import HttpError
+
+import azure.functions as func
+from azure.common import AzureMissingResourceHttpError
+
+
+class TestCoalescingCache:
+    def test_concurrent_callers_share_one_load(self):
+        cache = caching.CoalescingCache(ttl=60, max_entries=10)
+        loads = []
+
+        def load():
+            loads.append(1)
+            time.sleep(0.05)
+            return "value"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get("k", load)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == ["value"] * 8
+        assert len(loads) == 1
+        assert cache.stats()["coalesced"] + cache.stats()["hits"] == 7
+
+    def test_failed_loads_are_not_cached(self):
+        cache = caching.CoalescingCache(ttl=60, max_entries=10)
+
+        def load():
+            raise ValueError("boom")
+
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                cache.get("k", load)
+        assert cache.stats()["loads"] == 2
+
+
+class FakePipelineRuns:
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.gets = 0
+
+    def get(self, resource_group, factory_name, run_id):
+        self.gets += 1
+        return SimpleNamespace(
+            run_id=run_id,
+            status=self.statuses.pop(0),
+            message="",
+            run_start=None,
+            run_end=None,
+            duration_in_ms=None,
+        )
+
+
+@pytest.fixture()
+def adf_runs(monkeypatch):
+    monkeypatch.setattr(
+        pipeline_status, "_run_statuses", caching.CoalescingCache(0, 10)
+    )
+    runs = FakePipelineRuns(["InProgress", "Succeeded", "Failed"])
+    monkeypatch.setattr(
+        clients, "get_adf_client", lambda: SimpleNamespace(pipeline_runs=runs)
+    )
+    yield runs
+
+
+class TestRunStatus:
+    def test_terminal_states_are_kept(self, adf_runs):
+        statuses = [
+            pipeline_status.get_run_status("rg", "adf", "run-1")["status"]
+            for _ in range(3)
+        ]
+
+        assert statuses == ["InProgress", "Succeeded", "Succeeded"]
+        assert adf_runs.gets == 2
+
+    def test_paused_pipelines_have_no_run(self, monkeypatch, adf_runs):
+        entity = {"pipeline_name": "p", "acted_upon": 0}
+        monkeypatch.setattr(
+            pipeline_status, "find_run", lambda token: dict(entity, run_id=None)
+        )
+
+        status = pipeline_status.pipeline_status(pausedata.new_token())
+
+        assert status == {"pipeline_name": "p", "run_id": None, "status": "Paused"}
+        assert adf_runs.gets == 0
+
+
+class TestMainAsync:
+    def test_status_is_reported(self, monkeypatch, adf_runs):
+        run = {
+            "resource_group": "rg",
+            "factory_name": "adf",
+            "pipeline_name": "p",
+            "acted_upon": 1,
+            "run_id": "run-1",
+        }
+        monkeypatch.setattr(pipeline_status, "find_run", lambda token: run)
+        req = func.HttpRequest(
+            method="GET",
+            url="/api/PipelineStatus",
+            params={"token": pausedata.new_token()},
+            body=b"",
+        )
+
+        response = asyncio.run(pipeline_status.main_async(req))
+
+        assert json.loads(response.get_body())["status"] == "InProgress"
+
+    def test_malformed_tokens_are_rejected(self):
+        req = func.HttpRequest(
+            method="GET", url="/api/PipelineStatus", params={"token": "x"}, body=b""
+        )
+
+        assert asyncio.run(pipeline_status.main_async(req)).status_code == 500
+
+
+class TestFindRun:
+    def test_unknown_tokens_are_remembered(self, monkeypatch):
+        monkeypatch.setenv("AzureWebJobsStorage", "conn")
+        monkeypatch.setattr(
+            pipeline_status, "_runs_by_token", caching.CoalescingCache(15, 10)
+        )
+        monkeypatch.setattr(
+            pipeline_status.utilities,
+            "setup_table_service",
+            lambda conn_str, target_table: None,
+        )
+        lookups = []
+
+        def get_paused_pipeline(table_service, token, select=None):
+            lookups.append(token)
+            raise AzureMissingResourceHttpError("Not found", 404)
+
+        monkeypatch.setattr(pausedata, "get_paused_pipeline", get_paused_pipeline)
+        token = pausedata.new_token()
+
+        for _ in range(3):
+            with pytest.raises(HttpError):
+                pipeline_status.find_run(token)
+
+        assert lookups == [token]